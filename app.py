@@ -25,9 +25,11 @@ import gradio as gr
 pipeline, device, config = None, None, None
 
 import threading
+from contextlib import nullcontext
 from functools import lru_cache
 
 _init_lock = threading.Lock()
+_inference_lock = threading.Lock()
 
 @lru_cache(maxsize=1)
 def get_pipeline():
@@ -65,6 +67,9 @@ def fn(prompt, duration):
     with _init_lock:
         pipeline, config, device = get_pipeline()
 
+    # with paged KV cache storage every request takes its own pages from the shared pool,
+    # otherwise requests share one KV cache and run one at a time
+    with nullcontext() if pipeline.kv_cache_storage == "paged" else _inference_lock:
         sampled_noise = torch.randn(
             [1, config['num_frame_per_block'], 16, 60, 104], device=device, dtype=torch.bfloat16
         )
@@ -90,7 +95,8 @@ def fn(prompt, duration):
         all_video.append(current_video)
         video = 255.0 * torch.cat(all_video, dim=1)
         
-        pipeline.vae.model.clear_cache()
+        with pipeline.vae_lock:
+            pipeline.vae.model.clear_cache()
         output_path = f"{GRADIO_TMP}/{prompt[:100].replace(' ', '_')}-{time.time()}.mp4"
         write_video(output_path, video[0], fps=16)
         
@@ -145,7 +151,11 @@ if __name__ == "__main__":
         examples_per_page=30
     )
 
-    demo.queue(default_concurrency_limit=1)
+    # with paged KV cache storage requests run concurrently, the pool makes them wait for free pages
+    kv_cache_storage = OmegaConf.merge(
+        OmegaConf.load("configs/default_config.yaml"), OmegaConf.load("configs/self_forcing_dmd.yaml")
+    ).kv_cache_storage
+    demo.queue(default_concurrency_limit=None if kv_cache_storage == "paged" else 1)
     demo.launch(
         server_name="0.0.0.0",
         server_port=1324,
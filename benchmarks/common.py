@@ -0,0 +1,59 @@
+import time
+
+import torch
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def time_calls(modules, device):
+    """
+    Record the latency in seconds of every call of `modules` into the returned list, clear it between runs.
+    """
+    call_times = []
+
+    def start(module, inputs):
+        synchronize(device)
+        module.call_start = time.perf_counter()
+
+    def stop(module, inputs, output):
+        synchronize(device)
+        call_times.append(time.perf_counter() - module.call_start)
+
+    for module in modules:
+        module.register_forward_pre_hook(start)
+        module.register_forward_hook(stop)
+    return call_times
+
+
+def time_generator_calls(pipeline, device):
+    """
+    Record the latency in seconds of every call of the generator of `pipeline` (one denoising step or clean
+    context pass of the blocks in flight) into the returned list, clear it between runs.
+    """
+    return time_calls([pipeline.generator], device)
+
+
+def timed(function, device):
+    """
+    Run `function` and return its result with its latency in seconds.
+    """
+    synchronize(device)
+    start = time.perf_counter()
+    result = function()
+    synchronize(device)
+    return result, time.perf_counter() - start
+
+
+def kv_cache_bytes(pipeline):
+    """
+    Size in bytes of the KV cache of `pipeline`, the whole pool with paged storage.
+    """
+    if pipeline.kv_cache_pool is not None:
+        layers = pipeline.kv_cache_pool.layers
+    else:
+        layers = pipeline.kv_cache1
+    return sum(value.numel() * value.element_size()
+               for layer in layers for value in layer.values() if torch.is_tensor(value))
@@ -0,0 +1,57 @@
+import argparse
+import statistics
+
+import torch
+
+from benchmarks.common import time_generator_calls
+from utils.misc import cpu_fallbacks
+from utils.tiny_models import make_noise, make_pipeline
+
+# Per-step latency of the eager and the compiled (`compile_denoise_step`) generator on a 2-layer model at the width
+# of Wan 1.3B, and how far the latents of the compiled one are from the eager ones.
+# Run from the repository root: python -m benchmarks.compile_denoise_step
+parser = argparse.ArgumentParser()
+parser.add_argument("--num_layers", type=int, default=2, help="Number of transformer blocks")
+parser.add_argument("--ffn_dim", type=int, default=8960, help="FFN width, 8960 is the one of Wan 1.3B")
+parser.add_argument("--num_frames", type=int, default=12, help="Number of latent frames per video")
+parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+parser.add_argument("--rtol", type=float, default=5e-2,
+                    help="Largest latent difference accepted, relative to the largest eager latent")
+args = parser.parse_args()
+
+torch.set_grad_enabled(False)
+device = torch.device(args.device)
+
+
+def run(compile_denoise_step):
+    """
+    Generate the same video twice, the first run warms up (and compiles). Returns the latents of the second run
+    and the latency of each of its generator calls in seconds.
+    """
+    pipeline = make_pipeline(
+        args.num_layers, ffn_dim=args.ffn_dim, compile_denoise_step=compile_denoise_step).to(device)
+    step_times = time_generator_calls(pipeline, device)
+    for _ in range(2):
+        step_times.clear()
+        # inference draws the noise of the denoising steps from the global RNG
+        torch.manual_seed(0)
+        _, latents = pipeline.inference(
+            make_noise(1, args.num_frames).to(device), ["a prompt"], return_latents=True)
+    return latents.float().cpu(), step_times
+
+
+with cpu_fallbacks():
+    eager_latents, eager_times = run(False)
+    compiled_latents, compiled_times = run(True)
+
+eager_median, compiled_median = statistics.median(eager_times), statistics.median(compiled_times)
+# the model runs in bfloat16, the fused kernels of the compiled blocks round their intermediates differently
+max_difference = (compiled_latents - eager_latents).abs().max().item()
+relative_difference = max_difference / eager_latents.abs().max().item()
+print(f"{len(eager_times)} denoise steps of {args.num_layers} layers, ffn {args.ffn_dim}, "
+      f"{args.num_frames} frames on {device}")
+print(f"eager     {eager_median * 1e3:9.1f} ms per step (median), {sum(eager_times):7.2f} s total")
+print(f"compiled  {compiled_median * 1e3:9.1f} ms per step (median), {sum(compiled_times):7.2f} s total")
+print(f"speedup   {eager_median / compiled_median:.2f}x, latents differ by at most {max_difference:.2e} "
+      f"({relative_difference:.2%} of the largest latent)")
+assert relative_difference <= args.rtol, f"the compiled latents differ from the eager ones by {max_difference}"
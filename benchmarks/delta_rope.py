@@ -0,0 +1,64 @@
+import argparse
+import statistics
+
+import torch
+
+from benchmarks.common import timed
+from utils.misc import cpu_fallbacks
+from utils.tiny_models import make_generator
+
+# Latency of a Rolling Sink re-insertion of 3 frames of keys: rotating the keys roped at their original positions
+# by the frame offset (`causal_rope_shift`, the current path) against roping the un-roped keys at their new
+# positions (`causal_rope_apply`, the previous one), and how far apart they are, at the sizes of Wan 1.3B.
+# Run from the repository root: python -m benchmarks.delta_rope
+parser = argparse.ArgumentParser()
+parser.add_argument("--latent_height", type=int, default=60, help="60 x 104 latents decode to 480 x 832")
+parser.add_argument("--latent_width", type=int, default=104)
+parser.add_argument("--current_start_frame", type=int, default=42, help="Frame the source frames move to")
+parser.add_argument("--left", type=int, default=9, help="First source frame")
+parser.add_argument("--reverse", action="store_true", help="Re-insert the source frames in reverse order")
+parser.add_argument("--repeats", type=int, default=20)
+parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+args = parser.parse_args()
+
+torch.set_grad_enabled(False)
+device = torch.device(args.device)
+
+
+def median_time(function):
+    times = [timed(function, device)[1] for _ in range(args.repeats + 1)]
+    return statistics.median(times[1:])
+
+
+with cpu_fallbacks():
+    from wan.modules.causal_model import causal_rope_apply, causal_rope_shift
+
+    freqs = make_generator(num_layers=1).model.freqs.to(device)
+    grid_h, grid_w = args.latent_height // 2, args.latent_width // 2
+    frame_seqlen = grid_h * grid_w
+    grid_sizes = torch.tensor([[3, grid_h, grid_w]])
+    keys = torch.randn(1, 3 * frame_seqlen, 12, 128, generator=torch.Generator().manual_seed(0)).to(
+        device, torch.bfloat16)
+    # the first-window copy holds the keys roped at their original positions
+    roped = causal_rope_apply(keys, grid_sizes, freqs, start_frame=args.left)
+
+    def flip(x):
+        return x.unflatten(1, (3, frame_seqlen)).flip(dims=[1]).flatten(1, 2) if args.reverse else x
+
+    if args.reverse:
+        shift, shift_step = args.current_start_frame - (args.left + 2), 2
+    else:
+        shift, shift_step = args.current_start_frame - args.left, 0
+    delta = causal_rope_shift(flip(roped), freqs, frame_seqlen, shift, shift_step)
+    previous = causal_rope_apply(flip(keys), grid_sizes, freqs, start_frame=args.current_start_frame)
+    delta_time = median_time(lambda: causal_rope_shift(flip(roped), freqs, frame_seqlen, shift, shift_step))
+    previous_time = median_time(
+        lambda: causal_rope_apply(flip(keys), grid_sizes, freqs, start_frame=args.current_start_frame))
+
+difference = (delta.float() - previous.float()).abs()
+print(f"re-insertion of 3 frames x {frame_seqlen} tokens, 12 heads x 128, bfloat16 on {device}"
+      f"{', reversed' if args.reverse else ''}")
+print(f"rope at the new positions (previous)  {previous_time * 1e3:8.2f} ms")
+print(f"delta rotation (current)              {delta_time * 1e3:8.2f} ms ({previous_time / delta_time:.1f}x)")
+print(f"difference: max {difference.max().item():.2e}, mean {difference.mean().item():.2e} "
+      f"(mean magnitude {previous.float().abs().mean().item():.2f})")
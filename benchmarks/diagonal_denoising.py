@@ -0,0 +1,62 @@
+import argparse
+
+import torch
+
+from benchmarks.common import time_generator_calls, timed
+from utils.misc import cpu_fallbacks
+from utils.noise import SeekableNoise
+from utils.tiny_models import LATENT_HEIGHT, LATENT_WIDTH, make_pipeline
+
+# Throughput, per-forward latency and latent change of diagonal denoising (`diagonal_denoising_lag`) against
+# denoising one block at a time on the tiny pipeline, for a few lags. The blocks in flight share the forwards of
+# the generator, the gain comes from running fewer, larger forwards and is larger on a GPU than on a CPU.
+# Run from the repository root: python -m benchmarks.diagonal_denoising
+parser = argparse.ArgumentParser()
+parser.add_argument("--lags", type=int, nargs="+", default=[4, 3, 2, 1])
+parser.add_argument("--num_layers", type=int, default=2, help="Number of transformer blocks")
+parser.add_argument("--ffn_dim", type=int, default=8960, help="FFN width, 8960 is the one of Wan 1.3B")
+parser.add_argument("--num_frames", type=int, default=36, help="Number of latent frames per video")
+parser.add_argument("--batch_size", type=int, default=1)
+parser.add_argument("--local_attn_size", type=int, default=9, help="Attention window in frames")
+parser.add_argument("--sink_size", type=int, default=3, help="Sink frames of the attention window")
+parser.add_argument("--kv_cache_storage", type=str, default="full", choices=["full", "paged"])
+parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+args = parser.parse_args()
+
+torch.set_grad_enabled(False)
+device = torch.device(args.device)
+
+
+def run(lag):
+    """
+    Generate the video after a warmup run. Returns the latents, the latency of each generator forward and the
+    latency of the whole video in seconds.
+    """
+    pipeline = make_pipeline(
+        args.num_layers, ffn_dim=args.ffn_dim, local_attn_size=args.local_attn_size, sink_size=args.sink_size,
+        kv_cache_storage=args.kv_cache_storage, diagonal_denoising_lag=lag).to(device)
+    # addressed by frame and step, every lag draws the same noise
+    noise = SeekableNoise(0, list(range(args.batch_size)), [16, LATENT_HEIGHT, LATENT_WIDTH], device=device,
+                          dtype=torch.bfloat16)
+    step_times = time_generator_calls(pipeline, device)
+    for _ in range(2):
+        step_times.clear()
+        (_, latents), latency = timed(lambda: pipeline.inference(
+            noise, ["a prompt"] * args.batch_size, num_frames=args.num_frames, return_latents=True), device)
+    return latents.float().cpu(), list(step_times), latency
+
+
+with cpu_fallbacks():
+    reference_latents, reference_times, reference_latency = run(None)
+    results = [(lag, *run(lag)) for lag in args.lags]
+
+print(f"{args.num_layers} layers, ffn {args.ffn_dim}, {args.num_frames} frames, batch {args.batch_size}, "
+      f"window {args.local_attn_size} (sink {args.sink_size}), {args.kv_cache_storage} KV cache on {device}")
+print("lag  forwards  ms per forward  latency   frames/s  speedup  largest block latent change (relative RMS)")
+for lag, latents, step_times, latency in [(None, reference_latents, reference_times, reference_latency)] + results:
+    error = max(
+        ((latents[:, start:start + 3] - reference_latents[:, start:start + 3]).norm()
+         / reference_latents[:, start:start + 3].norm()).item()
+        for start in range(0, args.num_frames, 3))
+    print(f"{'off' if lag is None else lag:<3}  {len(step_times):8d}  {sum(step_times) / len(step_times) * 1e3:14.1f}"
+          f"  {latency:6.2f} s  {args.num_frames / latency:8.2f}  {reference_latency / latency:6.2f}x  {error:.4f}")
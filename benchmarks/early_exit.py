@@ -0,0 +1,51 @@
+import argparse
+
+import torch
+
+from benchmarks.common import time_generator_calls, timed
+from utils.misc import cpu_fallbacks
+from utils.tiny_models import make_noise, make_pipeline
+
+# Generator calls skipped, latency and latent error against the full denoising schedule of
+# `early_exit_threshold` on the tiny pipeline, for a few thresholds.
+# Random weights do not converge between denoising steps the way a trained model does: the thresholds at which
+# blocks exit here say nothing about the ones to use with a checkpoint, tune those on real videos.
+# Run from the repository root: python -m benchmarks.early_exit
+parser = argparse.ArgumentParser()
+parser.add_argument("--thresholds", type=float, nargs="+", default=[2.0, 1.5, 1.2, 1.0])
+parser.add_argument("--num_layers", type=int, default=2, help="Number of transformer blocks")
+parser.add_argument("--ffn_dim", type=int, default=8960, help="FFN width, 8960 is the one of Wan 1.3B")
+parser.add_argument("--num_frames", type=int, default=24, help="Number of latent frames per video")
+parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+args = parser.parse_args()
+
+torch.set_grad_enabled(False)
+device = torch.device(args.device)
+
+
+def run(threshold):
+    """
+    Generate the video with `threshold` after a warmup run. Returns the latents, the number of generator calls and
+    the latency in seconds.
+    """
+    pipeline = make_pipeline(args.num_layers, ffn_dim=args.ffn_dim, early_exit_threshold=threshold).to(device)
+    step_times = time_generator_calls(pipeline, device)
+    for _ in range(2):
+        step_times.clear()
+        # inference draws the noise of the denoising steps from the global RNG
+        torch.manual_seed(0)
+        (_, latents), latency = timed(lambda: pipeline.inference(
+            make_noise(1, args.num_frames).to(device), ["a prompt"], return_latents=True), device)
+    return latents.float().cpu(), len(step_times), latency
+
+
+with cpu_fallbacks():
+    full_latents, full_calls, full_latency = run(None)
+    results = [(threshold, *run(threshold)) for threshold in args.thresholds]
+
+print(f"{args.num_layers} layers, ffn {args.ffn_dim}, {args.num_frames} frames on {device}")
+print("threshold  generator calls  skipped  latency   latent error (relative RMS)")
+print(f"off        {full_calls:15d}  {0:7d}  {full_latency:6.2f} s  0")
+for threshold, latents, calls, latency in results:
+    error = ((latents - full_latents).norm() / full_latents.norm()).item()
+    print(f"{threshold:<9g}  {calls:15d}  {full_calls - calls:7d}  {latency:6.2f} s  {error:.3f}")
@@ -0,0 +1,63 @@
+import argparse
+
+import torch
+
+from benchmarks.common import kv_cache_bytes, time_calls, time_generator_calls
+from utils.misc import cpu_fallbacks
+from utils.tiny_models import make_pipeline
+
+# Latency and memory of the KV cache storages on the tiny pipeline at the frame size of Wan 1.3B at 480x832
+# (1560 tokens per latent frame). "single_copy" keeps one un-roped copy of the frames and ropes the whole window
+# in float32 before every attention, "full" and "paged" keep the keys roped next to a copy of the first window.
+# The self-attention time includes that re-rope, the difference is its cost.
+# Run from the repository root: python -m benchmarks.kv_cache_storage
+parser = argparse.ArgumentParser()
+parser.add_argument("--storages", type=str, nargs="+", default=["full", "single_copy", "paged"])
+parser.add_argument("--num_layers", type=int, default=1, help="Number of transformer blocks")
+parser.add_argument("--ffn_dim", type=int, default=8960, help="FFN width, 8960 is the one of Wan 1.3B")
+parser.add_argument("--num_frames", type=int, default=15, help="Number of latent frames per video")
+parser.add_argument("--local_attn_size", type=int, default=9, help="Attention window in frames")
+parser.add_argument("--sink_size", type=int, default=3, help="Sink frames of the attention window")
+parser.add_argument("--latent_height", type=int, default=60, help="60 x 104 latents decode to 480 x 832")
+parser.add_argument("--latent_width", type=int, default=104)
+parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+args = parser.parse_args()
+
+torch.set_grad_enabled(False)
+device = torch.device(args.device)
+
+
+def run(kv_cache_storage):
+    """
+    Generate the video after a warmup run. Returns the latents, the self-attention time per generator call and
+    the time of all the generator calls in seconds (the VAE decode left out), and the size of the KV cache in bytes.
+    """
+    pipeline = make_pipeline(args.num_layers, ffn_dim=args.ffn_dim, local_attn_size=args.local_attn_size,
+                             sink_size=args.sink_size, frame_seq_length=args.latent_height * args.latent_width // 4,
+                             kv_cache_storage=kv_cache_storage).to(device)
+    noise = torch.randn(1, args.num_frames, 16, args.latent_height, args.latent_width,
+                        generator=torch.Generator().manual_seed(1)).to(device, torch.bfloat16)
+    attention_times = time_calls([block.self_attn for block in pipeline.generator.model.blocks], device)
+    step_times = time_generator_calls(pipeline, device)
+    for _ in range(2):
+        attention_times.clear()
+        step_times.clear()
+        # inference draws the noise of the denoising steps from the global RNG
+        torch.manual_seed(0)
+        _, latents = pipeline.inference(noise, ["a prompt"], return_latents=True)
+    return (latents.float().cpu(), sum(attention_times) / len(step_times), sum(step_times),
+            kv_cache_bytes(pipeline))
+
+
+with cpu_fallbacks():
+    results = {storage: run(storage) for storage in args.storages}
+
+reference_latents = results[args.storages[0]][0]
+print(f"{args.num_layers} layers, ffn {args.ffn_dim}, {args.num_frames} frames of "
+      f"{args.latent_height * args.latent_width // 4} tokens, window {args.local_attn_size} "
+      f"(sink {args.sink_size}) on {device}")
+print(f"storage      self-attention per step  generator  KV cache  latents vs {args.storages[0]} (relative RMS)")
+for storage, (latents, attention_time, generator_time, num_bytes) in results.items():
+    error = ((latents - reference_latents).norm() / reference_latents.norm()).item()
+    print(f"{storage:<11}  {attention_time * 1e3:20.1f} ms  {generator_time:7.2f} s  {num_bytes / 2**20:6.1f} MiB  "
+          f"{error:.4f}")
@@ -0,0 +1,74 @@
+import argparse
+import statistics
+
+import torch
+
+from benchmarks.common import synchronize, timed
+from utils.kv_cache import KVCachePagePool, KVCachePageTable
+from utils.misc import cpu_fallbacks
+from utils.tiny_models import make_noise, make_pipeline
+
+# Cost of reading the attention window of a paged KV cache: the read of one layer, in place for the consecutive
+# pages of one allocation and gathered for a fragmented page table, at the sizes of Wan 1.3B; then the latency
+# of the tiny pipeline with full and paged storage.
+# Run from the repository root: python -m benchmarks.paged_kv_cache
+parser = argparse.ArgumentParser()
+parser.add_argument("--window_frames", type=int, default=21, help="Frames of the attention window")
+parser.add_argument("--frame_seq_length", type=int, default=1560, help="Tokens per latent frame, 1560 at 480x832")
+parser.add_argument("--batch_size", type=int, default=1)
+parser.add_argument("--repeats", type=int, default=20)
+parser.add_argument("--num_layers", type=int, default=2, help="Number of transformer blocks of the pipeline")
+parser.add_argument("--ffn_dim", type=int, default=8960, help="FFN width, 8960 is the one of Wan 1.3B")
+parser.add_argument("--num_frames", type=int, default=24, help="Number of latent frames per video")
+parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+args = parser.parse_args()
+
+torch.set_grad_enabled(False)
+device = torch.device(args.device)
+
+
+def read_time(pages):
+    """
+    Median time in seconds of reading the window of one layer through the page table `pages`.
+    """
+    # imported once the CPU fallbacks are in place
+    from wan.modules.causal_model import kv_cache_load
+
+    num_pages = 2 * args.batch_size * args.window_frames
+    pool = KVCachePagePool([{"k": torch.randn(
+        num_pages, args.frame_seq_length, 12, 128, dtype=torch.bfloat16, device=device)}])
+    kv_cache = {"k": pool.layers[0]["k"], "page_tables": {"k": KVCachePageTable(pool, pages, device)}}
+    times = []
+    for _ in range(args.repeats + 1):
+        # the attention reads the window, a gather copies it first
+        _, seconds = timed(
+            lambda: kv_cache_load(kv_cache, "k", 0, args.window_frames * args.frame_seq_length, torch.bfloat16)
+            .sum(), device)
+        times.append(seconds)
+    return statistics.median(times[1:])
+
+
+def generation_time(kv_cache_storage):
+    pipeline = make_pipeline(args.num_layers, ffn_dim=args.ffn_dim, local_attn_size=9, sink_size=3,
+                             kv_cache_storage=kv_cache_storage).to(device)
+    for _ in range(2):
+        torch.manual_seed(0)
+        _, latency = timed(lambda: pipeline.inference(make_noise(1, args.num_frames).to(device), ["a prompt"]),
+                           device)
+    return latency
+
+
+window = range(args.window_frames)
+# the pages of one allocation, and the same pages interleaved with the ones of another stream
+consecutive = [[b * args.window_frames + i for i in window] for b in range(args.batch_size)]
+fragmented = [[2 * (b * args.window_frames + i) for i in window] for b in range(args.batch_size)]
+with cpu_fallbacks():
+    synchronize(device)
+    in_place, gathered = read_time(consecutive), read_time(fragmented)
+    full_latency, paged_latency = generation_time("full"), generation_time("paged")
+
+print(f"window of {args.window_frames} frames x {args.frame_seq_length} tokens, batch {args.batch_size} on {device}")
+print(f"read one layer in place   {in_place * 1e3:8.2f} ms")
+print(f"read one layer gathered   {gathered * 1e3:8.2f} ms ({gathered / in_place:.1f}x)")
+print(f"tiny pipeline ({args.num_layers} layers, {args.num_frames} frames)  full {full_latency:.2f} s  "
+      f"paged {paged_latency:.2f} s")
@@ -0,0 +1,76 @@
+import argparse
+
+import torch
+
+from benchmarks.common import kv_cache_bytes, time_calls, time_generator_calls
+from utils.misc import cpu_fallbacks
+from utils.tiny_models import make_pipeline
+
+# Accuracy, latency and memory of the int8/fp8 KV cache (`kv_cache_dtype`) against a bfloat16 one on the tiny
+# pipeline at the frame size of Wan 1.3B at 480x832 (1560 tokens per latent frame). The self-attention time
+# includes the quantization of the new keys/values and the dequantization of the window before every attention.
+# Run from the repository root: python -m benchmarks.quantized_kv_cache
+parser = argparse.ArgumentParser()
+parser.add_argument("--kv_cache_dtypes", type=str, nargs="+", default=["int8", "fp8"])
+parser.add_argument("--kv_cache_storage", type=str, default="full", choices=["full", "single_copy", "paged"])
+parser.add_argument("--num_layers", type=int, default=1, help="Number of transformer blocks")
+parser.add_argument("--ffn_dim", type=int, default=8960, help="FFN width, 8960 is the one of Wan 1.3B")
+parser.add_argument("--num_frames", type=int, default=15, help="Number of latent frames per video")
+parser.add_argument("--local_attn_size", type=int, default=9, help="Attention window in frames")
+parser.add_argument("--sink_size", type=int, default=3, help="Sink frames of the attention window")
+parser.add_argument("--latent_height", type=int, default=60, help="60 x 104 latents decode to 480 x 832")
+parser.add_argument("--latent_width", type=int, default=104)
+parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+args = parser.parse_args()
+
+torch.set_grad_enabled(False)
+device = torch.device(args.device)
+
+
+def run(kv_cache_dtype):
+    """
+    Generate the video after a warmup run. Returns the self-attention outputs and the latents, the
+    self-attention time per generator call and the time of all the generator calls in seconds, and the size of
+    the KV cache in bytes.
+    """
+    pipeline = make_pipeline(args.num_layers, ffn_dim=args.ffn_dim, local_attn_size=args.local_attn_size,
+                             sink_size=args.sink_size, frame_seq_length=args.latent_height * args.latent_width // 4,
+                             kv_cache_storage=args.kv_cache_storage, kv_cache_dtype=kv_cache_dtype).to(device)
+    noise = torch.randn(1, args.num_frames, 16, args.latent_height, args.latent_width,
+                        generator=torch.Generator().manual_seed(1)).to(device, torch.bfloat16)
+    self_attentions = [block.self_attn for block in pipeline.generator.model.blocks]
+    attention_times = time_calls(self_attentions, device)
+    step_times = time_generator_calls(pipeline, device)
+    outputs = []
+    for self_attention in self_attentions:
+        self_attention.register_forward_hook(lambda module, inputs, output: outputs.append(output.float().cpu()))
+    for _ in range(2):
+        attention_times.clear()
+        step_times.clear()
+        outputs.clear()
+        # inference draws the noise of the denoising steps from the global RNG
+        torch.manual_seed(0)
+        _, latents = pipeline.inference(noise, ["a prompt"], return_latents=True)
+    return (outputs, latents.float().cpu(), sum(attention_times) / len(step_times), sum(step_times),
+            kv_cache_bytes(pipeline))
+
+
+def relative_difference(value, reference):
+    return ((value - reference).norm() / reference.norm()).item()
+
+
+with cpu_fallbacks():
+    results = {kv_cache_dtype: run(kv_cache_dtype) for kv_cache_dtype in [None, *args.kv_cache_dtypes]}
+
+reference_outputs, reference_latents = results[None][:2]
+print(f"{args.num_layers} layers, ffn {args.ffn_dim}, {args.num_frames} frames of "
+      f"{args.latent_height * args.latent_width // 4} tokens, window {args.local_attn_size} "
+      f"(sink {args.sink_size}), {args.kv_cache_storage} KV cache on {device}")
+print("KV cache  self-attention per step  generator  KV cache     largest attention error  latent error "
+      "(relative RMS)")
+for kv_cache_dtype, (outputs, latents, attention_time, generator_time, num_bytes) in results.items():
+    attention_error = max(
+        relative_difference(output, reference) for output, reference in zip(outputs, reference_outputs))
+    latent_error = relative_difference(latents, reference_latents)
+    print(f"{kv_cache_dtype or 'bf16':<8}  {attention_time * 1e3:20.1f} ms  {generator_time:7.2f} s  "
+          f"{num_bytes / 2**20:7.1f} MiB  {attention_error:23.4f}  {latent_error:.4f}")
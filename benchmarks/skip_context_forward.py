@@ -0,0 +1,65 @@
+import argparse
+
+import torch
+
+from benchmarks.common import time_generator_calls, timed
+from utils.misc import cpu_fallbacks
+from utils.tiny_models import make_noise, make_pipeline
+
+# Generator calls, latency and latent drift of `skip_context_forward` against the clean context forward on the
+# tiny pipeline, for the configured denoising schedule. Skipping commits the keys/values of the last denoising
+# step, the drift grows with the timestep of that step: the schedule of self_forcing_dmd.yaml ends at 625 after
+# warping, one ending at the smallest timestep of the scheduler (--last_step 1) shows the bfloat16 rounding only.
+# Run from the repository root: python -m benchmarks.skip_context_forward
+parser = argparse.ArgumentParser()
+parser.add_argument("--last_step", type=int, default=None,
+                    help="Replace the last denoising step of the schedule, e.g. 1 for the smallest timestep")
+parser.add_argument("--num_layers", type=int, default=2, help="Number of transformer blocks")
+parser.add_argument("--ffn_dim", type=int, default=8960, help="FFN width, 8960 is the one of Wan 1.3B")
+parser.add_argument("--num_frames", type=int, default=24, help="Number of latent frames per video")
+parser.add_argument("--local_attn_size", type=int, default=9, help="Attention window in frames")
+parser.add_argument("--sink_size", type=int, default=3, help="Sink frames of the attention window")
+parser.add_argument("--kv_cache_storage", type=str, default="full", choices=["full", "single_copy", "paged"])
+parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+args = parser.parse_args()
+
+torch.set_grad_enabled(False)
+device = torch.device(args.device)
+
+
+def run(skip_context_forward):
+    """
+    Generate the video after a warmup run. Returns the latents, the number of generator calls and the latency in
+    seconds.
+    """
+    config = dict(kv_cache_storage=args.kv_cache_storage, skip_context_forward=skip_context_forward)
+    if args.last_step is not None:
+        config["denoising_step_list"] = [1000, 750, 500, args.last_step]
+    pipeline = make_pipeline(args.num_layers, ffn_dim=args.ffn_dim, local_attn_size=args.local_attn_size,
+                             sink_size=args.sink_size, **config).to(device)
+    step_times = time_generator_calls(pipeline, device)
+    for _ in range(2):
+        step_times.clear()
+        # inference draws the noise of the denoising steps from the global RNG
+        torch.manual_seed(0)
+        (_, latents), latency = timed(lambda: pipeline.inference(
+            make_noise(1, args.num_frames).to(device), ["a prompt"], return_latents=True), device)
+    return latents.float().cpu(), len(step_times), latency, pipeline.denoising_step_list
+
+
+with cpu_fallbacks():
+    context_latents, context_calls, context_latency, steps = run(False)
+    skip_latents, skip_calls, skip_latency, _ = run(True)
+
+print(f"{args.num_layers} layers, ffn {args.ffn_dim}, {args.num_frames} frames, window {args.local_attn_size} "
+      f"(sink {args.sink_size}), {args.kv_cache_storage} KV cache on {device}")
+print(f"denoising steps {[round(step, 2) for step in steps.tolist()]}")
+print("                  generator calls  latency")
+print(f"context forward   {context_calls:15d}  {context_latency:6.2f} s")
+print(f"skipped           {skip_calls:15d}  {skip_latency:6.2f} s  ({context_latency / skip_latency:.2f}x)")
+# the error of the committed keys/values carries over to the next blocks through the KV cache
+print("block  latent drift (relative RMS)")
+for block, start in enumerate(range(0, args.num_frames, 3)):
+    reference = context_latents[:, start:start + 3]
+    error = ((skip_latents[:, start:start + 3] - reference).norm() / reference.norm()).item()
+    print(f"{block:5d}  {error:.4f}")
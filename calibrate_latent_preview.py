@@ -0,0 +1,62 @@
+import argparse
+import torch
+from omegaconf import OmegaConf
+from tqdm import tqdm
+
+from pipeline import CausalInferencePipeline
+from utils.dataset import TextDataset
+from utils.misc import set_seed
+from utils.noise import SeekableNoise
+from utils.preview import LatentPreviewer
+
+from utils.memory import gpu
+
+# Fit the latent to RGB projection of the previews (`latent_preview_path`) on videos generated with the VAE decoder
+parser = argparse.ArgumentParser()
+parser.add_argument("--config_path", type=str, help="Path to the config file")
+parser.add_argument("--checkpoint_path", type=str, help="Path to the checkpoint folder")
+parser.add_argument("--data_path", type=str, help="Path to the prompts to calibrate on")
+parser.add_argument("--output_path", type=str, default="checkpoints/latent_preview.pt",
+                    help="Where to save the fitted projection")
+parser.add_argument("--num_prompts", type=int, default=16, help="Number of prompts to calibrate on")
+parser.add_argument("--num_output_frames", type=int, default=21, help="Number of latent frames per video")
+parser.add_argument("--use_ema", action="store_true", help="Whether to use EMA parameters")
+parser.add_argument("--seed", type=int, default=0, help="Random seed")
+args = parser.parse_args()
+
+device = torch.device("cuda")
+set_seed(args.seed)
+torch.set_grad_enabled(False)
+
+config = OmegaConf.load(args.config_path)
+default_config = OmegaConf.load("configs/default_config.yaml")
+config = OmegaConf.merge(default_config, config)
+# the previewer is what is being fitted
+config.latent_preview_path = None
+
+pipeline = CausalInferencePipeline(config, device=device)
+if args.checkpoint_path:
+    state_dict = torch.load(args.checkpoint_path, map_location="cpu")
+    pipeline.generator.load_state_dict(state_dict['generator' if not args.use_ema else 'generator_ema'])
+pipeline = pipeline.to(dtype=torch.bfloat16)
+pipeline.text_encoder.to(device=gpu)
+pipeline.generator.to(device=gpu)
+pipeline.vae.to(device=gpu)
+
+dataset = TextDataset(prompt_path=args.data_path)
+num_frames = args.num_output_frames // config['num_frame_per_block'] * config['num_frame_per_block']
+latents, targets = [], []
+for i in tqdm(range(min(args.num_prompts, len(dataset)))):
+    noise = SeekableNoise(args.seed, [i], [16, 60, 104], device=device, dtype=torch.bfloat16)
+    video, latent = pipeline.inference(
+        noise=noise, text_prompts=[dataset[i]['prompts']], return_latents=True, num_frames=num_frames)
+    # only the colors averaged over every latent pixel are kept, not the videos
+    targets.append(LatentPreviewer.targets(latent, video).cpu())
+    latents.append(latent.float().cpu())
+latents, targets = torch.cat(latents), torch.cat(targets)
+
+previewer = LatentPreviewer.fit(latents, targets)
+error = (previewer(latents) - targets).pow(2).mean().sqrt().item()
+print(f"[MAIN] Preview RMSE on the calibration videos: {error:.4f} (colors in [0, 1])")
+previewer.save(args.output_path)
+print(f"[MAIN] Saved the latent previewer to {args.output_path}, set latent_preview_path to use it")
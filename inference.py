@@ -1,10 +1,12 @@
 import argparse
 import torch
 import os
+import shutil
 from omegaconf import OmegaConf
 from tqdm import tqdm
 from torchvision import transforms
 from torchvision.io import write_video
+from torchvision.utils import save_image
 from einops import rearrange
 import torch.distributed as dist
 from torch.utils.data import DataLoader, SequentialSampler
@@ -16,6 +18,8 @@ from pipeline import (
 )
 from utils.dataset import TextDataset, TextImagePairDataset
 from utils.misc import set_seed
+from utils.noise import SeekableNoise
+from utils.video import VideoWriter
 
 from utils.memory import gpu, get_cuda_free_memory_gb, DynamicSwapInstaller
 import time
@@ -32,9 +36,25 @@ parser.add_argument("--i2v", action="store_true", help="Whether to perform I2V (
 parser.add_argument("--use_ema", action="store_true", help="Whether to use EMA parameters")
 parser.add_argument("--seed", type=int, default=0, help="Random seed")
 parser.add_argument("--num_samples", type=int, default=1, help="Number of samples to generate per prompt")
+parser.add_argument("--batch_size", type=int, default=1,
+                    help="Number of prompts generated together, every denoising step runs on all their samples at once")
 parser.add_argument("--save_with_index", action="store_true",
                     help="Whether to save the video using the index or prompt as the filename")
+parser.add_argument("--fresh_noise", action="store_true",
+                    help="T2V: draw new noise for every block instead of repeating the noise of the first block")
+parser.add_argument("--endless", action="store_true",
+                    help="Generate in constant memory: draw the noise per block and write every block to the video "
+                         "as soon as it is decoded. With --num_output_frames 0, generate until interrupted")
+parser.add_argument("--checkpoint_every", type=int, default=0,
+                    help="Save the generation state every N denoised blocks to <output_folder>/checkpoints (0: never)")
+parser.add_argument("--resume", action="store_true",
+                    help="Skip the videos already written and continue the others from their last checkpoint")
+parser.add_argument("--preview", action="store_true",
+                    help="After every block, write a preview of its last frame next to every video (<video>.preview.png) "
+                         "with the latent previewer of the config (latent_preview_path), without running the VAE")
 args = parser.parse_args()
+assert not (args.endless and args.checkpoint_every), "--checkpoint_every is not supported with --endless"
+assert not (args.endless and args.preview), "--endless writes the decoded frames as they are generated, not previews"
 
 print(f'[MAIN] Target video length:\n\t{args.num_output_frames} latent frames;\n\t{args.num_output_frames*4 - 3} frames;\n\t{int((args.num_output_frames*4 - 3)/16.0)} seconds (FPS=16)\n')
 print(f'[MAIN] Seed: {args.seed}')
@@ -101,7 +121,7 @@ if dist.is_initialized():
     sampler = DistributedSampler(dataset, shuffle=False, drop_last=True)
 else:
     sampler = SequentialSampler(dataset)
-dataloader = DataLoader(dataset, batch_size=1, sampler=sampler, num_workers=0, drop_last=False)
+dataloader = DataLoader(dataset, batch_size=args.batch_size, sampler=sampler, num_workers=0, drop_last=False)
 
 # Create output directory (only on main process to avoid race conditions)
 if local_rank == 0:
@@ -111,65 +131,116 @@ if dist.is_initialized():
     dist.barrier()
 
 
-def encode(self, videos: torch.Tensor) -> torch.Tensor:
-    device, dtype = videos[0].device, videos[0].dtype
-    scale = [self.mean.to(device=device, dtype=dtype),
-             1.0 / self.std.to(device=device, dtype=dtype)]
-    output = [
-        self.model.encode(u.unsqueeze(0), scale).float().squeeze(0)
-        for u in videos
-    ]
-
-    output = torch.stack(output, dim=0)
-    return output
-
-
 for i, batch_data in tqdm(enumerate(dataloader), disable=(local_rank != 0)):
-    idx = batch_data['idx'].item()
-
-    # For DataLoader batch_size=1, the batch_data is already a single item, but in a batch container
+    # For DataLoader batches, the batch_data is a dict of lists (or tensors), one entry per prompt
     # Unpack the batch data for convenience
     if isinstance(batch_data, dict):
         batch = batch_data
     elif isinstance(batch_data, list):
         batch = batch_data[0]  # First (and only) item in the batch
+    idxs = batch['idx'].tolist()
+    # the samples of every prompt are consecutive in the batch: sample i is prompt i // num_samples
+    batch_size = len(idxs) * args.num_samples
+
+    prompt_list = batch['prompts']
+    model = "regular" if not args.use_ema else "ema"
+
+    def get_output_path(sample_idx):
+        prompt_idx, seed_idx = divmod(sample_idx, args.num_samples)
+        if args.save_with_index:
+            return os.path.join(args.output_folder, f'{idxs[prompt_idx]}-{args.seed}-{seed_idx}_{model}.mp4')
+        return os.path.join(args.output_folder, f'{prompt_list[prompt_idx][:100]}-{args.seed}-{seed_idx}.mp4')
+
+    # The generation state of the batch is saved every --checkpoint_every blocks, --resume continues from it.
+    # It is removed once the videos are written, a batch with a checkpoint left did not finish writing them
+    generation_checkpoint = None
+    if args.checkpoint_every:
+        generation_checkpoint = os.path.join(
+            args.output_folder, "checkpoints", f"{'_'.join(map(str, idxs))}-{args.seed}_{model}")
+    if args.resume and not (generation_checkpoint and os.path.exists(generation_checkpoint)) and all(
+            os.path.exists(get_output_path(sample_idx)) for sample_idx in range(batch_size)
+            if idxs[sample_idx // args.num_samples] < num_prompts):
+        continue
 
     all_video = []
     num_generated_frames = 0  # Number of generated (latent) frames
 
+    # The noise is drawn block by block and addressed by the global index of the sample, a video is the same
+    # whatever the batch or the process it is generated in
+    samples = [idx * args.num_samples + seed_idx for idx in idxs for seed_idx in range(args.num_samples)]
+
     if args.i2v:
         # For image-to-video, batch contains image and caption
-        prompt = batch['prompts'][0]  # Get caption from batch
-        prompts = [prompt] * args.num_samples
+        prompts = [prompt for prompt in prompt_list for _ in range(args.num_samples)]
 
-        # Process the image
-        image = batch['image'].squeeze(0).unsqueeze(0).unsqueeze(2).to(device=device, dtype=torch.bfloat16)
+        # Process the images
+        image = batch['image'].unsqueeze(2).to(device=device, dtype=torch.bfloat16)
 
-        # Encode the input image as the first latent
+        # Encode the input images as the first latent
         initial_latent = pipeline.vae.encode_to_latent(image).to(device=device, dtype=torch.bfloat16)
-        initial_latent = initial_latent.repeat(args.num_samples, 1, 1, 1, 1)
+        initial_latent = initial_latent.repeat_interleave(args.num_samples, dim=0)
 
-        sampled_noise = torch.randn(
-            [args.num_samples, args.num_output_frames - 1, 16, 60, 104], device=device, dtype=torch.bfloat16
-        )
+        sampled_noise = SeekableNoise(args.seed, samples, [16, 60, 104], device=device, dtype=torch.bfloat16)
+        num_frames = args.num_output_frames - 1
     else:
-        # For text-to-video, batch is just the text prompt
-        prompt = batch['prompts'][0]
-        extended_prompt = batch['extended_prompts'][0] if 'extended_prompts' in batch else None
-        if extended_prompt is not None:
-            prompts = [extended_prompt] * args.num_samples
+        # For text-to-video, batch is just the text prompts
+        extended_prompts = batch['extended_prompts'] if 'extended_prompts' in batch else None
+        if extended_prompts is not None:
+            prompts = [prompt for prompt in extended_prompts for _ in range(args.num_samples)]
         else:
-            prompts = [prompt] * args.num_samples
+            prompts = [prompt for prompt in prompt_list for _ in range(args.num_samples)]
         initial_latent = None
 
-        sampled_noise = torch.randn(
-            [args.num_samples, config['num_frame_per_block'], 16, 60, 104], device=device, dtype=torch.bfloat16
-        )
-        # repeat noise to cover all output frames
+        # the noise of the first block is repeated over all output frames, unless --fresh_noise
+        sampled_noise = SeekableNoise(args.seed, samples, [16, 60, 104], device=device, dtype=torch.bfloat16,
+                                      period=None if args.fresh_noise else config['num_frame_per_block'])
         num_repeats = args.num_output_frames // config['num_frame_per_block']
-        sampled_noise = sampled_noise.repeat(1, num_repeats, 1, 1, 1)
-        print("\n[MAIN]: Latent video shape:", sampled_noise.shape)
+        num_frames = num_repeats * config['num_frame_per_block']
+        print("\n[MAIN]: Latent video shape:", [batch_size, num_frames, 16, 60, 104])
+
+    if args.endless:
+        # nothing grows with the video length: the frames of every block go straight to the video files
+        writers = [VideoWriter(get_output_path(sample_idx), fps=16) for sample_idx in range(batch_size)]
+        start_time = time.time()
+        try:
+            for video in pipeline.stream(
+                noise=sampled_noise,
+                text_prompts=prompts,
+                initial_latent=initial_latent,
+                low_memory=low_memory,
+                num_frames=num_frames if args.num_output_frames else None,
+            ):
+                video = 255.0 * rearrange(video, 'b t c h w -> b t h w c')
+                for writer, sample_video in zip(writers, video):
+                    writer.write(sample_video)
+        finally:
+            # also finalizes the videos when the generation is interrupted
+            for writer in writers:
+                writer.close()
+        time_cost = time.time() - start_time
+        print(f"[MAIN] Time cost for inference: {time_cost:.2f}s")
+        print(f"[MAIN] Number of frames in video: {writers[0].num_frames}")
+        print(f"[MAIN] FPS: {writers[0].num_frames / time_cost:.2f}")
+        continue
+
+
+    state = None
+    if args.resume and generation_checkpoint and os.path.exists(os.path.join(generation_checkpoint, "state.pt")):
+        state = pipeline.load_checkpoint(generation_checkpoint)
+        # the initial latent frames are in the checkpoint, only the noise of the frames left is needed
+        num_checkpoint_frames = state["current_start_frame"] - (
+            initial_latent.shape[1] if initial_latent is not None else 0)
+        sampled_noise = sampled_noise.seek(num_checkpoint_frames)
+        num_frames -= num_checkpoint_frames
+        initial_latent = None
+        print(f"[MAIN] Resuming from {generation_checkpoint} at latent frame {state['current_start_frame']}")
 
+    def write_preview(start_frame, preview):
+        # the last frame of the block, upsampled to the video resolution
+        frames = torch.nn.functional.interpolate(preview[:, -1].float(), scale_factor=8, mode="bilinear")
+        for sample_idx, frame in enumerate(frames):
+            if idxs[sample_idx // args.num_samples] < num_prompts:
+                save_image(frame, os.path.splitext(get_output_path(sample_idx))[0] + ".preview.png")
 
     # Generate frames
     start_time = time.time()
@@ -179,7 +250,14 @@ for i, batch_data in tqdm(enumerate(dataloader), disable=(local_rank != 0)):
         return_latents=True,
         initial_latent=initial_latent,
         low_memory=low_memory,
+        state=state,
+        num_frames=num_frames,
+        checkpoint_path=generation_checkpoint,
+        checkpoint_every=args.checkpoint_every,
+        preview_callback=write_preview if args.preview else None,
     )
+    if state is not None:
+        pipeline.release(state)
     end_time = time.time()
     time_cost = end_time - start_time
     print(f"[MAIN] Time cost for inference: {time_cost:.2f}s")
@@ -197,13 +275,17 @@ for i, batch_data in tqdm(enumerate(dataloader), disable=(local_rank != 0)):
     # Clear VAE cache
     pipeline.vae.model.clear_cache()
 
-    # Save the video if the current prompt is not a dummy prompt
-    if idx < num_prompts:
-        model = "regular" if not args.use_ema else "ema"
-        for seed_idx in range(args.num_samples):
+    for sample_idx in range(batch_size):
+        # Save the video if the current prompt is not a dummy prompt
+        if idxs[sample_idx // args.num_samples] < num_prompts:
             # All processes save their videos
-            if args.save_with_index:
-                output_path = os.path.join(args.output_folder, f'{idx}-{args.seed}-{seed_idx}_{model}.mp4')
-            else:
-                output_path = os.path.join(args.output_folder, f'{prompt[:100]}-{args.seed}-{seed_idx}.mp4')
-            write_video(output_path, video[seed_idx], fps=16)
+            write_video(get_output_path(sample_idx), video[sample_idx], fps=16)
+            if args.preview:
+                # the video replaces its preview
+                preview_path = os.path.splitext(get_output_path(sample_idx))[0] + ".preview.png"
+                if os.path.exists(preview_path):
+                    os.remove(preview_path)
+
+    # the videos are written, the checkpoint is not needed anymore
+    if generation_checkpoint is not None:
+        shutil.rmtree(generation_checkpoint, ignore_errors=True)
@@ -114,14 +114,14 @@ class CausalDiffusionInferencePipeline(torch.nn.Module):
                 self.crossattn_cache_neg[block_index]["is_init"] = False
             # reset kv cache
             for block_index in range(len(self.kv_cache_pos)):
-                self.kv_cache_pos[block_index]["global_end_index"] = torch.tensor(
-                    [0], dtype=torch.long, device=noise.device)
-                self.kv_cache_pos[block_index]["local_end_index"] = torch.tensor(
-                    [0], dtype=torch.long, device=noise.device)
-                self.kv_cache_neg[block_index]["global_end_index"] = torch.tensor(
-                    [0], dtype=torch.long, device=noise.device)
-                self.kv_cache_neg[block_index]["local_end_index"] = torch.tensor(
-                    [0], dtype=torch.long, device=noise.device)
+                self.kv_cache_pos[block_index]["global_end_index"] = 0
+                self.kv_cache_pos[block_index]["local_end_index"] = 0
+                self.kv_cache_pos[block_index]["ring_start_index"] = 0
+                self.kv_cache_pos[block_index]["rope_offset"] = 0
+                self.kv_cache_neg[block_index]["global_end_index"] = 0
+                self.kv_cache_neg[block_index]["local_end_index"] = 0
+                self.kv_cache_neg[block_index]["ring_start_index"] = 0
+                self.kv_cache_neg[block_index]["rope_offset"] = 0
 
         # Step 2: Cache context feature
         current_start_frame = start_frame_index
@@ -284,14 +284,18 @@ class CausalDiffusionInferencePipeline(torch.nn.Module):
             kv_cache_pos.append({
                 "k": torch.zeros([batch_size, kv_cache_size, 12, 128], dtype=dtype, device=device),
                 "v": torch.zeros([batch_size, kv_cache_size, 12, 128], dtype=dtype, device=device),
-                "global_end_index": torch.tensor([0], dtype=torch.long, device=device),
-                "local_end_index": torch.tensor([0], dtype=torch.long, device=device)
+                "global_end_index": 0,
+                "local_end_index": 0,
+                "ring_start_index": 0,
+                "rope_offset": 0
             })
             kv_cache_neg.append({
                 "k": torch.zeros([batch_size, kv_cache_size, 12, 128], dtype=dtype, device=device),
                 "v": torch.zeros([batch_size, kv_cache_size, 12, 128], dtype=dtype, device=device),
-                "global_end_index": torch.tensor([0], dtype=torch.long, device=device),
-                "local_end_index": torch.tensor([0], dtype=torch.long, device=device)
+                "global_end_index": 0,
+                "local_end_index": 0,
+                "ring_start_index": 0,
+                "rope_offset": 0
             })
 
         self.kv_cache_pos = kv_cache_pos  # always store the clean cache
@@ -1,7 +1,18 @@
-from typing import List, Optional
+from typing import Callable, List, Optional, Union
+import copy
+import itertools
+import math
+import os
+import queue
+import threading
 import torch
 
+from utils.kv_cache import KVCachePagePool, KVCachePageTable
+from utils.noise import SeekableNoise
+from utils.preview import LatentPreviewer
+from utils.scheduler import FewStepSampler
 from utils.wan_wrapper import WanDiffusionWrapper, WanTextEncoder, WanVAEWrapper
+from wan.modules.causal_model import kv_cache_get, kv_cache_num_tokens, kv_cache_set
 
 from utils.memory import gpu, get_cuda_free_memory_gb, DynamicSwapInstaller, move_model_to_device_with_memory_preservation
 
@@ -30,12 +41,46 @@ class CausalInferencePipeline(torch.nn.Module):
             timesteps = torch.cat((self.scheduler.timesteps.cpu(), torch.tensor([0], dtype=torch.float32)))
             self.denoising_step_list = timesteps[1000 - self.denoising_step_list]
 
+        # the sigmas of the denoising steps and of the clean context pass, resolved once
+        self.sampler = FewStepSampler(
+            self.scheduler, [*self.denoising_step_list.tolist(), getattr(args, "context_noise", 0), 0])
+
         self.num_transformer_blocks = 30
         self.frame_seq_length = 1560
 
         self.kv_cache1 = None
+        # set while a call generates with the shared KV cache (full and single_copy storage)
+        self.kv_cache_in_use = False
         self.args = args
         self.num_frame_per_block = getattr(args, "num_frame_per_block", 1)
+        # "full": rolling k/v plus the k_original/v_original copies of the first window
+        # "single_copy": one pool of un-roped k/v frames, keys are roped when the window is read
+        # "paged": "full" storage in frame-sized pages of a pool shared by concurrent inference calls
+        self.kv_cache_storage = getattr(args, "kv_cache_storage", "full")
+        assert self.kv_cache_storage in ("full", "single_copy", "paged")
+        # size of the paged pool, None fits one stream of batch size 1
+        self.kv_cache_num_pages = getattr(args, "kv_cache_num_pages", None)
+        # seconds a call waits for the other calls to release enough pages before it fails, None waits for ever
+        self.kv_cache_page_timeout = getattr(args, "kv_cache_page_timeout", None)
+        self.kv_cache_pool = None
+        self.kv_cache_pool_lock = threading.Lock()
+        # the VAE keeps its causal conv cache on the module, decode one video at a time
+        self.vae_lock = threading.Lock()
+        # decode the frames in overlapping tiles of this many latent pixels per side to bound the memory of
+        # the VAE at high resolutions, None decodes whole frames
+        self.vae_tile_size = getattr(args, "vae_tile_size", None)
+        self.vae_tile_overlap = getattr(args, "vae_tile_overlap", 8)
+        # decode the video of `inference` in segments in parallel on these devices, every segment re-decodes
+        # `vae_decode_warmup_frames` latent frames before it (None: the whole causal context, same video)
+        self.vae_decode_devices = getattr(args, "vae_decode_devices", None)
+        self.vae_decode_warmup_frames = getattr(args, "vae_decode_warmup_frames", None)
+        # linear latent to RGB projection of the previews of `preview_callback`, see calibrate_latent_preview.py
+        latent_preview_path = getattr(args, "latent_preview_path", None)
+        self.latent_previewer = LatentPreviewer.load(latent_preview_path) if latent_preview_path else None
+        # None keeps the KV cache in the dtype of the noise, "int8"/"fp8" store it quantized with
+        # per-token, per-head scales and dequantize it right before attention
+        self.kv_cache_dtype = getattr(args, "kv_cache_dtype", None)
+        assert self.kv_cache_dtype in (None, "int8", "fp8")
         self.independent_first_frame = args.independent_first_frame
         self.local_attn_size = self.generator.model.local_attn_size
 
@@ -44,81 +89,425 @@ class CausalInferencePipeline(torch.nn.Module):
         if self.num_frame_per_block > 1:
             self.generator.model.num_frame_per_block = self.num_frame_per_block
 
+        # keep the keys/values of the last denoising step in the KV cache instead of rerunning the
+        # generator on the clean frames, saves one forward per block at the cost of some quality drift
+        self.skip_context_forward = getattr(args, "skip_context_forward", False)
+        # compile every transformer block once, the KV cache bookkeeping inside them runs eagerly
+        # so the compiled graphs have fixed shapes and are reused for all the blocks of the video
+        self.compile_denoise_step = getattr(args, "compile_denoise_step", False)
+        if self.compile_denoise_step:
+            for block in self.generator.model.blocks:
+                block.compile()
+        # decode the finished blocks of `inference` in a worker thread while the next ones are denoised
+        self.overlap_vae_decode = getattr(args, "overlap_vae_decode", False)
+        # stop denoising a block once the relative change of the denoised prediction between two steps falls
+        # below this threshold instead of always running the whole denoising_step_list, None disables it
+        self.early_exit_threshold = getattr(args, "early_exit_threshold", None)
+        # start the next block once the current one has run this many of its passes (denoising steps and clean
+        # context forward) instead of all of them, the blocks in flight share every forward of the generator.
+        # None denoises one block at a time
+        self.diagonal_denoising_lag = getattr(args, "diagonal_denoising_lag", None)
+        # frames of the blocks in flight after the oldest one, the KV cache holds them on top of the window
+        self.num_diagonal_frames = 0
+        if self.diagonal_denoising_lag is not None:
+            assert self.kv_cache_storage != "single_copy", "diagonal denoising needs full or paged KV cache storage"
+            assert self.early_exit_threshold is None, "diagonal denoising runs a fixed number of steps per block"
+            num_passes = len(self.denoising_step_list) + (0 if self.skip_context_forward else 1)
+            self.num_diagonal_frames = \
+                (math.ceil(num_passes / self.diagonal_denoising_lag) - 1) * self.num_frame_per_block
+
     def inference(
         self,
-        noise: torch.Tensor,
+        noise: Union[torch.Tensor, Callable[[int, int], torch.Tensor]],
         text_prompts: List[str],
         initial_latent: Optional[torch.Tensor] = None,
         return_latents: bool = False,
         profile: bool = False,
         low_memory: bool = False,
+        state: Optional[dict] = None,
+        return_state: bool = False,
+        num_frames: Optional[int] = None,
+        checkpoint_path: Optional[str] = None,
+        checkpoint_every: int = 1,
+        preview_callback: Optional[Callable[[int, torch.Tensor], None]] = None,
     ) -> torch.Tensor:
         """
         Perform inference on the given noise and text prompts.
         Inputs:
-            noise (torch.Tensor): The input noise tensor of shape
-                (batch_size, num_output_frames, num_channels, height, width).
-            text_prompts (List[str]): The list of text prompts.
+            noise (torch.Tensor or callable): The input noise tensor of shape
+                (batch_size, num_output_frames, num_channels, height, width), or a function
+                `noise(start_frame, num_frames)` returning the noise of the new frames
+                [start_frame, start_frame + num_frames), called once per block. A `SeekableNoise` also
+                provides the noise added back between the denoising steps, which makes the video reproducible.
+            text_prompts (List[str]): The text prompts, one per sample. The samples of a batch can have different prompts.
             initial_latent (torch.Tensor): The initial latent tensor of shape
                 (batch_size, num_input_frames, num_channels, height, width).
                 If num_input_frames is 1, perform image to video.
                 If num_input_frames is greater than 1, perform video extension.
             return_latents (bool): Whether to return the latents.
+            state (dict): A generation state returned by a previous call with `return_state`, `restore`
+                or `fork` to continue from, it is advanced in place. Only the new frames are generated and returned.
+            return_state (bool): Whether to also return the generation state after this call. With the
+                default storage it lives in the shared KV cache and is only valid until the next call,
+                with paged storage its pages stay allocated until `release` is called.
+            num_frames (int): With a noise function, the number of new frames to generate.
+            checkpoint_path (str): A directory to save a checkpoint of the generation to every `checkpoint_every`
+                denoised blocks (see `save_checkpoint`). Without `state` a new checkpoint is started, with the
+                state of `load_checkpoint(checkpoint_path)` the checkpoint is continued and the returned video and
+                latents also cover the frames generated before it was saved.
+            preview_callback (callable): Called after every block with its start frame and a cheap RGB preview
+                of its latents by the latent previewer (`latent_preview_path`), of shape
+                (batch_size, num_block_frames, 3, height, width) at the latent resolution, in the range [0, 1].
+                Nothing is decoded by the VAE. Raising an exception from it cancels the generation.
         Outputs:
             video (torch.Tensor): The generated video tensor of shape
                 (batch_size, num_output_frames, num_channels, height, width).
                 It is normalized to be in the range [0, 1].
         """
-        batch_size, num_frames, num_channels, height, width = noise.shape
-        if not self.independent_first_frame or (self.independent_first_frame and initial_latent is not None):
-            # If the first frame is independent and the first frame is provided, then the number of frames in the
-            # noise should still be a multiple of num_frame_per_block
-            assert num_frames % self.num_frame_per_block == 0
-            num_blocks = num_frames // self.num_frame_per_block
-        else:
-            # Using a [1, 4, 4, 4, 4, 4, ...] model to generate a video without image conditioning
-            assert (num_frames - 1) % self.num_frame_per_block == 0
-            num_blocks = (num_frames - 1) // self.num_frame_per_block
+        assert state is None or initial_latent is None
+        # with diagonal denoising the KV cache also holds the blocks in flight when one finishes
+        assert checkpoint_path is None or self.diagonal_denoising_lag is None, \
+            "checkpoints are not supported with diagonal denoising"
+        assert preview_callback is None or self.latent_previewer is not None, \
+            "previews need a latent previewer, set latent_preview_path"
+        block_noise, num_frames, batch_size, dtype, device = self._noise_source(noise, num_frames, text_prompts)
+        assert num_frames is not None
         num_input_frames = initial_latent.shape[1] if initial_latent is not None else 0
         num_output_frames = num_frames + num_input_frames  # add the initial latent frames
-        conditional_dict = self.text_encoder(
-            text_prompts=text_prompts
-        )
+        conditional_dict = self._encode_text_prompts(text_prompts, batch_size)
 
         if low_memory:
             gpu_memory_preservation = get_cuda_free_memory_gb(gpu) + 5
             move_model_to_device_with_memory_preservation(self.text_encoder, target_device=gpu, preserved_memory_gb=gpu_memory_preservation)
 
-        output = torch.zeros(
-            [batch_size, num_output_frames, num_channels, height, width],
-            device=noise.device,
-            dtype=noise.dtype
-        )
+        # allocated with the first block
+        output = None
 
         # Set up profiling if requested
+        profile_events = None
         if profile:
             init_start = torch.cuda.Event(enable_timing=True)
-            init_end = torch.cuda.Event(enable_timing=True)
-            diffusion_start = torch.cuda.Event(enable_timing=True)
             diffusion_end = torch.cuda.Event(enable_timing=True)
             vae_start = torch.cuda.Event(enable_timing=True)
             vae_end = torch.cuda.Event(enable_timing=True)
-            block_times = []
-            block_start = torch.cuda.Event(enable_timing=True)
-            block_end = torch.cuda.Event(enable_timing=True)
+            profile_events = {
+                "init_end": torch.cuda.Event(enable_timing=True),
+                "diffusion_start": torch.cuda.Event(enable_timing=True),
+                "block_start": torch.cuda.Event(enable_timing=True),
+                "block_end": torch.cuda.Event(enable_timing=True),
+                "block_times": []
+            }
             init_start.record()
 
         # Step 1: Initialize KV cache to all zeros
-        if self.kv_cache1 is None:
+        kv_cache1, crossattn_cache, start_frame, release_kv_cache = self._prepare_kv_cache(
+            batch_size, dtype, device, num_output_frames, state, return_state)
+        finish_decode = None
+        try:
+            # the latents of the checkpoint this call continues
+            checkpoint_latents = None
+            if checkpoint_path is not None:
+                if state is None:
+                    self._remove_checkpoint(checkpoint_path)
+                else:
+                    checkpoint_latents = self._load_checkpoint_latents(checkpoint_path, start_frame).to(device)
+            if self.overlap_vae_decode:
+                decode_block, finish_decode = self._start_block_decoder(batch_size, device)
+                if checkpoint_latents is not None:
+                    decode_block(checkpoint_latents)
+
+            # Steps 2 and 3: cache the initial latent frames and denoise the new ones block by block
+            num_denoised_blocks = num_saved_frames = 0
+            for current_start_frame, latents in self._generate_blocks(
+                    block_noise, num_frames, conditional_dict, initial_latent, kv_cache1, crossattn_cache,
+                    start_frame, independent_first_frame=self.independent_first_frame and state is None,
+                    profile_events=profile_events):
+                if output is None:
+                    output = latents.new_zeros([batch_size, num_output_frames, *latents.shape[2:]])
+                end_frame = current_start_frame - start_frame + latents.shape[1]
+                output[:, current_start_frame - start_frame:end_frame] = latents
+                if preview_callback is not None:
+                    preview_callback(current_start_frame, self.latent_previewer(latents))
+                if self.overlap_vae_decode:
+                    decode_block(latents)
+                if checkpoint_path is not None and current_start_frame >= start_frame + num_input_frames:
+                    num_denoised_blocks += 1
+                    # no checkpoint after the last block, the call is about to return
+                    if num_denoised_blocks % checkpoint_every == 0 and end_frame < num_output_frames:
+                        self.save_checkpoint(
+                            checkpoint_path,
+                            {"kv_cache": kv_cache1, "current_start_frame": start_frame + end_frame},
+                            output[:, num_saved_frames:end_frame])
+                        num_saved_frames = end_frame
+        except BaseException:
+            if finish_decode is not None:
+                finish_decode(cancel=True)
+            self._abort_kv_cache(kv_cache1, release_kv_cache)
+            raise
+        state = self._finish_state(
+            kv_cache1, crossattn_cache, start_frame + num_output_frames, state, return_state, release_kv_cache)
+        if checkpoint_latents is not None:
+            output = torch.cat([checkpoint_latents, output], dim=1)
+
+        if profile:
+            # End diffusion timing and synchronize CUDA
+            diffusion_end.record()
+            torch.cuda.synchronize()
+            diffusion_time = profile_events["diffusion_start"].elapsed_time(diffusion_end)
+            init_time = init_start.elapsed_time(profile_events["init_end"])
+            vae_start.record()
+
+        # Step 4: Decode the output
+        if self.overlap_vae_decode:
+            # only the blocks still in the queue are left to decode
+            video = finish_decode()
+        else:
+            with self.vae_lock:
+                if self.vae_decode_devices:
+                    video = self.vae.parallel_decode_to_pixel(
+                        output, self.vae_decode_devices, num_warmup_frames=self.vae_decode_warmup_frames,
+                        return_in_cpu=True, tile_size=self.vae_tile_size, tile_overlap=self.vae_tile_overlap)
+                else:
+                    video = self.vae.decode_to_pixel(
+                        output, use_cache=False, return_in_cpu=True, tile_size=self.vae_tile_size,
+                        tile_overlap=self.vae_tile_overlap)
+        video = (video * 0.5 + 0.5).clamp(0, 1)
+
+        if profile:
+            # End VAE timing and synchronize CUDA
+            vae_end.record()
+            torch.cuda.synchronize()
+            vae_time = vae_start.elapsed_time(vae_end)
+            total_time = init_time + diffusion_time + vae_time
+
+            print("Profiling results:")
+            print(f"  - Initialization/caching time: {init_time:.2f} ms ({100 * init_time / total_time:.2f}%)")
+            print(f"  - Diffusion generation time: {diffusion_time:.2f} ms ({100 * diffusion_time / total_time:.2f}%)")
+            for i, block_time in enumerate(profile_events["block_times"]):
+                print(f"    - Block {i} generation time: {block_time:.2f} ms ({100 * block_time / diffusion_time:.2f}% of diffusion)")
+            print(f"  - VAE decoding time: {vae_time:.2f} ms ({100 * vae_time / total_time:.2f}%)")
+            print(f"  - Total time: {total_time:.2f} ms")
+
+        if return_state:
+            return (video, output, state) if return_latents else (video, state)
+        if return_latents:
+            return video, output
+        else:
+            return video
+
+    def stream(
+        self,
+        noise: Union[torch.Tensor, Callable[[int, int], torch.Tensor]],
+        text_prompts: List[str],
+        initial_latent: Optional[torch.Tensor] = None,
+        low_memory: bool = False,
+        state: Optional[dict] = None,
+        return_state: bool = False,
+        num_frames: Optional[int] = None,
+        latent_sink: Optional[Callable[[torch.Tensor], None]] = None,
+        preview_callback: Optional[Callable[[int, torch.Tensor], None]] = None,
+    ):
+        """
+        Same as `inference`, but yields the pixel frames of every block as soon as it is denoised instead of
+        returning the whole video at the end. Blocks are decoded with the causal cache of the VAE, so the
+        frames are the same as the ones of `inference` and time to first frame is about the latency of a block.
+        Every stream keeps its own VAE cache, but only with `kv_cache_storage: paged` does it also get a KV cache
+        of its own: with full and single_copy storage all calls share the KV cache of the pipeline, and a
+        stream has to be finished or closed before another stream or `inference` call starts.
+        Inputs:
+            noise (torch.Tensor or callable): The noise tensor or the noise function, see `inference`.
+                With a noise function nothing is kept per frame (noise, latents or pixels) and memory
+                does not grow with the length of the video.
+            num_frames (int): With a noise function, the number of new frames to generate,
+                None to generate until the stream is closed.
+            latent_sink (callable): Called with the latents of every block, the initial latent ones included,
+                of shape (batch_size, num_block_frames, num_channels, height, width).
+            preview_callback (callable): Called with the start frame and the preview of every block before it is
+                decoded, see `inference`.
+        Yields:
+            video (torch.Tensor): The frames of one block on the CPU, of shape
+                (batch_size, num_block_frames, num_channels, height, width) in the range [0, 1].
+                The first latent frame decodes to 1 frame, every following one to 4 frames.
+        Returns:
+            state (dict): With `return_state`, the generation state, as the value of the generator
+                (the result of `yield from` or `StopIteration.value`). See `inference`.
+        """
+        assert state is None or initial_latent is None
+        assert preview_callback is None or self.latent_previewer is not None, \
+            "previews need a latent previewer, set latent_preview_path"
+        block_noise, num_frames, batch_size, dtype, device = self._noise_source(noise, num_frames, text_prompts)
+        num_input_frames = initial_latent.shape[1] if initial_latent is not None else 0
+        # None for an endless stream
+        num_output_frames = num_frames + num_input_frames if num_frames is not None else None
+        conditional_dict = self._encode_text_prompts(text_prompts, batch_size)
+
+        if low_memory:
+            gpu_memory_preservation = get_cuda_free_memory_gb(gpu) + 5
+            move_model_to_device_with_memory_preservation(self.text_encoder, target_device=gpu, preserved_memory_gb=gpu_memory_preservation)
+
+        kv_cache1, crossattn_cache, start_frame, release_kv_cache = self._prepare_kv_cache(
+            batch_size, dtype, device, num_output_frames, state, return_state)
+        # one causal VAE cache per sample, as with `inference` a continued state starts a new one
+        feat_cache = [self.vae.model.new_decode_cache() for _ in range(batch_size)]
+
+        try:
+            for current_start_frame, latents in self._generate_blocks(
+                    block_noise, num_frames, conditional_dict, initial_latent, kv_cache1, crossattn_cache,
+                    start_frame, independent_first_frame=self.independent_first_frame and state is None):
+                if latent_sink is not None:
+                    latent_sink(latents)
+                if preview_callback is not None:
+                    preview_callback(current_start_frame, self.latent_previewer(latents))
+                with self.vae_lock:
+                    video = self.vae.decode_to_pixel(
+                        latents, use_cache=True, return_in_cpu=True, feat_cache=feat_cache,
+                        tile_size=self.vae_tile_size, tile_overlap=self.vae_tile_overlap)
+                yield (video * 0.5 + 0.5).clamp(0, 1)
+        except BaseException:
+            # also reached when the consumer closes the stream early
+            self._abort_kv_cache(kv_cache1, release_kv_cache)
+            raise
+        state = self._finish_state(
+            kv_cache1, crossattn_cache, start_frame + num_output_frames, state, return_state, release_kv_cache)
+        if return_state:
+            return state
+
+    def _noise_source(self, noise, num_frames, text_prompts):
+        """
+        Turn the noise of `inference` and `stream`, a tensor or a noise function, into a noise function.
+        Returns it with the number of new frames and the batch size, dtype and device of the generation.
+        """
+        if callable(noise):
+            if isinstance(noise, SeekableNoise):
+                return noise, num_frames, len(text_prompts), noise.dtype, noise.device
+            parameter = next(self.generator.parameters())
+            return noise, num_frames, len(text_prompts), parameter.dtype, parameter.device
+        assert num_frames is None
+
+        def block_noise(start, length):
+            return noise[:, start:start + length]
+        return block_noise, noise.shape[1], noise.shape[0], noise.dtype, noise.device
+
+    def _encode_text_prompts(self, text_prompts, batch_size):
+        """
+        Encode one prompt per sample. The samples of a batch may have different prompts, every one of them gets
+        its own row of the cross-attention cache and they share every forward of the generator.
+        Prompts repeated in the batch (several samples of a prompt) are encoded only once.
+        """
+        assert len(text_prompts) == batch_size, "one text prompt per sample of the noise"
+        unique_prompts = list(dict.fromkeys(text_prompts))
+        conditional_dict = self.text_encoder(
+            text_prompts=unique_prompts
+        )
+        if len(unique_prompts) < len(text_prompts):
+            index = [unique_prompts.index(prompt) for prompt in text_prompts]
+            conditional_dict = {
+                name: value[index] for name, value in conditional_dict.items()
+            }
+        return conditional_dict
+
+    def _start_block_decoder(self, batch_size, device):
+        """
+        Decode latent blocks with the causal cache of the VAE in a worker thread, on a CUDA stream of its own,
+        while the generator denoises the next blocks. The frames are the same as the ones of a single decode.
+        Returns a function that queues the latents of a block and a function that waits for the worker and
+        returns the decoded video on the CPU (`cancel` drops the blocks still queued instead).
+        """
+        # bounded, the generator never runs more than a couple of blocks ahead of the decoder
+        blocks = queue.Queue(maxsize=2)
+        feat_cache = [self.vae.model.new_decode_cache() for _ in range(batch_size)]
+        decode_stream = torch.cuda.Stream(device) if device.type == "cuda" else None
+        videos, errors = [], []
+        cancelled = threading.Event()
+
+        def worker():
+            # grad mode is per thread, torch.cuda.stream(None) keeps the current stream
+            with torch.no_grad(), torch.cuda.stream(decode_stream):
+                while True:
+                    block = blocks.get()
+                    if block is None:
+                        return
+                    if errors or cancelled.is_set():
+                        continue
+                    latents, ready = block
+                    try:
+                        if ready is not None:
+                            decode_stream.wait_event(ready)
+                        with self.vae_lock:
+                            videos.append(self.vae.decode_to_pixel(
+                                latents, use_cache=True, return_in_cpu=True, feat_cache=feat_cache,
+                                tile_size=self.vae_tile_size, tile_overlap=self.vae_tile_overlap))
+                    except BaseException as e:
+                        errors.append(e)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+
+        def decode_block(latents):
+            if errors:
+                raise errors[0]
+            ready = None
+            if decode_stream is not None:
+                # the latents are produced on the current stream and freed only once the decoder is done
+                ready = torch.cuda.Event()
+                ready.record()
+                latents.record_stream(decode_stream)
+            blocks.put((latents, ready))
+
+        def finish_decode(cancel=False):
+            if cancel:
+                cancelled.set()
+            blocks.put(None)
+            thread.join()
+            if cancel:
+                return None
+            if errors:
+                raise errors[0]
+            return torch.cat(videos, dim=1)
+
+        return decode_block, finish_decode
+
+    def _prepare_kv_cache(self, batch_size, dtype, device, num_output_frames, state, return_state):
+        """
+        Get the KV and cross-attention caches of a call: the ones of `state`, fresh pages of the paged pool or
+        the shared caches of the pipeline, reset. Returns them with the frame to start from and whether the
+        caches belong to this call only and are released at its end.
+        """
+        if state is None:
+            self._check_kv_cache_free(self.kv_cache_storage != "paged")
+        else:
+            self._check_kv_cache_free(state["kv_cache"] is self.kv_cache1)
+        start_frame = 0
+        kv_cache1 = None
+        if state is not None:
+            kv_cache1, crossattn_cache = state["kv_cache"], state["crossattn_cache"]
+            start_frame = state["current_start_frame"]
+            # the prompt may change from the one the state was generated with
+            for block_index in range(self.num_transformer_blocks):
+                crossattn_cache[block_index]["is_init"] = False
+        elif self.kv_cache_storage == "paged":
+            # every call gets its own pages and cross-attention cache, so calls can run concurrently
+            kv_cache1 = self._allocate_paged_kv_cache(
+                batch_size=batch_size,
+                num_frames=None if return_state else num_output_frames,
+                dtype=dtype,
+                device=device
+            )
+            crossattn_cache = self._initialize_crossattn_cache(
+                batch_size=batch_size,
+                dtype=dtype,
+                device=device
+            )
+        elif self.kv_cache1 is None or self.kv_cache1[0]["k"].shape[0] != batch_size:
             self._initialize_kv_cache(
                 batch_size=batch_size,
-                dtype=noise.dtype,
-                device=noise.device
+                dtype=dtype,
+                device=device
             )
-            self._initialize_crossattn_cache(
+            self.crossattn_cache = self._initialize_crossattn_cache(
                 batch_size=batch_size,
-                dtype=noise.dtype,
-                device=noise.device
+                dtype=dtype,
+                device=device
             )
         else:
             # reset cross attn cache
@@ -126,28 +515,108 @@ class CausalInferencePipeline(torch.nn.Module):
                 self.crossattn_cache[block_index]["is_init"] = False
             # reset kv cache
             for block_index in range(len(self.kv_cache1)):
-                self.kv_cache1[block_index]["global_end_index"] = torch.tensor(
-                    [0], dtype=torch.long, device=noise.device)
-                self.kv_cache1[block_index]["local_end_index"] = torch.tensor(
-                    [0], dtype=torch.long, device=noise.device)
+                self.kv_cache1[block_index]["global_end_index"] = 0
+                self.kv_cache1[block_index]["local_end_index"] = 0
+                self.kv_cache1[block_index]["rope_offset"] = 0
+                if self.kv_cache_storage == "single_copy":
+                    self.kv_cache1[block_index]["frame_slots"] = []
+                    self.kv_cache1[block_index]["free_slots"] = list(range(
+                        self.kv_cache1[block_index]["num_source_frames"],
+                        self.kv_cache1[block_index]["k"].shape[1] // self.frame_seq_length))
+                else:
+                    self.kv_cache1[block_index]["ring_start_index"] = 0
+        # paged caches allocated by this call are released once it is done
+        release_kv_cache = state is None and kv_cache1 is not None
+        if kv_cache1 is None:
+            kv_cache1, crossattn_cache = self.kv_cache1, self.crossattn_cache
+        if kv_cache1 is self.kv_cache1:
+            self.kv_cache_in_use = True
+        return kv_cache1, crossattn_cache, start_frame, release_kv_cache
+
+    def _check_kv_cache_free(self, uses_shared_kv_cache):
+        # resetting or advancing the shared cache under an unfinished call would corrupt its KV window
+        assert not (uses_shared_kv_cache and self.kv_cache_in_use), \
+            "another call is still generating with the shared KV cache, finish or close it first " \
+            "(or use kv_cache_storage: paged to run calls concurrently)"
+
+    def _finish_state(self, kv_cache1, crossattn_cache, current_start_frame, state, return_state, release_kv_cache):
+        """
+        Advance `state` to `current_start_frame`, build a new state for `return_state`
+        or release the paged caches of the call. Returns the state.
+        """
+        if kv_cache1 is self.kv_cache1:
+            self.kv_cache_in_use = False
+        if state is not None:
+            state["current_start_frame"] = current_start_frame
+        elif return_state:
+            state = {
+                "kv_cache": kv_cache1,
+                "crossattn_cache": crossattn_cache,
+                "current_start_frame": current_start_frame
+            }
+        elif release_kv_cache:
+            self._release_paged_kv_cache(kv_cache1)
+        return state
+
+    def _abort_kv_cache(self, kv_cache1, release_kv_cache):
+        """
+        Give back the KV cache of a call that failed or was closed early.
+        """
+        if kv_cache1 is self.kv_cache1:
+            self.kv_cache_in_use = False
+        if release_kv_cache:
+            self._release_paged_kv_cache(kv_cache1)
+
+    def _generate_blocks(
+        self,
+        noise,
+        num_frames,
+        conditional_dict,
+        initial_latent,
+        kv_cache1,
+        crossattn_cache,
+        start_frame,
+        independent_first_frame,
+        profile_events=None
+    ):
+        """
+        Cache the initial latent frames and denoise `num_frames` new frames block by block, starting at `start_frame`.
+        `noise(start, length)` returns the noise of the new frames [start, start + length), `num_frames` None
+        denoises blocks until the generator is closed. A `SeekableNoise` also draws the re-noise of every step.
+        Yields the start frame and the latents of every block, the initial latent ones included.
+        """
+        if num_frames is None:
+            num_blocks = None
+        elif not independent_first_frame or initial_latent is not None:
+            # If the first frame is independent and the first frame is provided, then the number of frames in the
+            # noise should still be a multiple of num_frame_per_block
+            assert num_frames % self.num_frame_per_block == 0
+            num_blocks = num_frames // self.num_frame_per_block
+        else:
+            # Using a [1, 4, 4, 4, 4, 4, ...] model to generate a video without image conditioning
+            assert (num_frames - 1) % self.num_frame_per_block == 0
+            num_blocks = (num_frames - 1) // self.num_frame_per_block
+        num_input_frames = initial_latent.shape[1] if initial_latent is not None else 0
+        profile = profile_events is not None
 
         # Step 2: Cache context feature
-        current_start_frame = 0
+        current_start_frame = start_frame
         if initial_latent is not None:
-            timestep = torch.ones([batch_size, 1], device=noise.device, dtype=torch.int64) * 0
-            if self.independent_first_frame:
+            timestep = torch.ones([initial_latent.shape[0], 1], dtype=torch.int64) * 0
+            if independent_first_frame:
                 # Assume num_input_frames is 1 + self.num_frame_per_block * num_input_blocks
                 assert (num_input_frames - 1) % self.num_frame_per_block == 0
                 num_input_blocks = (num_input_frames - 1) // self.num_frame_per_block
-                output[:, :1] = initial_latent[:, :1]
                 self.generator(
                     noisy_image_or_video=initial_latent[:, :1],
                     conditional_dict=conditional_dict,
                     timestep=timestep * 0,
-                    kv_cache=self.kv_cache1,
-                    crossattn_cache=self.crossattn_cache,
+                    kv_cache=kv_cache1,
+                    crossattn_cache=crossattn_cache,
                     current_start=current_start_frame * self.frame_seq_length,
+                    sampler=self.sampler
                 )
+                yield current_start_frame, initial_latent[:, :1]
                 current_start_frame += 1
             else:
                 # Assume num_input_frames is self.num_frame_per_block * num_input_blocks
@@ -157,39 +626,50 @@ class CausalInferencePipeline(torch.nn.Module):
             for _ in range(num_input_blocks):
                 current_ref_latents = \
                     initial_latent[:, current_start_frame:current_start_frame + self.num_frame_per_block]
-                output[:, current_start_frame:current_start_frame + self.num_frame_per_block] = current_ref_latents
                 self.generator(
                     noisy_image_or_video=current_ref_latents,
                     conditional_dict=conditional_dict,
                     timestep=timestep * 0,
-                    kv_cache=self.kv_cache1,
-                    crossattn_cache=self.crossattn_cache,
+                    kv_cache=kv_cache1,
+                    crossattn_cache=crossattn_cache,
                     current_start=current_start_frame * self.frame_seq_length,
+                    sampler=self.sampler
                 )
+                yield current_start_frame, current_ref_latents
                 current_start_frame += self.num_frame_per_block
 
         if profile:
-            init_end.record()
+            profile_events["init_end"].record()
             torch.cuda.synchronize()
-            diffusion_start.record()
+            profile_events["diffusion_start"].record()
 
         # Step 3: Temporal denoising loop
-        all_num_frames = [self.num_frame_per_block] * num_blocks
-        if self.independent_first_frame and initial_latent is None:
-            all_num_frames = [1] + all_num_frames
+        if num_blocks is None:
+            all_num_frames = itertools.repeat(self.num_frame_per_block)
+        else:
+            all_num_frames = [self.num_frame_per_block] * num_blocks
+        if independent_first_frame and initial_latent is None:
+            all_num_frames = itertools.chain([1], all_num_frames)
+        if self.diagonal_denoising_lag is not None:
+            yield from self._generate_blocks_diagonally(
+                noise, all_num_frames, conditional_dict, kv_cache1, crossattn_cache, current_start_frame,
+                start_frame + num_input_frames)
+            return
         for current_num_frames in all_num_frames:
             if profile:
-                block_start.record()
+                profile_events["block_start"].record()
 
-            noisy_input = noise[
-                :, current_start_frame - num_input_frames:current_start_frame + current_num_frames - num_input_frames]
+            noise_start_frame = current_start_frame - start_frame - num_input_frames
+            noisy_input = noise(noise_start_frame, current_num_frames)
+            batch_size = noisy_input.shape[0]
 
             # Step 3.1: Spatial denoising loop
+            previous_pred = None
+            exited_early = False
             for index, current_timestep in enumerate(self.denoising_step_list):
-                # set current timestep
+                # set current timestep, kept on the host so that the generator reads it without a sync
                 timestep = torch.ones(
                     [batch_size, current_num_frames],
-                    device=noise.device,
                     dtype=torch.int64) * current_timestep
 
                 if index < len(self.denoising_step_list) - 1:
@@ -197,82 +677,152 @@ class CausalInferencePipeline(torch.nn.Module):
                         noisy_image_or_video=noisy_input,
                         conditional_dict=conditional_dict,
                         timestep=timestep,
-                        kv_cache=self.kv_cache1,
-                        crossattn_cache=self.crossattn_cache,
-                        current_start=current_start_frame * self.frame_seq_length
+                        kv_cache=kv_cache1,
+                        crossattn_cache=crossattn_cache,
+                        current_start=current_start_frame * self.frame_seq_length,
+                        sampler=self.sampler
                     )
+                    if self.early_exit_threshold is not None:
+                        if previous_pred is not None and self._relative_change(
+                                denoised_pred, previous_pred) < self.early_exit_threshold:
+                            exited_early = True
+                            break
+                        previous_pred = denoised_pred
                     next_timestep = self.denoising_step_list[index + 1]
-                    noisy_input = self.scheduler.add_noise(
-                        denoised_pred.flatten(0, 1),
-                        torch.randn_like(denoised_pred.flatten(0, 1)),
-                        next_timestep * torch.ones(
-                            [batch_size * current_num_frames], device=noise.device, dtype=torch.long)
-                    ).unflatten(0, denoised_pred.shape[:2])
+                    if isinstance(noise, SeekableNoise):
+                        # addressed by frame and step, the same whatever the calls or processes before it
+                        step_noise = noise(noise_start_frame, current_num_frames, step=index + 1)
+                    else:
+                        step_noise = torch.randn_like(denoised_pred)
+                    noisy_input = self.sampler.add_noise(denoised_pred, step_noise, next_timestep)
                 else:
                     # for getting real output
                     _, denoised_pred = self.generator(
                         noisy_image_or_video=noisy_input,
                         conditional_dict=conditional_dict,
                         timestep=timestep,
-                        kv_cache=self.kv_cache1,
-                        crossattn_cache=self.crossattn_cache,
-                        current_start=current_start_frame * self.frame_seq_length
+                        kv_cache=kv_cache1,
+                        crossattn_cache=crossattn_cache,
+                        current_start=current_start_frame * self.frame_seq_length,
+                        commit_kv_cache=self.skip_context_forward and self.args.context_noise == 0,
+                        sampler=self.sampler
                     )
 
-            # Step 3.2: record the model's output
-            output[:, current_start_frame:current_start_frame + current_num_frames] = denoised_pred
+            if self.early_exit_threshold is not None:
+                print(f"Block at frame {current_start_frame}: {index + 1}/{len(self.denoising_step_list)} denoising steps")
 
-            # Step 3.3: rerun with timestep zero to update KV cache using clean context
-            context_timestep = torch.ones_like(timestep) * self.args.context_noise
-            self.generator(
-                noisy_image_or_video=denoised_pred,
-                conditional_dict=conditional_dict,
-                timestep=context_timestep,
-                kv_cache=self.kv_cache1,
-                crossattn_cache=self.crossattn_cache,
-                current_start=current_start_frame * self.frame_seq_length,
-            )
+            # Step 3.2: rerun with timestep zero to update KV cache using clean context
+            # (also after an early exit, the step that exited did not commit its keys/values)
+            if not self.skip_context_forward or exited_early:
+                context_timestep = torch.ones_like(timestep) * self.args.context_noise
+                self.generator(
+                    noisy_image_or_video=denoised_pred,
+                    conditional_dict=conditional_dict,
+                    timestep=context_timestep,
+                    kv_cache=kv_cache1,
+                    crossattn_cache=crossattn_cache,
+                    current_start=current_start_frame * self.frame_seq_length,
+                    sampler=self.sampler
+                )
 
             if profile:
-                block_end.record()
+                profile_events["block_end"].record()
                 torch.cuda.synchronize()
-                block_time = block_start.elapsed_time(block_end)
-                block_times.append(block_time)
+                block_time = profile_events["block_start"].elapsed_time(profile_events["block_end"])
+                profile_events["block_times"].append(block_time)
+
+            # Step 3.3: hand out the model's output
+            yield current_start_frame, denoised_pred
 
             # Step 3.4: update the start and end frame indices
             current_start_frame += current_num_frames
 
-        if profile:
-            # End diffusion timing and synchronize CUDA
-            diffusion_end.record()
-            torch.cuda.synchronize()
-            diffusion_time = diffusion_start.elapsed_time(diffusion_end)
-            init_time = init_start.elapsed_time(init_end)
-            vae_start.record()
+    def _generate_blocks_diagonally(
+        self,
+        noise,
+        all_num_frames,
+        conditional_dict,
+        kv_cache1,
+        crossattn_cache,
+        current_start_frame,
+        first_noise_frame
+    ):
+        """
+        Step 3 of `_generate_blocks` with diagonal denoising. A block starts once the previous one has run
+        `diagonal_denoising_lag` passes, every forward of the generator advances all the blocks in flight by one
+        pass, so the early high-noise steps of a block run with the late steps of the ones before it and attend
+        to their partially denoised keys/values. Yields the blocks in order as they finish.
+        """
+        num_steps = len(self.denoising_step_list)
+        num_passes = num_steps + (0 if self.skip_context_forward else 1)
+        all_num_frames = iter(all_num_frames)
+        # in flight, oldest first
+        blocks = []
+        while True:
+            if not blocks or blocks[-1]["pass"] >= self.diagonal_denoising_lag:
+                num_frames = next(all_num_frames, None)
+                if num_frames is not None:
+                    noise_start_frame = current_start_frame - first_noise_frame
+                    blocks.append({
+                        "start_frame": current_start_frame,
+                        "num_frames": num_frames,
+                        "noise_start_frame": noise_start_frame,
+                        "input": noise(noise_start_frame, num_frames),
+                        "pass": 0
+                    })
+                    current_start_frame += num_frames
+            if not blocks:
+                return
 
-        # Step 4: Decode the output
-        video = self.vae.decode_to_pixel(output, use_cache=False, return_in_cpu=True)
-        video = (video * 0.5 + 0.5).clamp(0, 1)
+            block_sizes = [block["num_frames"] for block in blocks]
+            noisy_input = torch.cat([block["input"] for block in blocks], dim=1)
+            batch_size = noisy_input.shape[0]
+            # one timestep per frame, the denoising step of its block or the context noise of the clean pass
+            timestep = torch.cat([
+                torch.ones([batch_size, block["num_frames"]], dtype=torch.int64) * (
+                    self.denoising_step_list[block["pass"]] if block["pass"] < num_steps else self.args.context_noise)
+                for block in blocks
+            ], dim=1)
+            _, denoised_pred = self.generator(
+                noisy_image_or_video=noisy_input,
+                conditional_dict=conditional_dict,
+                timestep=timestep,
+                kv_cache=kv_cache1,
+                crossattn_cache=crossattn_cache,
+                current_start=blocks[0]["start_frame"] * self.frame_seq_length,
+                commit_kv_cache=self.skip_context_forward and self.args.context_noise == 0
+                and blocks[0]["pass"] == num_passes - 1,
+                block_sizes=block_sizes,
+                sampler=self.sampler
+            )
 
-        if profile:
-            # End VAE timing and synchronize CUDA
-            vae_end.record()
-            torch.cuda.synchronize()
-            vae_time = vae_start.elapsed_time(vae_end)
-            total_time = init_time + diffusion_time + vae_time
+            for block, block_pred in zip(blocks, denoised_pred.split(block_sizes, dim=1)):
+                index = block["pass"]
+                if index < num_steps - 1:
+                    next_timestep = self.denoising_step_list[index + 1]
+                    if isinstance(noise, SeekableNoise):
+                        step_noise = noise(block["noise_start_frame"], block["num_frames"], step=index + 1)
+                    else:
+                        step_noise = torch.randn_like(block_pred)
+                    block["input"] = self.sampler.add_noise(block_pred, step_noise, next_timestep)
+                elif index == num_steps - 1:
+                    # the model's output, rerun as the clean context of the next pass
+                    block["output"] = block["input"] = block_pred
+                block["pass"] += 1
 
-            print("Profiling results:")
-            print(f"  - Initialization/caching time: {init_time:.2f} ms ({100 * init_time / total_time:.2f}%)")
-            print(f"  - Diffusion generation time: {diffusion_time:.2f} ms ({100 * diffusion_time / total_time:.2f}%)")
-            for i, block_time in enumerate(block_times):
-                print(f"    - Block {i} generation time: {block_time:.2f} ms ({100 * block_time / diffusion_time:.2f}% of diffusion)")
-            print(f"  - VAE decoding time: {vae_time:.2f} ms ({100 * vae_time / total_time:.2f}%)")
-            print(f"  - Total time: {total_time:.2f} ms")
+            # only the oldest block can finish in a forward
+            if blocks[0]["pass"] == num_passes:
+                block = blocks.pop(0)
+                yield block["start_frame"], block["output"]
 
-        if return_latents:
-            return video, output
-        else:
-            return video
+    @staticmethod
+    def _relative_change(denoised_pred, previous_pred):
+        """
+        The largest relative RMS change between two denoised predictions over the samples of the batch, the
+        block is only done once every sample has converged. Waits for the GPU.
+        """
+        change = (denoised_pred - previous_pred).float().flatten(1).norm(dim=1)
+        return (change / previous_pred.float().flatten(1).norm(dim=1).clamp_min(1e-6)).max().item()
 
     def _initialize_kv_cache(self, batch_size, dtype, device):
         """
@@ -285,18 +835,302 @@ class CausalInferencePipeline(torch.nn.Module):
         else:
             # Use the default KV cache size
             kv_cache_size = 32760
+        kv_cache_size += self.num_diagonal_frames * self.frame_seq_length
+
+        def buffers(num_tokens, *names):
+            return self._kv_cache_buffers(batch_size, num_tokens, dtype, device, *names)
+
+        # Rolling Sink replays the first `num_frames - 3` frames of the window. With single-copy storage
+        # these stay pinned in the pool next to the two most recent blocks, the rest of the window points
+        # at re-inserted source frames.
+        num_source_frames = kv_cache_size // self.frame_seq_length - 3
+        num_pool_frames = kv_cache_size // self.frame_seq_length + 3
 
         for _ in range(self.num_transformer_blocks):
+            if self.kv_cache_storage == "single_copy":
+                kv_cache1.append({
+                    **buffers(num_pool_frames * self.frame_seq_length, "k", "v"),
+                    "global_end_index": 0,
+                    "local_end_index": 0,
+                    "num_source_frames": num_source_frames,
+                    "frame_slots": [],
+                    "free_slots": list(range(num_source_frames, num_pool_frames)),
+                    "rope_offset": 0
+                })
+            else:
+                kv_cache1.append({
+                    **buffers(kv_cache_size, "k", "v", "k_original", "v_original"),
+                    "global_end_index": 0,
+                    "local_end_index": 0,
+                    "ring_start_index": 0,
+                    "rope_offset": 0
+                })
+
+        self.kv_cache1 = kv_cache1  # always store the clean cache
+
+    def _kv_cache_buffers(self, batch_size, num_tokens, dtype, device, *names):
+        """
+        Allocate zero-filled k/v buffers of shape [batch_size, num_tokens, 12, 128] in the KV cache dtype.
+        """
+        kv_cache_dtype = {None: dtype, "int8": torch.int8, "fp8": torch.float8_e4m3fn}[self.kv_cache_dtype]
+        entries = {}
+        for name in names:
+            entries[name] = torch.zeros([batch_size, num_tokens, 12, 128], dtype=kv_cache_dtype, device=device)
+            if self.kv_cache_dtype is not None:
+                entries[name + "_scale"] = torch.zeros(
+                    [batch_size, num_tokens, 12, 1], dtype=torch.float32, device=device)
+        return entries
+
+    def _allocate_paged_kv_cache(self, batch_size, num_frames, dtype, device):
+        """
+        Allocate the pages of one inference call from the shared paged KV cache pool.
+        Returns the per-block KV cache of the call and the pages to release once it is done.
+        """
+        if self.local_attn_size != -1:
+            kv_cache_frames = self.local_attn_size
+        else:
+            kv_cache_frames = 32760 // self.frame_seq_length
+        kv_cache_frames += self.num_diagonal_frames
+
+        with self.kv_cache_pool_lock:
+            if self.kv_cache_pool is None:
+                # page i of every block holds one frame of k/v, the rolling window and the copies of
+                # the first window used by Rolling Sink take pages from the same pool
+                num_pages = self.kv_cache_num_pages or 2 * kv_cache_frames
+                self.kv_cache_pool = KVCachePagePool([
+                    self._kv_cache_buffers(num_pages, self.frame_seq_length, dtype, device, "k", "v")
+                    for _ in range(self.num_transformer_blocks)
+                ])
+
+        # a call never holds more frames than the window, shorter videos take fewer pages
+        # unless they may be continued (num_frames is None)
+        num_window_frames = kv_cache_frames if num_frames is None else min(num_frames, kv_cache_frames)
+        pages = self.kv_cache_pool.allocate(2 * batch_size * num_window_frames, timeout=self.kv_cache_page_timeout)
+        rows = [pages[i:i + num_window_frames] for i in range(0, len(pages), num_window_frames)]
+        page_tables = {
+            "window": KVCachePageTable(self.kv_cache_pool, rows[:batch_size], device),
+            "original": KVCachePageTable(self.kv_cache_pool, rows[batch_size:], device)
+        }
+        return self._paged_kv_cache(page_tables, device)
+
+    def _paged_kv_cache(self, page_tables, device):
+        """
+        Per-block views of the paged KV cache pool through the "window" and "original" page tables of a stream.
+        """
+        kv_cache1 = []
+        for layer in self.kv_cache_pool.layers:
+            kv_cache = {"page_tables": {}}
+            for name, buffer in layer.items():
+                # "k_original"/"v_original" (and their scales) live in the same pool as "k"/"v"
+                original_name = name[:1] + "_original" + name[1:]
+                kv_cache[name] = kv_cache[original_name] = buffer
+                kv_cache["page_tables"][name] = page_tables["window"]
+                kv_cache["page_tables"][original_name] = page_tables["original"]
             kv_cache1.append({
-                "k": torch.zeros([batch_size, kv_cache_size, 12, 128], dtype=dtype, device=device),
-                "v": torch.zeros([batch_size, kv_cache_size, 12, 128], dtype=dtype, device=device),
-                "k_original": torch.zeros([batch_size, kv_cache_size, 12, 128], dtype=dtype, device=device),
-                "v_original": torch.zeros([batch_size, kv_cache_size, 12, 128], dtype=dtype, device=device),
-                "global_end_index": torch.tensor([0], dtype=torch.long, device=device),
-                "local_end_index": torch.tensor([0], dtype=torch.long, device=device)
+                **kv_cache,
+                "global_end_index": 0,
+                "local_end_index": 0,
+                "ring_start_index": 0,
+                "rope_offset": 0
             })
+        return kv_cache1
 
-        self.kv_cache1 = kv_cache1  # always store the clean cache
+    def _release_paged_kv_cache(self, kv_cache1):
+        page_tables = kv_cache1[0]["page_tables"]
+        page_tables["k"].release()
+        page_tables["k_original"].release()
+
+    def snapshot(self, state, path=None, include_original=True):
+        """
+        Copy a generation state to host memory, or save it to `path` so that `restore` memory-maps it.
+        The snapshot also holds the RNG state, restoring it replays the same noise as continuing directly.
+        The cross-attention cache is not part of it, a resumed call rebuilds it from its own prompt.
+        Without `include_original` the first-window copies of Rolling Sink are left out, they have to be
+        added back to the snapshot before it is restored (see `save_checkpoint`).
+        """
+        snapshot = {
+            "kv_cache": self._snapshot_kv_cache(
+                state["kv_cache"], lambda name: include_original or not self._is_original(name)),
+            "current_start_frame": state["current_start_frame"],
+            "rng_state": torch.get_rng_state(),
+            "cuda_rng_state": torch.cuda.get_rng_state() if torch.cuda.is_available() else None
+        }
+        if path is None:
+            return snapshot
+        torch.save(snapshot, path)
+        return path
+
+    @staticmethod
+    def _snapshot_kv_cache(kv_cache1, include):
+        """
+        Copy the entries of the per-block KV cache whose name passes `include` to host memory.
+        """
+        snapshot = []
+        for kv_cache in kv_cache1:
+            entries = {}
+            for name, value in kv_cache.items():
+                if name == "page_tables" or not include(name):
+                    continue
+                elif torch.is_tensor(value):
+                    entries[name] = kv_cache_get(
+                        kv_cache, name, 0, kv_cache_num_tokens(kv_cache, name)).to("cpu", copy=True)
+                else:
+                    entries[name] = copy.deepcopy(value)
+            snapshot.append(entries)
+        return snapshot
+
+    @staticmethod
+    def _is_original(name):
+        # "k_original"/"v_original" and their scales
+        return name[1:].startswith("_original")
+
+    def restore(self, snapshot):
+        """
+        Load a snapshot (or the path it was saved to) back into a KV cache on the device of the generator.
+        Returns the generation state to continue from with `inference(..., state=state)`.
+        """
+        if isinstance(snapshot, str):
+            snapshot = torch.load(snapshot, map_location="cpu", mmap=True, weights_only=True)
+        batch_size = snapshot["kv_cache"][0]["k"].shape[0]
+        parameter = next(self.generator.parameters())
+        dtype, device = parameter.dtype, parameter.device
+        if self.kv_cache_storage == "paged":
+            kv_cache1 = self._allocate_paged_kv_cache(
+                batch_size=batch_size,
+                num_frames=None,
+                dtype=dtype,
+                device=device
+            )
+        else:
+            self._check_kv_cache_free(True)
+            if self.kv_cache1 is None or self.kv_cache1[0]["k"].shape[0] != batch_size:
+                self._initialize_kv_cache(batch_size=batch_size, dtype=dtype, device=device)
+            kv_cache1 = self.kv_cache1
+        crossattn_cache = self._initialize_crossattn_cache(batch_size=batch_size, dtype=dtype, device=device)
+
+        for kv_cache, entries in zip(kv_cache1, snapshot["kv_cache"]):
+            for name, value in entries.items():
+                if torch.is_tensor(value):
+                    kv_cache_set(kv_cache, name, 0, value.to(device))
+                else:
+                    kv_cache[name] = copy.deepcopy(value)
+        if self.kv_cache_storage != "paged":
+            self.crossattn_cache = crossattn_cache
+
+        torch.set_rng_state(snapshot["rng_state"])
+        if snapshot["cuda_rng_state"] is not None:
+            torch.cuda.set_rng_state(snapshot["cuda_rng_state"])
+        return {
+            "kv_cache": kv_cache1,
+            "crossattn_cache": crossattn_cache,
+            "current_start_frame": snapshot["current_start_frame"]
+        }
+
+    def save_checkpoint(self, path, state, latents):
+        """
+        Checkpoint a generation to the directory `path`, to resume it with `load_checkpoint` after a crash.
+        `latents` are the frames generated since the previous checkpoint, they are appended to `latents.bin`,
+        raw frame-major bytes memory-mapped when loading. The snapshot of `state` goes to `state.pt` and
+        replaces the previous one atomically, it records how many latent frames it covers, so a crash
+        while saving leaves the previous checkpoint valid.
+        The first-window copies of Rolling Sink do not change once the first window is generated, they are
+        written to `original.pt` by the first checkpoint past it and left out of the following snapshots,
+        which only hold the rolling window and its indices.
+        """
+        os.makedirs(path, exist_ok=True)
+        # (num_frames, batch_size, num_channels, height, width), appended frames keep the layout
+        latents = latents.transpose(0, 1).contiguous().cpu()
+        with open(os.path.join(path, "latents.bin"), "ab") as f:
+            f.write(latents.view(torch.uint8).numpy().tobytes())
+            num_latent_frames = f.tell() // latents[0].nbytes
+        original_path = os.path.join(path, "original.pt")
+        num_window_frames = self.local_attn_size if self.local_attn_size != -1 else 32760 // self.frame_seq_length
+        if not os.path.exists(original_path) and "k_original" in state["kv_cache"][0] \
+                and state["current_start_frame"] >= num_window_frames:
+            torch.save(self._snapshot_kv_cache(state["kv_cache"], self._is_original), original_path + ".tmp")
+            os.replace(original_path + ".tmp", original_path)
+        checkpoint = self.snapshot(state, include_original=not os.path.exists(original_path))
+        checkpoint["num_latent_frames"] = num_latent_frames
+        checkpoint["latent_shape"] = list(latents.shape[1:])
+        checkpoint["latent_dtype"] = str(latents.dtype).removeprefix("torch.")
+        torch.save(checkpoint, os.path.join(path, "state.pt.tmp"))
+        os.replace(os.path.join(path, "state.pt.tmp"), os.path.join(path, "state.pt"))
+
+    def load_checkpoint(self, path):
+        """
+        Restore the generation state saved to the directory `path` by `save_checkpoint`, see `restore`.
+        Continue it with `inference(..., state=state, checkpoint_path=path)` and the noise of the frames from
+        `state["current_start_frame"]` on (minus the number of initial latent frames of the first call).
+        """
+        checkpoint = torch.load(
+            os.path.join(path, "state.pt"), map_location="cpu", mmap=True, weights_only=True)
+        assert checkpoint["num_latent_frames"] == checkpoint["current_start_frame"]
+        # drop the frames appended by an interrupted save
+        with open(os.path.join(path, "latents.bin"), "r+b") as f:
+            f.truncate(self._checkpoint_latent_numel(checkpoint, checkpoint["num_latent_frames"])
+                       * getattr(torch, checkpoint["latent_dtype"]).itemsize)
+        original_path = os.path.join(path, "original.pt")
+        if "k_original" not in checkpoint["kv_cache"][0] and os.path.exists(original_path):
+            original = torch.load(original_path, map_location="cpu", mmap=True, weights_only=True)
+            for entries, original_entries in zip(checkpoint["kv_cache"], original):
+                entries.update(original_entries)
+        return self.restore(checkpoint)
+
+    def _load_checkpoint_latents(self, path, num_frames):
+        """
+        Memory-map the first `num_frames` latent frames of a checkpoint, of shape
+        (batch_size, num_frames, num_channels, height, width).
+        """
+        checkpoint = torch.load(
+            os.path.join(path, "state.pt"), map_location="cpu", mmap=True, weights_only=True)
+        latents = torch.from_file(
+            os.path.join(path, "latents.bin"),
+            size=self._checkpoint_latent_numel(checkpoint, num_frames),
+            dtype=getattr(torch, checkpoint["latent_dtype"]))
+        return latents.view(num_frames, *checkpoint["latent_shape"]).transpose(0, 1)
+
+    @staticmethod
+    def _checkpoint_latent_numel(checkpoint, num_frames):
+        return num_frames * math.prod(checkpoint["latent_shape"])
+
+    @staticmethod
+    def _remove_checkpoint(path):
+        for name in ("state.pt", "latents.bin", "original.pt"):
+            if os.path.exists(os.path.join(path, name)):
+                os.remove(os.path.join(path, name))
+
+    def fork(self, state, num_forks):
+        """
+        Fork a paged generation state into `num_forks` independent continuations.
+        The forks share the pages of `state` and copy one only when they write to it, so the sink,
+        the first-window copies and the part of the window not overwritten yet are never duplicated.
+        """
+        assert self.kv_cache_storage == "paged"
+        forks = []
+        for _ in range(num_forks):
+            page_tables = state["kv_cache"][0]["page_tables"]
+            kv_cache1 = self._paged_kv_cache({
+                "window": page_tables["k"].fork(),
+                "original": page_tables["k_original"].fork()
+            }, page_tables["k"].device)
+            for kv_cache, source in zip(kv_cache1, state["kv_cache"]):
+                kv_cache["global_end_index"] = source["global_end_index"]
+                kv_cache["local_end_index"] = source["local_end_index"]
+                kv_cache["ring_start_index"] = source["ring_start_index"]
+                kv_cache["rope_offset"] = source["rope_offset"]
+            forks.append({
+                "kv_cache": kv_cache1,
+                "crossattn_cache": [dict(cache) for cache in state["crossattn_cache"]],
+                "current_start_frame": state["current_start_frame"]
+            })
+        return forks
+
+    def release(self, state):
+        """
+        Return the pages of a paged generation state to the pool.
+        """
+        if self.kv_cache_storage == "paged":
+            self._release_paged_kv_cache(state["kv_cache"])
 
     def _initialize_crossattn_cache(self, batch_size, dtype, device):
         """
@@ -310,4 +1144,4 @@ class CausalInferencePipeline(torch.nn.Module):
                 "v": torch.zeros([batch_size, 512, 12, 128], dtype=dtype, device=device),
                 "is_init": False
             })
-        self.crossattn_cache = crossattn_cache
+        return crossattn_cache
@@ -0,0 +1,12 @@
+from utils.misc import cpu_fallbacks
+
+_cpu_fallbacks = cpu_fallbacks()
+
+
+def pytest_configure(config):
+    # the test modules import `wan` when they are collected, the fallbacks stay on for the whole session
+    _cpu_fallbacks.__enter__()
+
+
+def pytest_unconfigure(config):
+    _cpu_fallbacks.__exit__(None, None, None)
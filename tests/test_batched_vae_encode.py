@@ -0,0 +1,47 @@
+import math
+
+import pytest
+import torch
+
+from utils.tiny_models import LATENT_HEIGHT, LATENT_WIDTH, make_vae
+
+# 9 frames encode to 3 latent frames
+NUM_SAMPLES, NUM_FRAMES = 5, 9
+
+
+@pytest.fixture(scope="module")
+def encoded():
+    torch.set_grad_enabled(False)
+    vae = make_vae()
+    pixel = torch.randn(NUM_SAMPLES, 3, NUM_FRAMES, 8 * LATENT_HEIGHT, 8 * LATENT_WIDTH,
+                        generator=torch.Generator().manual_seed(0))
+    latents = torch.cat([vae.encode_to_latent(sample.unsqueeze(0)) for sample in pixel])
+    return vae, pixel, latents
+
+
+# all the samples together, one at a time, and groups that do not divide the batch
+@pytest.mark.parametrize("batch_size", [None, 1, 2, 3, 5])
+def test_batched_encode_is_the_encode_of_every_sample(encoded, batch_size):
+    vae, pixel, latents = encoded
+
+    batched_latents = vae.encode_to_latent(pixel, batch_size=batch_size)
+
+    assert batched_latents.shape == (NUM_SAMPLES, 3, 16, LATENT_HEIGHT, LATENT_WIDTH)
+    if batch_size == 1:
+        assert torch.equal(batched_latents, latents)
+    else:
+        # the batched convolutions round differently
+        torch.testing.assert_close(batched_latents, latents)
+
+
+@pytest.mark.parametrize("batch_size", [2, 5])
+def test_streamed_batched_encode_is_the_batched_encode(encoded, batch_size):
+    vae, pixel, _ = encoded
+    latents = vae.encode_to_latent(pixel, batch_size=batch_size)
+
+    # one cache per group of samples, the first chunk of 1 + 4 frames, then 4 frames
+    feat_cache = [vae.model.new_encode_cache() for _ in range(math.ceil(NUM_SAMPLES / batch_size))]
+    chunks = [vae.encode_to_latent(chunk, batch_size=batch_size, use_cache=True, feat_cache=feat_cache)
+              for chunk in pixel.split([5, 4], dim=2)]
+
+    assert torch.equal(torch.cat(chunks, dim=1), latents)
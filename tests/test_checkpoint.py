@@ -0,0 +1,54 @@
+import os
+
+import pytest
+import torch
+
+from utils.tiny_models import make_noise, make_pipeline
+
+# 5 blocks of 3 frames, past the 6-frame window
+NUM_FRAMES = 15
+# the crash happens when the noise of the block at this frame is drawn, after the checkpoint at it. Two
+# blocks are left, the first one re-inserts first-window frames the second one attends to
+CRASH_FRAME = 9
+
+
+class Crash(Exception):
+    pass
+
+
+def make(kv_cache_storage):
+    torch.set_grad_enabled(False)
+    return make_pipeline(local_attn_size=6, sink_size=3, kv_cache_storage=kv_cache_storage)
+
+
+@pytest.mark.parametrize("kv_cache_storage", ["full", "single_copy", "paged"])
+def test_resumed_generation_is_the_uninterrupted_one(tmp_path, kv_cache_storage):
+    noise = make_noise(1, NUM_FRAMES)
+    # inference draws the noise of the denoising steps from the global RNG, the checkpoint holds its state
+    torch.manual_seed(0)
+    _, expected = make(kv_cache_storage).inference(noise, ["a prompt"], return_latents=True)
+
+    def crashing_noise(start_frame, num_frames):
+        if start_frame == CRASH_FRAME:
+            raise Crash
+        return noise[:, start_frame:start_frame + num_frames]
+
+    torch.manual_seed(0)
+    with pytest.raises(Crash):
+        make(kv_cache_storage).inference(
+            crashing_noise, ["a prompt"], num_frames=NUM_FRAMES, checkpoint_path=str(tmp_path), checkpoint_every=1)
+
+    # the first-window copies are saved once, the state only holds the rolling window past the first window
+    checkpoint = torch.load(tmp_path / "state.pt", weights_only=True)
+    assert checkpoint["current_start_frame"] == CRASH_FRAME
+    assert not any("k_original" in entries for entries in checkpoint["kv_cache"])
+    assert os.path.exists(tmp_path / "original.pt") == (kv_cache_storage != "single_copy")
+
+    # a new process resumes from the checkpoint
+    torch.manual_seed(1)
+    pipeline = make(kv_cache_storage)
+    state = pipeline.load_checkpoint(str(tmp_path))
+    _, latents = pipeline.inference(
+        noise[:, CRASH_FRAME:], ["a prompt"], state=state, checkpoint_path=str(tmp_path), return_latents=True)
+
+    assert torch.equal(latents, expected)
@@ -0,0 +1,48 @@
+import pytest
+import torch
+
+from utils.tiny_models import FRAME_SEQ_LENGTH, LATENT_HEIGHT, LATENT_WIDTH, make_generator
+from wan.modules.causal_model import causal_rope_apply, causal_rope_shift
+
+# Rolling Sink re-inserts 3 frames of the first window
+GRID_SIZES = torch.tensor([[3, LATENT_HEIGHT // 2, LATENT_WIDTH // 2]])
+
+
+@pytest.fixture(scope="module")
+def freqs():
+    return make_generator(num_layers=1).model.freqs
+
+
+def reinsert(x, freqs, current_start_frame_RS, left, reverse):
+    """
+    The source frames [left, left + 3) of the un-roped keys `x` re-inserted at `current_start_frame_RS`, by the
+    previous path (roping the un-roped keys at their new positions) and the current one (rotating the keys roped
+    at their original positions by the frame offset).
+    """
+    roped = causal_rope_apply(x, GRID_SIZES, freqs, start_frame=left)
+    if reverse:
+        x = x.unflatten(1, (3, FRAME_SEQ_LENGTH)).flip(dims=[1]).flatten(1, 2)
+        roped = roped.unflatten(1, (3, FRAME_SEQ_LENGTH)).flip(dims=[1]).flatten(1, 2)
+        shift, shift_step = current_start_frame_RS - (left + 2), 2
+    else:
+        shift, shift_step = current_start_frame_RS - left, 0
+    previous = causal_rope_apply(x, GRID_SIZES, freqs, start_frame=current_start_frame_RS)
+    return causal_rope_shift(roped, freqs, FRAME_SEQ_LENGTH, shift, shift_step), previous
+
+
+# the forward and the reversed sweep of a 21-frame window, and a stream long past it
+@pytest.mark.parametrize("current_start_frame_RS, left, reverse", [
+    (18, 0, False), (24, 6, False), (36, 15, True), (42, 9, True), (1000, 10, False), (1009, 12, True)])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_delta_rope_is_the_previous_reinsertion(freqs, current_start_frame_RS, left, reverse, dtype):
+    x = torch.randn(1, 3 * FRAME_SEQ_LENGTH, 12, 128, generator=torch.Generator().manual_seed(0)).to(dtype)
+
+    reinserted, previous = reinsert(x, freqs, current_start_frame_RS, left, reverse)
+
+    assert reinserted.dtype == previous.dtype == dtype
+    if dtype == torch.float32:
+        # the rotations are computed in float32 instead of float64
+        torch.testing.assert_close(reinserted, previous, rtol=1e-5, atol=1e-5)
+    else:
+        # the keys are roped and stored in bfloat16 first, the rotation rounds them a second time
+        torch.testing.assert_close(reinserted.float(), previous.float(), rtol=2 ** -7, atol=2 ** -7)
@@ -0,0 +1,75 @@
+import math
+
+import pytest
+import torch
+
+from utils.noise import SeekableNoise
+from utils.tiny_models import LATENT_HEIGHT, LATENT_WIDTH, make_pipeline
+from wan.modules.causal_model import CausalWanSelfAttention
+
+# 10 blocks of 3 frames, more than three times the 9-frame window
+NUM_FRAMES = 30
+# largest relative RMS difference of a block to the one generated one block at a time. The blocks in flight run
+# in one bfloat16 forward and attend to partially denoised keys/values of the blocks before them, they stay
+# within 2e-2 on the tiny pipeline
+RTOL = 5e-2
+
+
+def generate(num_frames=NUM_FRAMES, **config):
+    torch.set_grad_enabled(False)
+    pipeline = make_pipeline(local_attn_size=9, sink_size=3, **config)
+    # addressed by frame and step, the blocks draw the same noise whatever the order of the forwards
+    noise = SeekableNoise(0, [0], [16, LATENT_HEIGHT, LATENT_WIDTH], device=torch.device("cpu"),
+                          dtype=torch.bfloat16)
+    calls = []
+    pipeline.generator.register_forward_pre_hook(
+        lambda module, args, kwargs: calls.append(kwargs.get("block_sizes")), with_kwargs=True)
+    _, latents = pipeline.inference(noise, ["a prompt"], num_frames=num_frames, return_latents=True)
+    return pipeline, latents, calls
+
+
+@pytest.mark.parametrize("kv_cache_storage", ["full", "paged"])
+@pytest.mark.parametrize("skip_context_forward", [False, True])
+def test_one_block_in_flight_is_the_sequential_path(kv_cache_storage, skip_context_forward):
+    config = dict(kv_cache_storage=kv_cache_storage, skip_context_forward=skip_context_forward)
+    _, reference_latents, _ = generate(**config)
+    num_passes = 4 + (0 if skip_context_forward else 1)
+    pipeline, latents, calls = generate(diagonal_denoising_lag=num_passes, **config)
+
+    # every forward runs a single block, through the block_sizes path
+    assert calls == [[3]] * (num_passes * NUM_FRAMES // 3)
+    assert pipeline.num_diagonal_frames == 0
+    assert torch.equal(latents, reference_latents)
+
+
+@pytest.mark.parametrize("kv_cache_storage", ["full", "paged"])
+@pytest.mark.parametrize("lag", [1, 2])
+def test_blocks_in_flight_run_past_the_window_with_rolling_sink(kv_cache_storage, lag, monkeypatch):
+    rolling_sink_frames = CausalWanSelfAttention._rolling_sink_frames
+    rolling_sink_starts = []
+
+    def record_rolling_sink(self, current_start_frame, frame_seqlen):
+        if self.block_id == 0:
+            rolling_sink_starts.append(current_start_frame)
+        return rolling_sink_frames(self, current_start_frame, frame_seqlen)
+
+    monkeypatch.setattr(CausalWanSelfAttention, "_rolling_sink_frames", record_rolling_sink)
+    _, reference_latents, _ = generate(kv_cache_storage=kv_cache_storage)
+    reference_rolling_sink_starts = list(rolling_sink_starts)
+    rolling_sink_starts.clear()
+    pipeline, latents, calls = generate(kv_cache_storage=kv_cache_storage, diagonal_denoising_lag=lag)
+
+    # several blocks share the forwards, the cache holds them on top of the window
+    num_blocks_in_flight = math.ceil(5 / lag)
+    assert max(len(block_sizes) for block_sizes in calls) == num_blocks_in_flight
+    assert len(calls) < 5 * NUM_FRAMES // 3
+    assert pipeline.num_diagonal_frames == (num_blocks_in_flight - 1) * 3
+    # Rolling Sink re-inserts frames after the clean pass of every block that starts past the window, as it does
+    # one block at a time
+    assert rolling_sink_starts == reference_rolling_sink_starts
+    assert len(rolling_sink_starts) == (NUM_FRAMES - 9) // 3
+
+    assert latents.shape == reference_latents.shape
+    for start in range(0, NUM_FRAMES, 3):
+        block, reference = latents[:, start:start + 3].float(), reference_latents[:, start:start + 3].float()
+        assert ((block - reference).norm() / reference.norm()).item() <= RTOL
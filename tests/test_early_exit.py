@@ -0,0 +1,58 @@
+import pytest
+import torch
+
+from utils.tiny_models import make_noise, make_pipeline
+
+# 2 blocks of 3 frames
+NUM_FRAMES = 6
+
+
+def script_predictions(pipeline, scales):
+    """
+    Replace the denoised prediction of the k-th denoising step of every block with `scales[k]` (one scale per
+    sample, or one for all of them) times ones, so that the relative change between two steps is known. The clean
+    context passes are left alone. Returns the list the timesteps of the generator calls are recorded into.
+    """
+    forward = pipeline.generator.forward
+    steps = [int(step) for step in pipeline.denoising_step_list]
+    timesteps = []
+
+    def scripted_forward(*args, timestep, **kwargs):
+        flow_pred, denoised_pred = forward(*args, timestep=timestep, **kwargs)
+        step = int(timestep[0, 0])
+        timesteps.append(step)
+        if step == pipeline.args.context_noise:
+            return flow_pred, denoised_pred
+        scale = torch.tensor(scales[steps.index(step)], dtype=denoised_pred.dtype).view(-1, 1, 1, 1, 1)
+        return flow_pred, torch.ones_like(denoised_pred) * scale
+
+    pipeline.generator.forward = scripted_forward
+    return timesteps
+
+
+@pytest.mark.parametrize("threshold, num_steps", [(None, 4), (0.5, 2), (0.1, 3), (0.001, 4)])
+def test_denoising_stops_once_the_change_is_below_the_threshold(threshold, num_steps):
+    torch.set_grad_enabled(False)
+    pipeline = make_pipeline(early_exit_threshold=threshold)
+    steps = [int(step) for step in pipeline.denoising_step_list]
+    # relative changes 0.25, 0.02 and 0.005 after the second, third and fourth step
+    scales = [4.0, 5.0, 5.1, 5.125]
+    timesteps = script_predictions(pipeline, scales)
+
+    latents = pipeline.inference(make_noise(1, NUM_FRAMES), ["a prompt"], return_latents=True)[1]
+
+    # every block exits at the first step whose change is below the threshold, then runs the clean context pass
+    assert timesteps == (steps[:num_steps] + [pipeline.args.context_noise]) * (NUM_FRAMES // 3)
+    assert torch.equal(latents, torch.full_like(latents, scales[num_steps - 1]))
+
+
+def test_every_sample_has_to_converge():
+    torch.set_grad_enabled(False)
+    pipeline = make_pipeline(early_exit_threshold=0.1)
+    steps = [int(step) for step in pipeline.denoising_step_list]
+    # the first sample converges after the second step, the second one never does
+    timesteps = script_predictions(pipeline, [[4.0, 4.0], [4.0, 8.0], [4.0, 16.0], [4.0, 32.0]])
+
+    pipeline.inference(make_noise(2, NUM_FRAMES), ["a prompt", "another prompt"])
+
+    assert timesteps == (steps + [pipeline.args.context_noise]) * (NUM_FRAMES // 3)
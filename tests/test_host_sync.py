@@ -0,0 +1,104 @@
+import pytest
+import torch
+from torch.overrides import TorchFunctionMode
+from torch.utils._pytree import tree_flatten
+
+from utils.tiny_models import make_noise, make_pipeline
+
+# the Tensor methods that copy a value to the host, and wait for the device when the tensor lives on it
+HOST_READS = {torch.Tensor.item, torch.Tensor.tolist, torch.Tensor.__bool__, torch.Tensor.__int__,
+              torch.Tensor.__float__, torch.Tensor.__index__}
+
+
+class DeviceTensorMode(TorchFunctionMode):
+    """
+    Tell device tensors from host tensors on the CPU: the tensors marked with `mark`, the ones created or moved
+    with an explicit device and every result of an op on one of them are device tensors.
+    Host reads of device tensors are recorded with the shape of the tensor.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.host_reads = []
+
+    @staticmethod
+    def mark(tensors):
+        for tensor in tree_flatten(tensors)[0]:
+            if isinstance(tensor, torch.Tensor):
+                tensor._on_device = True
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        inputs = [x for x in tree_flatten((args, kwargs))[0] if isinstance(x, torch.Tensor)]
+        on_device = any(getattr(x, "_on_device", False) for x in inputs)
+        if func in HOST_READS:
+            if on_device:
+                self.host_reads.append((func.__name__, tuple(inputs[0].shape)))
+            return func(*args, **kwargs)
+        result = func(*args, **kwargs)
+        moved = kwargs.get("device") is not None or (
+            func in (torch.Tensor.to, torch.Tensor.cuda) and any(
+                isinstance(x, (str, torch.device)) for x in args[1:]))
+        if moved and result is (args[0] if args else None):
+            # on the CPU the copy to the device is the host tensor itself, keep that one a host tensor
+            result = result.clone()
+        if on_device or moved:
+            self.mark(result)
+        return result
+
+
+@pytest.mark.parametrize("kv_cache_storage", ["full", "single_copy", "paged"])
+@pytest.mark.parametrize("sink_size", [0, 3])
+def test_forward_inference_does_not_read_device_tensors(kv_cache_storage, sink_size):
+    torch.set_grad_enabled(False)
+    pipeline = make_pipeline(kv_cache_storage=kv_cache_storage, sink_size=sink_size, local_attn_size=6)
+    model = pipeline.generator.model
+    forward_inference = model._forward_inference
+    modes = []
+
+    def checked_forward_inference(x, t, context, *args, kv_cache=None, crossattn_cache=None, **kwargs):
+        # the model, the latents, the prompt and the caches live on the device, t is the host timestep
+        DeviceTensorMode.mark((list(model.parameters()), list(model.buffers()), model.freqs, x, context,
+                               kv_cache, crossattn_cache))
+        with DeviceTensorMode() as mode:
+            modes.append(mode)
+            return forward_inference(x, t, context, *args, kv_cache=kv_cache, crossattn_cache=crossattn_cache,
+                                     **kwargs)
+
+    model._forward_inference = checked_forward_inference
+    pipeline.inference(make_noise(1, 12), ["a prompt"])
+
+    assert modes
+    assert [read for mode in modes for read in mode.host_reads] == []
+
+
+def test_device_tensor_mode_records_host_reads():
+    tensor = torch.ones(2)
+    DeviceTensorMode.mark(tensor)
+    with DeviceTensorMode() as mode:
+        host = torch.tensor([1, 2])
+        host.tolist()
+        (tensor * 2).sum().item()
+        host.to("cpu").tolist()
+        bool(tensor[0] > 0)
+    assert mode.host_reads == [("item", ()), ("tolist", (2,)), ("__bool__", ())]
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs a CUDA device")
+def test_forward_inference_does_not_sync_cuda():
+    torch.set_grad_enabled(False)
+    pipeline = make_pipeline(kv_cache_storage="full")
+    pipeline.generator.to("cuda")
+    pipeline.vae.to("cuda")
+    model = pipeline.generator.model
+    forward_inference = model._forward_inference
+
+    def checked_forward_inference(*args, **kwargs):
+        torch.cuda.set_sync_debug_mode("error")
+        try:
+            return forward_inference(*args, **kwargs)
+        finally:
+            torch.cuda.set_sync_debug_mode("default")
+
+    model._forward_inference = checked_forward_inference
+    pipeline.inference(make_noise(1, 6).cuda(), ["a prompt"])
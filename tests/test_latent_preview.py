@@ -0,0 +1,45 @@
+import pickle
+
+import pytest
+import torch
+
+from utils.preview import LatentPreviewer
+from utils.tiny_models import make_noise, make_pipeline
+
+
+class Payload:
+    pass
+
+
+def test_calibrated_previewer_survives_a_save_load_round_trip(tmp_path):
+    torch.set_grad_enabled(False)
+    pipeline = make_pipeline()
+    torch.manual_seed(0)
+    video, latents = pipeline.inference(make_noise(2, 6), ["a prompt", "another prompt"], return_latents=True)
+    previewer = LatentPreviewer.fit(latents, LatentPreviewer.targets(latents, video))
+    previewer.save(tmp_path / "latent_preview.pt")
+
+    loaded = LatentPreviewer.load(tmp_path / "latent_preview.pt")
+
+    assert torch.equal(loaded.weight, previewer.weight) and torch.equal(loaded.bias, previewer.bias)
+    assert torch.equal(loaded(latents), previewer(latents))
+
+    # the pipeline loads it from the config and previews the blocks of a stream before decoding them
+    pipeline = make_pipeline(latent_preview_path=str(tmp_path / "latent_preview.pt"))
+    blocks, previews = [], []
+    for _ in pipeline.stream(
+            make_noise(1, 6), ["a prompt"], latent_sink=blocks.append,
+            preview_callback=lambda start_frame, preview: previews.append((start_frame, preview))):
+        pass
+
+    assert [start_frame for start_frame, _ in previews] == [0, 3]
+    for block, (_, preview) in zip(blocks, previews):
+        assert torch.equal(preview, previewer(block))
+
+
+def test_load_refuses_pickled_objects(tmp_path):
+    torch.save({"weight": torch.zeros(16, 3), "bias": torch.zeros(3), "payload": Payload()},
+               tmp_path / "latent_preview.pt")
+
+    with pytest.raises(pickle.UnpicklingError):
+        LatentPreviewer.load(tmp_path / "latent_preview.pt")
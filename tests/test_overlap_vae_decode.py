@@ -0,0 +1,96 @@
+import threading
+
+import pytest
+import torch
+
+from utils.tiny_models import make_noise, make_pipeline
+
+# 4 blocks of 3 frames
+NUM_FRAMES = 12
+
+
+def generate(pipeline, **kwargs):
+    # inference draws the noise of the denoising steps from the global RNG
+    torch.manual_seed(0)
+    return pipeline.inference(make_noise(1, NUM_FRAMES), ["a prompt"], return_latents=True, **kwargs)
+
+
+@pytest.mark.parametrize("vae_tile_size", [None, 4])
+def test_overlapped_decode_matches_decode_at_the_end(vae_tile_size):
+    torch.set_grad_enabled(False)
+    pipeline = make_pipeline(vae_tile_size=vae_tile_size, vae_tile_overlap=2)
+    video, latents = generate(pipeline)
+    pipeline.overlap_vae_decode = True
+    overlapped_video, overlapped_latents = generate(pipeline)
+
+    assert torch.equal(overlapped_latents, latents)
+    assert torch.equal(overlapped_video, video)
+
+
+def count_decodes(pipeline, fail_at=None, wait=None):
+    """
+    Count the blocks decoded by the VAE of `pipeline`, the `fail_at`-th one raises and every one first waits for
+    `wait` (an event, for at most a few seconds).
+    """
+    decode_to_pixel = pipeline.vae.decode_to_pixel
+    decoded = []
+
+    def counted_decode_to_pixel(latents, *args, **kwargs):
+        if wait is not None:
+            wait.wait(timeout=5)
+        decoded.append(latents.shape[1])
+        if len(decoded) == fail_at:
+            raise RuntimeError("decoder failure")
+        return decode_to_pixel(latents, *args, **kwargs)
+
+    pipeline.vae.decode_to_pixel = counted_decode_to_pixel
+    return decoded
+
+
+def decoder_threads():
+    return [thread for thread in threading.enumerate() if thread is not threading.current_thread()]
+
+
+def test_decoder_error_reaches_the_caller():
+    torch.set_grad_enabled(False)
+    pipeline = make_pipeline(overlap_vae_decode=True)
+    pipeline.latent_previewer = lambda latents: latents
+    threads = decoder_threads()
+    # the decoder fails on the first block once the last one is generated, the blocks between are queued
+    last_block = threading.Event()
+    decoded = count_decodes(pipeline, fail_at=1, wait=last_block)
+
+    def preview_callback(start_frame, preview):
+        if start_frame == NUM_FRAMES - 3:
+            last_block.set()
+
+    with pytest.raises(RuntimeError, match="decoder failure"):
+        generate(pipeline, preview_callback=preview_callback)
+    # the blocks queued after the failing one are dropped, the worker is done
+    assert decoded == [3]
+    assert decoder_threads() == threads
+    assert not pipeline.kv_cache_in_use
+
+    del pipeline.vae.decode_to_pixel
+    video, _ = generate(pipeline)
+    assert video.shape[1] == 1 + 4 * (NUM_FRAMES - 1)
+
+
+def test_generation_error_cancels_the_queued_blocks():
+    torch.set_grad_enabled(False)
+    pipeline = make_pipeline(overlap_vae_decode=True)
+    pipeline.latent_previewer = lambda latents: latents
+    threads = decoder_threads()
+    # the decoder is stuck on the first block until the generation fails on the third one
+    decoded = count_decodes(pipeline, wait=threading.Event())
+
+    def preview_callback(start_frame, preview):
+        if start_frame == 6:
+            raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        generate(pipeline, preview_callback=preview_callback)
+    # the second block was still queued when the call failed, it is never decoded
+    assert decoded == [3]
+    assert decoder_threads() == threads
+    assert not pipeline.kv_cache_in_use
@@ -0,0 +1,73 @@
+import pytest
+import torch
+
+from utils.kv_cache import KVCachePagePool, KVCachePageTable
+from utils.tiny_models import make_noise, make_pipeline
+from wan.modules.causal_model import kv_cache_get
+
+PAGE_SIZE = 4
+
+
+def make_kv_cache(pages):
+    pool = KVCachePagePool([{"k": torch.arange(16 * PAGE_SIZE * 2.0).view(16, PAGE_SIZE, 2)}])
+    pool.allocate(pool.num_pages)
+    return {"k": pool.layers[0]["k"], "page_tables": {"k": KVCachePageTable(pool, pages, "cpu")}}
+
+
+def gathered(kv_cache, start, end):
+    buffer = kv_cache["k"]
+    return buffer[kv_cache["page_tables"]["k"].tensor].flatten(1, 2)[:, start:end]
+
+
+@pytest.mark.parametrize("start, end", [(0, 12), (2, 9), (4, 8)])
+def test_consecutive_pages_are_read_in_place(start, end):
+    # two samples of 3 pages from one allocation
+    kv_cache = make_kv_cache([[5, 6, 7], [8, 9, 10]])
+
+    value = kv_cache_get(kv_cache, "k", start, end)
+
+    assert value.untyped_storage().data_ptr() == kv_cache["k"].untyped_storage().data_ptr()
+    assert torch.equal(value, gathered(kv_cache, start, end))
+
+
+@pytest.mark.parametrize("pages", [[[5, 6, 7], [9, 10, 11], [12, 13, 15]], [[3, 2, 1]], [[5, 6, 7], [4, 5, 6]]])
+def test_fragmented_pages_are_gathered(pages):
+    kv_cache = make_kv_cache(pages)
+
+    value = kv_cache_get(kv_cache, "k", 1, 11)
+
+    assert value.untyped_storage().data_ptr() != kv_cache["k"].untyped_storage().data_ptr()
+    assert torch.equal(value, gathered(kv_cache, 1, 11))
+
+
+@pytest.mark.parametrize("batch_size", [1, 2])
+def test_paged_storage_generates_the_full_storage_video(batch_size):
+    # Rolling Sink re-inserts frames read in place from the pool into other pages of it
+    torch.set_grad_enabled(False)
+    latents = {}
+    for kv_cache_storage in ("full", "paged"):
+        pipeline = make_pipeline(
+            local_attn_size=6, sink_size=3, kv_cache_storage=kv_cache_storage, kv_cache_num_pages=12 * batch_size)
+        # inference draws the noise of the denoising steps from the global RNG
+        torch.manual_seed(0)
+        _, latents[kv_cache_storage] = pipeline.inference(
+            make_noise(batch_size, 12), ["a prompt"] * batch_size, return_latents=True)
+
+    assert torch.equal(latents["paged"], latents["full"])
+
+
+def test_allocate_waits_for_released_pages_at_most_the_timeout():
+    pool = KVCachePagePool([{"k": torch.zeros(6, PAGE_SIZE)}])
+    first = pool.allocate(2)
+    second = pool.allocate(3)
+
+    with pytest.raises(TimeoutError):
+        pool.allocate(2, timeout=0.01)
+    with pytest.raises(ValueError):
+        pool.allocate(7, timeout=0.01)
+
+    # the pages released by the streams are handed out in order again
+    pool.release(first)
+    assert pool.allocate(3, timeout=0.01) == [0, 1, 5]
+    pool.release(second)
+    assert pool.allocate(3, timeout=0.01) == [2, 3, 4]
@@ -0,0 +1,54 @@
+import pytest
+import torch
+
+from utils.tiny_models import LATENT_HEIGHT, LATENT_WIDTH, make_vae
+from wan.modules.vae import WanVAE_
+
+# the warm-up of the tiny decoder is 30 latent frames: 3 or 4 segments are shorter than it, the second of 2
+# segments starts after it
+NUM_LATENT_FRAMES = 64
+
+
+def make_latent(num_frames=NUM_LATENT_FRAMES, batch_size=2):
+    return torch.randn(batch_size, num_frames, 16, LATENT_HEIGHT, LATENT_WIDTH,
+                       generator=torch.Generator().manual_seed(0))
+
+
+@pytest.fixture(scope="module")
+def decoded():
+    torch.set_grad_enabled(False)
+    vae = make_vae()
+    latent = make_latent()
+    return vae, latent, vae.decode_to_pixel(latent)
+
+
+@pytest.mark.parametrize("num_segments, num_devices", [(1, 1), (2, 2), (3, 2), (4, 3)])
+def test_parallel_decode_is_the_sequential_decode(decoded, num_segments, num_devices):
+    vae, latent, video = decoded
+    parallel_video = vae.parallel_decode_to_pixel(latent, ["cpu"] * num_devices, num_segments=num_segments)
+
+    assert torch.equal(parallel_video, video)
+
+
+def test_num_context_frames_is_the_shortest_exact_warm_up(decoded):
+    vae, latent, video = decoded
+    num_context_frames = vae.model.num_context_frames()
+    assert NUM_LATENT_FRAMES // 4 < num_context_frames < NUM_LATENT_FRAMES // 2
+    # one segment starting in the middle, with a warm-up as long as the causal context or one frame shorter
+    exact = vae.parallel_decode_to_pixel(latent, ["cpu"], num_segments=2, num_warmup_frames=num_context_frames)
+    short = vae.parallel_decode_to_pixel(latent, ["cpu"], num_segments=2, num_warmup_frames=num_context_frames - 1)
+
+    assert torch.equal(exact, video)
+    assert not torch.equal(short, video)
+    # the frames of the first segment do not depend on the warm-up
+    num_first_frames = vae.model.num_decoded_frames(NUM_LATENT_FRAMES // 2, 1)
+    assert torch.equal(short[:, :num_first_frames], video[:, :num_first_frames])
+
+
+def test_num_context_frames_of_the_wan_vae():
+    # the architecture of the Wan 2.1 VAE (`_video_vae`) without its weights
+    with torch.device("meta"):
+        model = WanVAE_(dim=96, z_dim=16, dim_mult=[1, 2, 4, 4], num_res_blocks=2, attn_scales=[],
+                        temperal_downsample=[False, True, True])
+
+    assert model.num_context_frames() == 38
@@ -0,0 +1,42 @@
+import pytest
+import torch
+
+from utils.tiny_models import make_noise, make_pipeline
+
+# 4 blocks of 3 frames, past the 6-frame window
+NUM_FRAMES = 12
+# largest relative RMS difference of a self-attention output to the one over a bfloat16 cache. Per-token,
+# per-head scales keep int8 within 1e-2 and fp8 (3 mantissa bits) within 3e-2 on the tiny pipeline
+ATTENTION_RTOL = {"int8": 2e-2, "fp8": 5e-2}
+# relative RMS difference of the latents, within 6e-3 for both
+LATENT_RTOL = 2e-2
+
+
+def relative_difference(value, reference):
+    return ((value - reference).norm() / reference.norm()).item()
+
+
+def generate(**config):
+    torch.set_grad_enabled(False)
+    pipeline = make_pipeline(local_attn_size=6, sink_size=3, **config)
+    outputs = []
+    for block in pipeline.generator.model.blocks:
+        block.self_attn.register_forward_hook(lambda module, inputs, output: outputs.append(output.float()))
+    # inference draws the noise of the denoising steps from the global RNG
+    torch.manual_seed(0)
+    _, latents = pipeline.inference(make_noise(1, NUM_FRAMES), ["a prompt"], return_latents=True)
+    return pipeline, outputs, latents.float()
+
+
+@pytest.mark.parametrize("kv_cache_storage", ["full", "single_copy", "paged"])
+@pytest.mark.parametrize("kv_cache_dtype", ["int8", "fp8"])
+def test_quantized_attention_stays_close_to_bfloat16(kv_cache_storage, kv_cache_dtype):
+    _, reference_outputs, reference_latents = generate(kv_cache_storage=kv_cache_storage)
+    pipeline, outputs, latents = generate(kv_cache_storage=kv_cache_storage, kv_cache_dtype=kv_cache_dtype)
+
+    kv_cache = pipeline.kv_cache_pool.layers[0] if kv_cache_storage == "paged" else pipeline.kv_cache1[0]
+    assert kv_cache["k"].dtype == {"int8": torch.int8, "fp8": torch.float8_e4m3fn}[kv_cache_dtype]
+    assert len(outputs) == len(reference_outputs)
+    for output, reference_output in zip(outputs, reference_outputs):
+        assert relative_difference(output, reference_output) <= ATTENTION_RTOL[kv_cache_dtype]
+    assert relative_difference(latents, reference_latents) <= LATENT_RTOL
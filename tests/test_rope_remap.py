@@ -0,0 +1,97 @@
+import itertools
+
+import pytest
+import torch
+
+from utils.noise import SeekableNoise
+from utils.tiny_models import FRAME_SEQ_LENGTH, LATENT_HEIGHT, LATENT_WIDTH, make_noise, make_pipeline
+from wan.modules.causal_model import causal_rope_apply, causal_rope_shift
+
+# RoPE table of the remapped runs, 30 frames run past it twice
+NUM_TABLE_FRAMES = 16
+NUM_FRAMES = 30
+# largest difference of the attention outputs to the unremapped run, relative to their largest value. Keys are
+# rotated and stored back in bfloat16, the runs stay within 1e-2 while a key rotated by one frame too many is
+# off by more than 2e-1
+RTOL = 3e-2
+
+
+def attention_outputs(num_table_frames, generate, **kwargs):
+    """
+    The outputs of every self-attention call of `generate(pipeline)` on a pipeline with a 6-frame window and a
+    RoPE table of `num_table_frames` frames (None keeps the whole table). Returns them with the RoPE offsets of the
+    KV caches of the blocks.
+    """
+    pipeline = make_pipeline(local_attn_size=6, **kwargs)
+    model = pipeline.generator.model
+    if num_table_frames is not None:
+        model.freqs = model.freqs[:num_table_frames]
+    outputs = []
+    for block in model.blocks:
+        block.self_attn.register_forward_hook(lambda module, inputs, output: outputs.append(output.float()))
+    rope_offsets = generate(pipeline)
+    return outputs, rope_offsets
+
+
+def generate_video(pipeline):
+    torch.set_grad_enabled(False)
+    torch.manual_seed(0)
+    _, state = pipeline.inference(make_noise(1, NUM_FRAMES), ["a prompt"], return_state=True)
+    return [kv_cache["rope_offset"] for kv_cache in state["kv_cache"]]
+
+
+def generate_endless(pipeline):
+    # the --endless mode of inference.py: a stream without a number of frames, closed by the consumer
+    torch.set_grad_enabled(False)
+    noise = SeekableNoise(0, [0], [16, LATENT_HEIGHT, LATENT_WIDTH], device=torch.device("cpu"),
+                          dtype=torch.bfloat16)
+    stream = pipeline.stream(noise, ["a prompt"], num_frames=None)
+    num_frames = 0
+    for video in itertools.islice(stream, NUM_FRAMES // pipeline.num_frame_per_block):
+        num_frames += video.shape[1]
+    stream.close()
+    assert num_frames == 1 + 4 * (NUM_FRAMES - 1)
+    if pipeline.kv_cache1 is None:
+        return None
+    return [kv_cache["rope_offset"] for kv_cache in pipeline.kv_cache1]
+
+
+def assert_same_attention(outputs, reference_outputs):
+    assert len(outputs) == len(reference_outputs)
+    for output, reference_output in zip(outputs, reference_outputs):
+        difference = (output - reference_output).abs().max() / reference_output.abs().max()
+        assert difference <= RTOL
+
+
+@pytest.mark.parametrize("kv_cache_storage", ["full", "single_copy", "paged"])
+@pytest.mark.parametrize("sink_size", [0, 3])
+@pytest.mark.parametrize("generate", [generate_video, generate_endless])
+def test_remapped_rope_matches_a_larger_table(kv_cache_storage, sink_size, generate):
+    reference_outputs, reference_offsets = attention_outputs(
+        None, generate, kv_cache_storage=kv_cache_storage, sink_size=sink_size)
+    outputs, rope_offsets = attention_outputs(
+        NUM_TABLE_FRAMES, generate, kv_cache_storage=kv_cache_storage, sink_size=sink_size)
+
+    if rope_offsets is not None:
+        # remapped twice by half the table, never with the whole table
+        assert rope_offsets == [NUM_TABLE_FRAMES] * len(rope_offsets)
+        assert reference_offsets == [0] * len(reference_offsets)
+    assert_same_attention(outputs, reference_outputs)
+
+
+@pytest.mark.parametrize("shift", [3, 40, 1000])
+def test_rope_shift_back_undoes_shift(shift):
+    model = make_pipeline().generator.model
+    freqs, table = model.freqs[:NUM_TABLE_FRAMES], model.freqs
+    grid_sizes = torch.tensor([[2, LATENT_HEIGHT // 2, LATENT_WIDTH // 2]])
+    x = torch.randn(1, 2 * FRAME_SEQ_LENGTH, 12, 128, generator=torch.Generator().manual_seed(0))
+
+    # shifting forward needs the positions in the table, shifting back only the per-frame frequencies
+    shifted = causal_rope_shift(x, table, FRAME_SEQ_LENGTH, shift)
+    torch.testing.assert_close(causal_rope_shift(shifted, freqs, FRAME_SEQ_LENGTH, -shift), x)
+
+    # roped at shift + 1 and moved back by shift is roped at 1
+    roped = causal_rope_apply(x, grid_sizes, table, start_frame=shift + 1)
+    torch.testing.assert_close(
+        causal_rope_shift(roped, freqs, FRAME_SEQ_LENGTH, -shift),
+        causal_rope_apply(x, grid_sizes, freqs, start_frame=1))
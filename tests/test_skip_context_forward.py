@@ -0,0 +1,62 @@
+import pytest
+import torch
+
+from utils.tiny_models import make_noise, make_pipeline
+
+# 5 blocks of 3 frames, past the 9-frame window so that Rolling Sink re-inserts frames the next blocks attend to
+# (with a 6-frame window and 3 sink frames it only re-inserts the sink)
+NUM_FRAMES = 15
+# largest relative RMS difference to the context forward. The last denoising step has a sigma of 5e-3, the context
+# forward sees frames moved by it: the caches stay within 1e-2 while skipping Rolling Sink after the committed step
+# is off by more than 1e-1
+RTOL = 2e-2
+
+
+def assert_close(value, reference):
+    assert ((value.float() - reference.float()).norm() / reference.float().norm()).item() <= RTOL
+
+
+def generate(**config):
+    torch.set_grad_enabled(False)
+    pipeline = make_pipeline(local_attn_size=9, sink_size=3, **config)
+    # inference draws the noise of the denoising steps from the global RNG
+    torch.manual_seed(0)
+    _, latents, state = pipeline.inference(
+        make_noise(1, NUM_FRAMES), ["a prompt"], return_latents=True, return_state=True)
+    return pipeline, latents, pipeline.snapshot(state)["kv_cache"]
+
+
+@pytest.mark.parametrize("kv_cache_storage", ["full", "single_copy", "paged"])
+def test_committed_kv_cache_is_the_one_of_the_context_forward(kv_cache_storage):
+    # the last denoising step at the smallest timestep of the scheduler sees (almost) the clean frames of the
+    # context forward: committing its keys/values has to leave the cache the context forward leaves. It is not
+    # timestep 0, only the commit triggers Rolling Sink after it
+    config = dict(kv_cache_storage=kv_cache_storage, denoising_step_list=[1000, 750, 500, 1])
+    _, reference_latents, reference_kv_cache = generate(**config)
+    pipeline, latents, kv_cache = generate(skip_context_forward=True, **config)
+    assert 0 < pipeline.denoising_step_list[-1] < 5 and pipeline.args.context_noise == 0
+
+    assert_close(latents, reference_latents)
+    for entries, reference_entries in zip(kv_cache, reference_kv_cache):
+        assert entries.keys() == reference_entries.keys()
+        for name, value in entries.items():
+            if torch.is_tensor(value):
+                assert_close(value, reference_entries[name])
+            else:
+                assert value == reference_entries[name], name
+
+
+def test_skipping_the_context_forward_saves_a_generator_call_per_block():
+    torch.set_grad_enabled(False)
+    calls = {}
+    for skip_context_forward in (False, True):
+        pipeline = make_pipeline(skip_context_forward=skip_context_forward)
+        timesteps = []
+        pipeline.generator.register_forward_pre_hook(
+            lambda module, args, kwargs: timesteps.append(int(kwargs["timestep"][0, 0])), with_kwargs=True)
+        pipeline.inference(make_noise(1, NUM_FRAMES), ["a prompt"])
+        calls[skip_context_forward] = timesteps
+
+    steps = [int(step) for step in pipeline.denoising_step_list]
+    assert calls[False] == (steps + [0]) * (NUM_FRAMES // 3)
+    assert calls[True] == steps * (NUM_FRAMES // 3)
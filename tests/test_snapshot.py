@@ -0,0 +1,71 @@
+import pytest
+import torch
+
+from utils.tiny_models import make_noise, make_pipeline
+
+# 2 blocks before the snapshot, 3 after it, past the 6-frame window
+NUM_FRAMES, SNAPSHOT_FRAME = 15, 6
+
+
+def pool_pages(pipeline, page_table):
+    return [buffer[page_table.tensor].clone() for layer in pipeline.kv_cache_pool.layers for buffer in layer.values()]
+
+
+def make(kv_cache_storage):
+    torch.set_grad_enabled(False)
+    # room for the pages of two streams and of the copies made on write
+    return make_pipeline(local_attn_size=6, sink_size=3, kv_cache_storage=kv_cache_storage, kv_cache_num_pages=48)
+
+
+@pytest.mark.parametrize("kv_cache_storage", ["full", "single_copy", "paged"])
+@pytest.mark.parametrize("to_path", [False, True])
+def test_restored_state_continues_the_uninterrupted_generation(tmp_path, kv_cache_storage, to_path):
+    pipeline = make(kv_cache_storage)
+    noise = make_noise(1, NUM_FRAMES)
+    # inference draws the noise of the denoising steps from the global RNG, the snapshot holds its state
+    torch.manual_seed(0)
+    _, expected = pipeline.inference(noise, ["a prompt"], return_latents=True)
+
+    torch.manual_seed(0)
+    _, state = pipeline.inference(noise[:, :SNAPSHOT_FRAME], ["a prompt"], return_state=True)
+    snapshot = pipeline.snapshot(state, str(tmp_path / "state.pt") if to_path else None)
+    # another continuation overwrites the KV cache and advances the RNG
+    pipeline.inference(make_noise(1, 6, seed=2), ["another prompt"], state=state)
+    pipeline.release(state)
+
+    state = pipeline.restore(snapshot)
+    _, latents = pipeline.inference(noise[:, SNAPSHOT_FRAME:], ["a prompt"], state=state, return_latents=True)
+    pipeline.release(state)
+
+    assert torch.equal(latents, expected[:, SNAPSHOT_FRAME:])
+
+
+def test_fork_does_not_change_the_pages_of_its_parent():
+    pipeline = make("paged")
+    noise = make_noise(1, NUM_FRAMES)
+    torch.manual_seed(0)
+    _, expected = pipeline.inference(noise, ["a prompt"], return_latents=True)
+
+    torch.manual_seed(0)
+    _, state = pipeline.inference(noise[:, :SNAPSHOT_FRAME], ["a prompt"], return_state=True)
+    rng_state = torch.get_rng_state()
+    page_tables = state["kv_cache"][0]["page_tables"]
+    pages = {name: [list(row) for row in page_tables[name].pages] for name in ("k", "k_original")}
+    contents = {name: pool_pages(pipeline, page_tables[name]) for name in pages}
+
+    fork, = pipeline.fork(state, 1)
+    assert fork["kv_cache"][0]["page_tables"]["k"].pages == pages["k"]
+    # the fork overwrites its window with another continuation, through copies of the shared pages
+    pipeline.inference(make_noise(1, 9, seed=2), ["another prompt"], state=fork)
+
+    assert fork["kv_cache"][0]["page_tables"]["k"].pages != pages["k"]
+    for name in pages:
+        assert page_tables[name].pages == pages[name]
+        assert all(map(torch.equal, pool_pages(pipeline, page_tables[name]), contents[name]))
+    pipeline.release(fork)
+
+    torch.set_rng_state(rng_state)
+    _, latents = pipeline.inference(noise[:, SNAPSHOT_FRAME:], ["a prompt"], state=state, return_latents=True)
+    pipeline.release(state)
+
+    assert torch.equal(latents, expected[:, SNAPSHOT_FRAME:])
@@ -0,0 +1,45 @@
+import pytest
+import torch
+
+from utils.tiny_models import make_vae
+
+SCALE = [torch.zeros(16), torch.ones(16)]
+# latent frames of 16 x 24 pixels
+LATENT_SIZE = (16, 24)
+# largest difference to the untiled decode, relative to its norm, of tiles of 16 latent pixels overlapping by 8.
+# The attention block in the middle of the decoder sees the whole frame and a tile only its part of it, the
+# difference stays within 7e-2 on the random weights of the tiny VAE
+RTOL = 1e-1
+
+
+@pytest.fixture(scope="module")
+def decoded():
+    torch.set_grad_enabled(False)
+    model = make_vae().model
+    latent = torch.randn(1, 16, 3, *LATENT_SIZE, generator=torch.Generator().manual_seed(0))
+    return model, latent, model.decode(latent, SCALE)
+
+
+def relative_difference(video, reference):
+    return ((video - reference).norm() / reference.norm()).item()
+
+
+@pytest.mark.parametrize("tile_size, tile_overlap", [(24, 0), (24, 8), (32, 4)])
+def test_a_tile_as_large_as_the_frame_is_the_untiled_decode(decoded, tile_size, tile_overlap):
+    model, latent, video = decoded
+
+    assert torch.equal(model.decode(latent, SCALE, tile_size=tile_size, tile_overlap=tile_overlap), video)
+
+
+def test_overlapping_tiles_stay_close_to_the_untiled_decode(decoded):
+    model, latent, video = decoded
+
+    def tiled(tile_size, tile_overlap):
+        tiled_video = model.decode(latent, SCALE, tile_size=tile_size, tile_overlap=tile_overlap)
+        assert tiled_video.shape == video.shape
+        return relative_difference(tiled_video, video)
+
+    assert tiled(16, 8) <= RTOL
+    # a wider overlap blends the seams over more pixels, larger tiles see more of the frame
+    assert tiled(8, 4) < tiled(8, 2) < tiled(8, 0)
+    assert tiled(16, 8) < tiled(12, 6) < tiled(8, 4)
@@ -0,0 +1,59 @@
+import pytest
+import torch
+
+from utils.tiny_models import LATENT_HEIGHT, LATENT_WIDTH, make_vae
+
+SCALE = [torch.zeros(16), torch.ones(16)]
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.set_grad_enabled(False)
+    return make_vae().model
+
+
+def random(*shape):
+    return torch.randn(*shape, generator=torch.Generator().manual_seed(0))
+
+
+@pytest.mark.parametrize("chunk_sizes", [[1] * 8, [3, 5], [1, 4, 2, 1]])
+def test_chunked_cached_decode_is_the_decode_of_the_whole_clip(model, chunk_sizes):
+    latent = random(1, 16, 8, LATENT_HEIGHT, LATENT_WIDTH)
+    video = model.decode(latent, SCALE)
+
+    feat_cache = model.new_decode_cache()
+    chunks = [model.cached_decode(chunk, SCALE, feat_cache=feat_cache)
+              for chunk in latent.split(chunk_sizes, dim=2)]
+
+    assert torch.equal(torch.cat(chunks, dim=2), video)
+
+
+@pytest.mark.parametrize("chunk_sizes", [[1, 4, 4, 4], [5, 8], [9, 4]])
+def test_chunked_cached_encode_is_the_encode_of_the_whole_clip(model, chunk_sizes):
+    # a new cache encodes the first frame on its own, then 4 frames at a time
+    pixel = random(1, 3, 13, 8 * LATENT_HEIGHT, 8 * LATENT_WIDTH)
+    latent = model.encode(pixel, SCALE)
+
+    feat_cache = model.new_encode_cache()
+    chunks = [model.cached_encode(chunk, SCALE, feat_cache=feat_cache)
+              for chunk in pixel.split(chunk_sizes, dim=2)]
+
+    assert latent.shape[2] == 4
+    assert torch.equal(torch.cat(chunks, dim=2), latent)
+
+
+def test_steady_state_decode_allocates_no_cache_buffers(model):
+    latent = random(1, 16, 6, LATENT_HEIGHT, LATENT_WIDTH)
+    feat_cache = model.new_decode_cache()
+    # the first latent frame decodes to 1 frame, the next ones to 4 and size the buffers of the cache
+    for i in range(2):
+        model.cached_decode(latent[:, :, i:i + 1], SCALE, feat_cache=feat_cache)
+    scratch = feat_cache.scratch
+    frames = {conv: buffer.data_ptr() for conv, buffer in feat_cache.frames.items()}
+
+    for i in range(2, latent.shape[2]):
+        model.cached_decode(latent[:, :, i:i + 1], SCALE, feat_cache=feat_cache)
+
+    # the same scratch buffer, and every cached conv still overwrites its frames in place
+    assert feat_cache.scratch is scratch
+    assert {conv: buffer.data_ptr() for conv, buffer in feat_cache.frames.items()} == frames
@@ -0,0 +1,126 @@
+import threading
+
+import torch
+
+
+class KVCachePagePool:
+    """
+    A fixed budget of KV cache pages shared by concurrent generation streams.
+
+    Every page holds the keys/values of one latent frame of one sample in every transformer block,
+    `layers[i][name]` being a tensor of shape [num_pages, frame_seq_length, ...]. Streams take pages
+    with `allocate` and map their frames to them through their own page tables, so streams with
+    different batch sizes and lengths share the same memory instead of each owning a full cache.
+    Pages are reference counted, forked streams share them until one of them writes.
+    """
+
+    def __init__(self, layers):
+        self.layers = layers
+        self.num_pages = next(iter(layers[0].values())).shape[0]
+        self.free_pages = list(range(self.num_pages))
+        self.ref_counts = [0] * self.num_pages
+        self.condition = threading.Condition()
+
+    def allocate(self, num_pages, timeout=None):
+        """
+        Take `num_pages` pages from the pool, waiting until other streams release enough of them, for at most
+        `timeout` seconds (None waits for ever). The free pages are kept sorted, so the pages of a stream are
+        consecutive unless the pool is fragmented.
+        """
+        if num_pages > self.num_pages:
+            raise ValueError(
+                f"A stream needs {num_pages} KV cache pages but the pool only has {self.num_pages}, "
+                f"increase kv_cache_num_pages")
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.free_pages) >= num_pages, timeout=timeout):
+                raise TimeoutError(
+                    f"A stream waited {timeout} s for {num_pages} KV cache pages, only {len(self.free_pages)} "
+                    f"of {self.num_pages} were released by the other streams, increase kv_cache_num_pages "
+                    f"or kv_cache_page_timeout")
+            pages = self.free_pages[:num_pages]
+            del self.free_pages[:num_pages]
+            for page in pages:
+                self.ref_counts[page] = 1
+        return pages
+
+    def share(self, pages):
+        with self.condition:
+            for page in pages:
+                self.ref_counts[page] += 1
+
+    def release(self, pages):
+        with self.condition:
+            for page in pages:
+                self.ref_counts[page] -= 1
+                if self.ref_counts[page] == 0:
+                    self.free_pages.append(page)
+            self.free_pages.sort()
+            self.condition.notify_all()
+
+    def copy_on_write(self, page):
+        """
+        Return `page` if the caller is its only user, otherwise a private copy of it.
+        """
+        if self.ref_counts[page] == 1:
+            return page
+        with self.condition:
+            if not self.free_pages:
+                raise RuntimeError("The KV cache pool ran out of pages for copy-on-write, increase kv_cache_num_pages")
+            new_page = self.free_pages.pop(0)
+            self.ref_counts[new_page] = 1
+        for layer in self.layers:
+            for buffer in layer.values():
+                buffer[new_page] = buffer[page]
+        self.release([page])
+        return new_page
+
+
+class KVCachePageTable:
+    """
+    The pages of one stream, `pages[b][i]` holding frame slot i of sample b.
+    `tensor` is the same table on the device, used to gather and scatter the pool buffers.
+    """
+
+    def __init__(self, pool, pages, device):
+        self.pool = pool
+        self.pages = pages
+        self.device = device
+        self.tensor = torch.tensor(pages, dtype=torch.long, device=device)
+        # (start, end) -> result of `strided_pages`, computed on the host once per table
+        self.strides = {}
+
+    def strided_pages(self, start, end):
+        """
+        The first page and the page stride between samples if the slots [start, end) of every sample are
+        consecutive pages, the samples spaced evenly (the pages of one `allocate`), otherwise None.
+        """
+        if (start, end) not in self.strides:
+            first_page = self.pages[0][start]
+            sample_stride = self.pages[1][start] - first_page if len(self.pages) > 1 else 0
+            strided = sample_stride >= 0 and all(
+                row[i] == first_page + b * sample_stride + i - start
+                for b, row in enumerate(self.pages) for i in range(start, end))
+            self.strides[start, end] = (first_page, sample_stride) if strided else None
+        return self.strides[start, end]
+
+    def writable(self, start, end):
+        """
+        Page ids of the slots [start, end) of every sample, copying the pages shared with other streams first.
+        """
+        changed = False
+        for row in self.pages:
+            for i in range(start, end):
+                page = self.pool.copy_on_write(row[i])
+                changed = changed or page != row[i]
+                row[i] = page
+        if changed:
+            self.tensor = torch.tensor(self.pages, dtype=torch.long, device=self.device)
+            self.strides = {}
+        return self.tensor[:, start:end]
+
+    def fork(self):
+        self.pool.share([page for row in self.pages for page in row])
+        return KVCachePageTable(self.pool, [list(row) for row in self.pages], self.device)
+
+    def release(self):
+        self.pool.release([page for row in self.pages for page in row])
@@ -1,3 +1,4 @@
+import contextlib
 import numpy as np
 import random
 import torch
@@ -37,3 +38,27 @@ def merge_dict_list(dict_list):
             # for non-tensor values, we just copy the value from the first item
             merged_dict[k] = v
     return merged_dict
+
+
+@contextlib.contextmanager
+def cpu_fallbacks():
+    """
+    Run the models on a machine without CUDA or flash-attn, for the tests and benchmarks: the current CUDA device
+    the modules of `wan` ask for when they are imported is 0 and the attention of `wan.modules.model` falls back
+    to scaled dot product attention. Both are restored on exit, import `wan` inside the context.
+    """
+    current_device = torch.cuda.current_device
+    if not torch.cuda.is_available():
+        torch.cuda.current_device = lambda: 0
+    try:
+        import wan.modules.attention as attention
+        import wan.modules.model as model
+        flash_attention = model.flash_attention
+        if not (attention.FLASH_ATTN_2_AVAILABLE or attention.FLASH_ATTN_3_AVAILABLE):
+            model.flash_attention = lambda q, k, v, k_lens=None, **kwargs: attention.attention(q, k, v)
+        try:
+            yield
+        finally:
+            model.flash_attention = flash_attention
+    finally:
+        torch.cuda.current_device = current_device
@@ -0,0 +1,60 @@
+import hashlib
+import struct
+
+import torch
+
+
+def noise_seed(*key):
+    """
+    A 63-bit seed derived from the integers of `key`.
+    It is the counter of the counter-based generator: every key draws its own, independent noise.
+    """
+    digest = hashlib.blake2b(struct.pack(f"<{len(key)}q", *key), digest_size=8).digest()
+    return int.from_bytes(digest, "little") >> 1
+
+
+class SeekableNoise:
+    """
+    Gaussian noise of a batch of videos, generated on demand and addressed by (seed, sample, frame, step).
+
+    Nothing is materialized ahead of time, any block of any sample can be drawn in any order, so a generation
+    is reproduced exactly when it is resumed, batched differently or sharded across processes as long as the
+    samples keep their global indices. Step 0 is the initial noise of a frame, step k the noise added back
+    after its k-th denoising step. With `period`, the initial noise of frame f is the one of frame f % period
+    (one block of noise repeated over the video).
+    A SeekableNoise is called with the same arguments as the noise function of `CausalInferencePipeline`.
+    """
+
+    def __init__(self, seed, samples, shape, device, dtype=torch.float32, period=None, start_frame=0):
+        self.seed = seed
+        # global indices of the samples of the batch
+        self.samples = list(samples)
+        # [num_channels, height, width] of a latent frame
+        self.shape = tuple(shape)
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.period = period
+        self.start_frame = start_frame
+        self.generator = torch.Generator(device=self.device)
+
+    def seek(self, start_frame):
+        """
+        The same noise with its frame 0 at frame `start_frame` of this one, to continue a generation.
+        """
+        return SeekableNoise(self.seed, self.samples, self.shape, self.device, self.dtype, self.period,
+                             self.start_frame + start_frame)
+
+    def __call__(self, start_frame, num_frames, step=0):
+        """
+        Noise of the frames [start_frame, start_frame + num_frames), of shape [batch_size, num_frames, *shape].
+        """
+        noise = torch.empty([len(self.samples), num_frames, *self.shape], device=self.device, dtype=self.dtype)
+        for i, sample in enumerate(self.samples):
+            for j in range(num_frames):
+                frame = self.start_frame + start_frame + j
+                if step == 0 and self.period is not None:
+                    frame %= self.period
+                self.generator.manual_seed(noise_seed(self.seed, sample, frame, step))
+                noise[i, j] = torch.randn(
+                    self.shape, generator=self.generator, device=self.device, dtype=self.dtype)
+        return noise
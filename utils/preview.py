@@ -0,0 +1,62 @@
+import torch
+import torch.nn.functional as F
+
+
+class LatentPreviewer:
+    """
+    Cheap RGB preview of Wan latents, without the VAE decoder: every latent pixel is mapped to the mean color of
+    the 8x8 pixels (and 4 frames) it decodes to by a linear projection of its 16 channels, fitted against videos
+    decoded by the VAE with `fit` (see calibrate_latent_preview.py).
+    A preview is one [16, 3] matmul per latent pixel, nothing next to a denoising step.
+    """
+
+    def __init__(self, weight: torch.Tensor, bias: torch.Tensor):
+        # [num_channels, 3] and [3]
+        self.weight = weight
+        self.bias = bias
+
+    def __call__(self, latents: torch.Tensor) -> torch.Tensor:
+        """
+        Preview frames of latents (batch_size, num_frames, num_channels, height, width): one frame per latent
+        frame, at the latent resolution, of shape (batch_size, num_frames, 3, height, width) in the range [0, 1].
+        """
+        weight = self.weight.to(device=latents.device, dtype=torch.float32)
+        bias = self.bias.to(device=latents.device, dtype=torch.float32)
+        rgb = torch.einsum("btchw,cd->btdhw", latents.float(), weight) + bias.view(1, 1, 3, 1, 1)
+        return rgb.clamp_(0, 1)
+
+    @staticmethod
+    def targets(latents: torch.Tensor, video: torch.Tensor) -> torch.Tensor:
+        """
+        The colors a preview of latents (batch_size, num_latent_frames, num_channels, height, width) should have:
+        the video they decode to (batch_size, num_frames, 3, height * 8, width * 8) in the range [0, 1], averaged
+        over the pixels and frames of every latent pixel.
+        """
+        batch_size, num_latent_frames, _, height, width = latents.shape
+        video = video.to(latents.device, torch.float32)
+        # the first latent frame decodes to 1 frame, every following one to 4 frames
+        targets = [video[:, :1]] + [
+            video[:, 1 + 4 * i:5 + 4 * i].mean(dim=1, keepdim=True) for i in range(num_latent_frames - 1)]
+        targets = F.adaptive_avg_pool2d(torch.cat(targets, dim=1).flatten(0, 1), (height, width))
+        return targets.view(batch_size, num_latent_frames, 3, height, width)
+
+    @classmethod
+    def fit(cls, latents: torch.Tensor, targets: torch.Tensor) -> "LatentPreviewer":
+        """
+        The least-squares projection from latents (batch_size, num_frames, num_channels, height, width) to their
+        `targets` (batch_size, num_frames, 3, height, width).
+        """
+        num_channels = latents.shape[2]
+        inputs = latents.float().permute(0, 1, 3, 4, 2).reshape(-1, num_channels)
+        inputs = torch.cat([inputs, torch.ones_like(inputs[:, :1])], dim=1)
+        targets = targets.float().permute(0, 1, 3, 4, 2).reshape(-1, 3)
+        solution = torch.linalg.lstsq(inputs.cpu(), targets.cpu()).solution
+        return cls(solution[:-1], solution[-1])
+
+    def save(self, path: str):
+        torch.save({"weight": self.weight.cpu(), "bias": self.bias.cpu()}, path)
+
+    @classmethod
+    def load(cls, path: str) -> "LatentPreviewer":
+        state = torch.load(path, map_location="cpu", weights_only=True)
+        return cls(state["weight"], state["bias"])
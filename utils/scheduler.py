@@ -192,3 +192,60 @@ class FlowMatchScheduler():
             (self.timesteps.unsqueeze(1) - timestep.unsqueeze(0)).abs(), dim=0)
         weights = self.linear_timesteps_weights[timestep_id]
         return weights
+
+
+class FewStepSampler():
+    """
+    The flow matching conversions of a few-step sampler with the sigma of every timestep resolved once.
+
+    `WanDiffusionWrapper._convert_flow_pred_to_x0` and `FlowMatchScheduler.add_noise` look the sigma of every
+    call up in the 1000-entry scheduler tables (an argmin on the device, after moving the tables there).
+    A sampler only ever sees the timesteps of its denoising step list, their sigmas are host scalars and the
+    conversions are plain elementwise ops computed in float32, with no table lookup or device transfer.
+    """
+
+    def __init__(self, scheduler, timesteps):
+        self.scheduler = scheduler
+        self.sigmas = {}
+        for timestep in timesteps:
+            self.sigma(timestep)
+
+    def sigma(self, timestep):
+        """
+        Sigma of the scheduler timestep closest to `timestep`, as a Python float.
+        """
+        timestep = float(timestep)
+        if timestep not in self.sigmas:
+            timestep_id = torch.argmin((self.scheduler.timesteps.double() - timestep).abs())
+            self.sigmas[timestep] = self.scheduler.sigmas[timestep_id].item()
+        return self.sigmas[timestep]
+
+    def _frame_sigmas(self, timestep, x):
+        """
+        The sigma of a [B, F] host timestep tensor, a float when all frames share it, else a float32
+        tensor of shape [1, F, 1, 1, 1] on the device of x (the samples of a batch share their timesteps).
+        """
+        if timestep.ndim == 0 or (timestep == timestep.flatten()[0]).all():
+            return self.sigma(timestep.flatten()[0])
+        sigmas = [self.sigma(t) for t in timestep[0].tolist()]
+        return torch.tensor(sigmas, dtype=torch.float32).view(1, -1, 1, 1, 1).to(x.device, non_blocking=True)
+
+    def convert_flow_pred_to_x0(self, flow_pred, xt, timestep):
+        """
+        x0 = x_t - sigma_t * flow_pred, of shape [B, F, C, H, W] like flow_pred and xt.
+        """
+        sigma = self._frame_sigmas(timestep, xt)
+        # float32 inputs, a reduced precision add may round sigma to the dtype of the tensors
+        if isinstance(sigma, float):
+            return torch.add(xt.float(), flow_pred.float(), alpha=-sigma).type_as(xt)
+        return torch.addcmul(xt.float(), flow_pred.float(), sigma, value=-1).type_as(xt)
+
+    def add_noise(self, x0, noise, timestep):
+        """
+        x_t = (1 - sigma_t) * x0 + sigma_t * noise, with `timestep` a scalar or a [B, F] host tensor.
+        """
+        sigma = self._frame_sigmas(torch.as_tensor(timestep), x0)
+        if isinstance(sigma, float):
+            # a single kernel, lerp computes in float32 for reduced precision inputs
+            return torch.lerp(x0, noise, sigma)
+        return torch.lerp(x0.float(), noise.float(), sigma).type_as(noise)
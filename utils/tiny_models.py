@@ -0,0 +1,88 @@
+"""
+Tiny random-weight models and pipelines for the tests and benchmarks: the architecture of Wan 1.3B (dim 1536,
+12 heads) with 2 layers and a narrow FFN by default, an 8-channel-wide VAE and a text encoder that maps a prompt
+to fixed random embeddings.
+The models are imported when they are built: without CUDA or flash-attn, build and run them inside
+`utils.misc.cpu_fallbacks`.
+"""
+import zlib
+
+import torch
+from omegaconf import OmegaConf
+
+# latent size of the tiny pipelines, 4x4 = 16 tokens per frame after patchifying
+LATENT_HEIGHT, LATENT_WIDTH = 8, 8
+FRAME_SEQ_LENGTH = LATENT_HEIGHT // 2 * LATENT_WIDTH // 2
+
+
+def make_generator(num_layers=2, seed=0, local_attn_size=21, sink_size=0, max_attention_frames=21, ffn_dim=256,
+                   frame_seq_length=FRAME_SEQ_LENGTH):
+    from utils.scheduler import FlowMatchScheduler
+    from utils.wan_wrapper import WanDiffusionWrapper
+    from wan.modules.causal_model import CausalWanModel
+
+    torch.manual_seed(seed)
+    generator = WanDiffusionWrapper.__new__(WanDiffusionWrapper)
+    torch.nn.Module.__init__(generator)
+    generator.model = CausalWanModel(
+        dim=1536, ffn_dim=ffn_dim, num_heads=12, num_layers=num_layers, text_dim=64, freq_dim=64,
+        local_attn_size=local_attn_size, sink_size=sink_size).eval()
+    torch.nn.init.normal_(generator.model.head.head.weight, std=0.05)
+    for block in generator.model.blocks:
+        # sharpen the attention so that the positions of the keys matter
+        block.self_attn.q.weight.data *= 8
+        block.self_attn.k.weight.data *= 8
+        block.self_attn.max_attention_size = (
+            max_attention_frames if local_attn_size == -1 else local_attn_size) * frame_seq_length
+    generator.uniform_timestep = False
+    generator.scheduler = FlowMatchScheduler(shift=5.0, sigma_min=0.0, extra_one_step=True)
+    generator.scheduler.set_timesteps(1000, training=True)
+    generator.seq_len = 32760
+    generator.post_init()
+    return generator
+
+
+class TextEncoder(torch.nn.Module):
+    def forward(self, text_prompts):
+        generator = torch.Generator().manual_seed(zlib.crc32("\n".join(text_prompts).encode()))
+        return {"prompt_embeds": torch.randn(len(text_prompts), 8, 64, generator=generator).bfloat16()}
+
+
+def make_vae(seed=0):
+    from utils.wan_wrapper import WanVAEWrapper
+    from wan.modules.vae import WanVAE_
+
+    torch.manual_seed(seed)
+    vae = WanVAEWrapper.__new__(WanVAEWrapper)
+    torch.nn.Module.__init__(vae)
+    vae.mean = torch.zeros(16)
+    vae.std = torch.ones(16)
+    vae.replicas = {}
+    vae.model = WanVAE_(dim=8, z_dim=16, dim_mult=[1, 2, 2, 2], num_res_blocks=1, attn_scales=[],
+                        temperal_downsample=[False, True, True]).eval()
+    return vae
+
+
+def make_pipeline(num_layers=2, seed=0, ffn_dim=256, local_attn_size=21, sink_size=0,
+                  frame_seq_length=FRAME_SEQ_LENGTH, **config):
+    """
+    Pipeline of the self forcing config with the tiny models, `config` overrides keys of the config.
+    The attention window and sink of the generator are arguments of the model, not of the config.
+    `frame_seq_length` is the number of tokens of the latents the pipeline is run on, a quarter of their pixels.
+    """
+    from pipeline import CausalInferencePipeline
+
+    args = OmegaConf.merge(OmegaConf.load("configs/default_config.yaml"),
+                           OmegaConf.load("configs/self_forcing_dmd.yaml"), config)
+    generator = make_generator(num_layers, seed, local_attn_size=local_attn_size, sink_size=sink_size, ffn_dim=ffn_dim,
+                               frame_seq_length=frame_seq_length)
+    pipeline = CausalInferencePipeline(
+        args, device="cpu", generator=generator, text_encoder=TextEncoder(), vae=make_vae(seed))
+    pipeline.num_transformer_blocks = num_layers
+    pipeline.frame_seq_length = frame_seq_length
+    return pipeline.to(torch.bfloat16)
+
+
+def make_noise(batch_size, num_frames, seed=1):
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(batch_size, num_frames, 16, LATENT_HEIGHT, LATENT_WIDTH, generator=generator).bfloat16()
@@ -0,0 +1,38 @@
+import av
+import torch
+
+
+class VideoWriter:
+    """
+    Write an H.264 video block by block, so that a long video is never held in memory.
+    Encodes like `torchvision.io.write_video` (libx264, yuv420p).
+    """
+
+    def __init__(self, path, fps=16):
+        self.container = av.open(path, mode="w")
+        self.stream = self.container.add_stream("libx264", rate=fps)
+        self.stream.pix_fmt = "yuv420p"
+        self.num_frames = 0
+
+    def write(self, frames: torch.Tensor):
+        """
+        Append frames of shape [T, H, W, C], uint8 or float in [0, 255].
+        """
+        frames = frames.to("cpu", torch.uint8).numpy()
+        if self.num_frames == 0:
+            self.stream.height, self.stream.width = frames.shape[1:3]
+        for frame in frames:
+            frame = av.VideoFrame.from_ndarray(frame, format="rgb24")
+            self.container.mux(self.stream.encode(frame))
+        self.num_frames += len(frames)
+
+    def close(self):
+        # flush the frames buffered by the encoder
+        self.container.mux(self.stream.encode())
+        self.container.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,12 +1,15 @@
+import copy
+import queue
+import threading
 import types
-from typing import List, Optional
+from typing import Callable, List, Optional, Sequence, Union
 import torch
 from torch import nn
 
-from utils.scheduler import SchedulerInterface, FlowMatchScheduler
+from utils.scheduler import SchedulerInterface, FlowMatchScheduler, FewStepSampler
 from wan.modules.tokenizers import HuggingfaceTokenizer
 from wan.modules.model import WanModel, RegisterTokens, GanAttentionBlock
-from wan.modules.vae import _video_vae
+from wan.modules.vae import CausalConvCache, _video_vae
 from wan.modules.t5 import umt5_xxl
 from wan.modules.causal_model import CausalWanModel
 
@@ -69,28 +72,52 @@ class WanVAEWrapper(torch.nn.Module):
             pretrained_path="wan_models/Wan2.1-T2V-1.3B/Wan2.1_VAE.pth",
             z_dim=16,
         ).eval().requires_grad_(False)
+        # copies of the model on the other devices of `parallel_decode_to_pixel`
+        self.replicas = {}
 
-    def encode_to_latent(self, pixel: torch.Tensor) -> torch.Tensor:
+    def encode_to_latent(self, pixel: torch.Tensor, batch_size: Optional[int] = None, use_cache: bool = False,
+                         feat_cache: Optional[List[CausalConvCache]] = None) -> torch.Tensor:
         # pixel: [batch_size, num_channels, num_frames, height, width]
+        # The samples are encoded together, `batch_size` at a time (all of them by default) to bound the memory.
+        # With `use_cache`, `pixel` continues the videos of the cache: the module one, or `feat_cache`,
+        # one `new_encode_cache` per group of `batch_size` samples. A long video streamed in chunks of frames
+        # is encoded at constant memory, see `WanVAE_.cached_encode`
+        if batch_size is None:
+            batch_size = pixel.shape[0]
+        if use_cache and feat_cache is None:
+            assert pixel.shape[0] <= batch_size, "All the samples must be encoded together when using the module cache"
+
         device, dtype = pixel.device, pixel.dtype
         scale = [self.mean.to(device=device, dtype=dtype),
                  1.0 / self.std.to(device=device, dtype=dtype)]
 
-        output = [
-            self.model.encode(u.unsqueeze(0), scale).float().squeeze(0)
-            for u in pixel
-        ]
-        output = torch.stack(output, dim=0)
-        # from [batch_size, num_channels, num_frames, height, width]
-        # to [batch_size, num_frames, num_channels, height, width]
-        output = output.permute(0, 2, 1, 3, 4)
+        if use_cache:
+            encode_function = self.model.cached_encode
+        else:
+            encode_function = self.model.encode
+
+        output = None
+        for group, start in enumerate(range(0, pixel.shape[0], batch_size)):
+            kwargs = {"feat_cache": feat_cache[group]} if use_cache and feat_cache is not None else {}
+            # [batch_size, num_channels, num_frames, height, width]
+            latent = encode_function(pixel[start:start + batch_size], scale, **kwargs)
+            if output is None:
+                output = torch.empty([pixel.shape[0], latent.shape[2], latent.shape[1], *latent.shape[3:]],
+                                     dtype=torch.float32, device=device)
+            # to [batch_size, num_frames, num_channels, height, width]
+            output[start:start + batch_size] = latent.transpose(1, 2)
         return output
 
-    def decode_to_pixel(self, latent: torch.Tensor, use_cache: bool = False, return_in_cpu: bool = False) -> torch.Tensor:
+    def decode_to_pixel(self, latent: torch.Tensor, use_cache: bool = False, return_in_cpu: bool = False,
+                        feat_cache: Optional[List[CausalConvCache]] = None,
+                        sink: Optional[Callable[[int, torch.Tensor], None]] = None,
+                        uint8: bool = False, tile_size: Optional[int] = None,
+                        tile_overlap: int = 0) -> Optional[torch.Tensor]:
         # from [batch_size, num_frames, num_channels, height, width]
         # to [batch_size, num_channels, num_frames, height, width]
         zs = latent.permute(0, 2, 1, 3, 4)
-        if use_cache:
+        # feat_cache: one `new_decode_cache` per sample, decoded chunk by chunk instead of with the module cache
+        if use_cache and feat_cache is None:
             assert latent.shape[0] == 1, "Batch size must be 1 when using cache"
 
         device, dtype = latent.device, latent.dtype
@@ -102,15 +129,127 @@ class WanVAEWrapper(torch.nn.Module):
         else:
             decode_function = self.model.decode
 
-        output = []
-        for u in zs:
-            output.append(decode_function(u.unsqueeze(0), scale, return_in_cpu=return_in_cpu).float().clamp_(-1, 1).squeeze(0))
-        output = torch.stack(output, dim=0)
-        # from [batch_size, num_channels, num_frames, height, width]
-        # to [batch_size, num_frames, num_channels, height, width]
-        output = output.permute(0, 2, 1, 3, 4)
+        # Every chunk of frames is clamped to [-1, 1] (with `uint8`, mapped to [0, 255] as
+        # `(255 * (x * 0.5 + 0.5)).to(torch.uint8)`) as soon as it is decoded, then written into the output,
+        # preallocated in the final layout, or handed to `sink(sample_index, frames)` without keeping it
+        # (frames: [num_frames, num_channels, height, width], None is returned).
+        # Time and memory grow linearly with the length of the video.
+        # With `tile_size`, every frame is decoded in tiles of at most tile_size x tile_size latent pixels
+        # (8 x 8 frame pixels each) overlapping by `tile_overlap` and blended, which bounds the activation
+        # memory of the decoder whatever the frame size
+        output = None
+        for i, u in enumerate(zs):
+            start_frame = 0
+
+            def write(chunk):
+                nonlocal output, start_frame
+                frames = self._to_frames(chunk, uint8)
+                if sink is not None:
+                    sink(i, frames)
+                    return
+                if output is None:
+                    num_frames = self.model.num_decoded_frames(zs.shape[2], frames.shape[0])
+                    output = torch.empty([zs.shape[0], num_frames, *frames.shape[1:]], dtype=frames.dtype,
+                                         device="cpu" if return_in_cpu else device)
+                output[i, start_frame:start_frame + frames.shape[0]] = frames
+                start_frame += frames.shape[0]
+
+            kwargs = {"feat_cache": feat_cache[i]} if use_cache and feat_cache is not None else {}
+            decode_function(u.unsqueeze(0), scale, sink=write, tile_size=tile_size, tile_overlap=tile_overlap,
+                            **kwargs)
+        # [batch_size, num_frames, num_channels, height, width]
+        return output
+
+    def parallel_decode_to_pixel(self, latent: torch.Tensor, devices: Sequence[Union[str, torch.device]],
+                                 num_segments: Optional[int] = None, num_warmup_frames: Optional[int] = None,
+                                 return_in_cpu: bool = False, uint8: bool = False, tile_size: Optional[int] = None,
+                                 tile_overlap: int = 0) -> torch.Tensor:
+        # Same as `decode_to_pixel`, but the latent frames are split into `num_segments` segments (one per device
+        # by default) decoded concurrently by one worker thread per device, each with a copy of the VAE.
+        # Every segment after the first starts `num_warmup_frames` latent frames earlier with a new causal cache
+        # and drops the frames of the warm-up. By default that is the whole causal context of the decoder
+        # (`num_context_frames`) and the video is the same as the one of a sequential decode, fewer frames
+        # trade exactness for less repeated work
+        batch_size, num_latent_frames = latent.shape[:2]
+        num_segments = min(num_segments or len(devices), num_latent_frames)
+        if num_warmup_frames is None:
+            num_warmup_frames = self.model.num_context_frames()
+        # with a new cache the first latent frame decodes to a single frame, it has to be a warm-up one
+        num_warmup_frames = max(num_warmup_frames, 1)
+        bounds = [round(i * num_latent_frames / num_segments) for i in range(num_segments + 1)]
+        segments = queue.Queue()
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            segments.put((start, end))
+
+        spatial_scale = 2**(len(self.model.dim_mult) - 1)
+        output = torch.empty(
+            [batch_size, self.model.num_decoded_frames(num_latent_frames, 1), 3,
+             latent.shape[3] * spatial_scale, latent.shape[4] * spatial_scale],
+            dtype=torch.uint8 if uint8 else torch.float32, device="cpu" if return_in_cpu else latent.device)
+        errors = []
+
+        def worker(device):
+            # grad mode is per thread
+            with torch.no_grad():
+                model = self._replica(device)
+                scale = [self.mean.to(device=device, dtype=latent.dtype),
+                         1.0 / self.std.to(device=device, dtype=latent.dtype)]
+                while not errors:
+                    try:
+                        start, end = segments.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        first = max(start - num_warmup_frames, 0)
+                        zs = latent[:, first:end].to(device).permute(0, 2, 1, 3, 4)
+                        for i, u in enumerate(zs):
+                            latent_frame = first
+
+                            def write(chunk):
+                                nonlocal latent_frame
+                                if latent_frame >= start:
+                                    frames = self._to_frames(chunk, uint8)
+                                    start_frame = self.model.num_decoded_frames(latent_frame, 1) \
+                                        if latent_frame > 0 else 0
+                                    output[i, start_frame:start_frame + frames.shape[0]] = frames
+                                latent_frame += 1
+
+                            model.cached_decode(
+                                u.unsqueeze(0), scale, feat_cache=model.new_decode_cache(), sink=write,
+                                tile_size=tile_size, tile_overlap=tile_overlap)
+                    except BaseException as e:
+                        errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(torch.device(device),), daemon=True)
+                   for device in devices]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        # [batch_size, num_frames, num_channels, height, width]
         return output
 
+    def _replica(self, device):
+        # the model itself on its own device, a copy kept for the next decodes on the others
+        if device.type == "cuda" and device.index is None:
+            device = torch.device("cuda", torch.cuda.current_device())
+        if next(self.model.parameters()).device == device:
+            return self.model
+        if device not in self.replicas:
+            self.replicas[device] = copy.deepcopy(self.model).to(device)
+        return self.replicas[device]
+
+    @staticmethod
+    def _to_frames(chunk: torch.Tensor, uint8: bool) -> torch.Tensor:
+        # a decoded chunk [1, num_channels, num_frames, height, width] to frames [num_frames, num_channels,
+        # height, width] clamped to [-1, 1], or mapped to [0, 255] with `uint8`
+        frames = chunk.squeeze(0).transpose(0, 1).float().clamp_(-1, 1)
+        if uint8:
+            frames = ((frames * 0.5 + 0.5).clamp_(0, 1) * 255).to(torch.uint8)
+        return frames
+
 
 class WanDiffusionWrapper(torch.nn.Module):
     def __init__(
@@ -225,8 +364,14 @@ class WanDiffusionWrapper(torch.nn.Module):
         concat_time_embeddings: Optional[bool] = False,
         clean_x: Optional[torch.Tensor] = None,
         aug_t: Optional[torch.Tensor] = None,
-        cache_start: Optional[int] = None
+        cache_start: Optional[int] = None,
+        commit_kv_cache: bool = False,
+        block_sizes: Optional[List[int]] = None,
+        sampler: Optional[FewStepSampler] = None
     ) -> torch.Tensor:
+        """
+        With a `sampler`, x0 is computed with its precomputed sigmas instead of the scheduler tables.
+        """
         prompt_embeds = conditional_dict["prompt_embeds"]
 
         # [B, F] -> [B]
@@ -245,7 +390,9 @@ class WanDiffusionWrapper(torch.nn.Module):
                 kv_cache=kv_cache,
                 crossattn_cache=crossattn_cache,
                 current_start=current_start,
-                cache_start=cache_start
+                cache_start=cache_start,
+                commit_kv_cache=commit_kv_cache,
+                block_sizes=block_sizes
             ).permute(0, 2, 1, 3, 4)
         else:
             if clean_x is not None:
@@ -277,11 +424,14 @@ class WanDiffusionWrapper(torch.nn.Module):
                         seq_len=self.seq_len
                     ).permute(0, 2, 1, 3, 4)
 
-        pred_x0 = self._convert_flow_pred_to_x0(
-            flow_pred=flow_pred.flatten(0, 1),
-            xt=noisy_image_or_video.flatten(0, 1),
-            timestep=timestep.flatten(0, 1)
-        ).unflatten(0, flow_pred.shape[:2])
+        if sampler is not None:
+            pred_x0 = sampler.convert_flow_pred_to_x0(flow_pred, noisy_image_or_video, timestep)
+        else:
+            pred_x0 = self._convert_flow_pred_to_x0(
+                flow_pred=flow_pred.flatten(0, 1),
+                xt=noisy_image_or_video.flatten(0, 1),
+                timestep=timestep.flatten(0, 1)
+            ).unflatten(0, flow_pred.shape[:2])
 
         if logits is not None:
             return flow_pred, pred_x0, logits
@@ -2,6 +2,8 @@ from wan.modules.attention import attention
 from wan.modules.model import (
     WanRMSNorm,
     rope_apply,
+    rope_rotate,
+    rope_tables,
     WanLayerNorm,
     WAN_CROSSATTENTION_CLASSES,
     rope_params,
@@ -25,34 +27,201 @@ flex_attention = torch.compile(
 
 
 def causal_rope_apply(x, grid_sizes, freqs, start_frame=0):
-    n, c = x.size(2), x.size(3) // 2
+    return rope_apply(x, grid_sizes, freqs, start_frame=start_frame)
 
-    # split freqs
-    freqs = freqs.split([c - 2 * (c // 3), c // 3, c // 3], dim=1)
 
-    # loop over samples
-    output = []
+def causal_rope_shift(x, freqs, frame_seqlen, shift, shift_step=0):
+    """
+    Move already roped tokens x [B, F * frame_seqlen, n, d] along the temporal axis,
+    frame i by `shift + i * shift_step` frames.
+    RoPE is a rotation, so rope(x, t + s) = rope(x, t) * e^(i * s * theta): only the temporal
+    channels change and they are rotated by the rotation of the frame offset.
+    A negative `shift` (with `shift_step` 0) moves the tokens back, it may be larger than the RoPE table.
+    """
+    num_frames = x.size(1) // frame_seqlen
+    cos_t, sin_t, _, _ = rope_tables(freqs)
+    c_t = cos_t.size(1)
+
+    if shift < 0:
+        assert shift_step == 0
+        # angle of the rotation computed in float64 from the per-frame frequencies of the table
+        angle = shift * freqs[1, :c_t].angle()
+        cos_t = angle.cos().float().view(1, 1, 1, 1, c_t)
+        sin_t = angle.sin().float().view(1, 1, 1, 1, c_t)
+    else:
+        if shift_step == 0:
+            frames = slice(shift, shift + 1)
+        else:
+            frames = slice(shift, shift + (num_frames - 1) * shift_step + 1, shift_step)
+        cos_t = cos_t[frames].view(1, -1, 1, 1, c_t)
+        sin_t = sin_t[frames].view(1, -1, 1, 1, c_t)
 
-    for i, (f, h, w) in enumerate(grid_sizes.tolist()):
-        seq_len = f * h * w
+    x = x.unflatten(1, (num_frames, frame_seqlen))
+    x_t = rope_rotate(x[..., :2 * c_t].unflatten(-1, (c_t, 2)), cos_t, sin_t).flatten(-2).type_as(x)
+    return torch.cat([x_t, x[..., 2 * c_t:]], dim=-1).flatten(1, 2)
+
+
+# largest representable magnitude of the quantized KV cache dtypes
+KV_CACHE_QMAX = {
+    torch.int8: 127.0,
+    torch.float8_e4m3fn: 448.0,
+}
+
+
+def quantize_kv(x, dtype):
+    """
+    Symmetric per-token, per-head quantization of keys/values of shape [B, L, num_heads, head_dim].
+    Returns the quantized tensor and the float32 scales of shape [B, L, num_heads, 1].
+    """
+    qmax = KV_CACHE_QMAX[dtype]
+    x = x.float()
+    scale = x.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / qmax
+    x = x / scale
+    if dtype == torch.int8:
+        x = x.round().clamp(-qmax, qmax)
+    return x.to(dtype), scale
 
-        # precompute multipliers
-        x_i = torch.view_as_complex(x[i, :seq_len].to(torch.float64).reshape(
-            seq_len, n, -1, 2))
-        freqs_i = torch.cat([
-            freqs[0][start_frame:start_frame + f].view(f, 1, 1, -1).expand(f, h, w, -1),
-            freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
-            freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1)
-        ],
-            dim=-1).reshape(seq_len, 1, -1)
 
-        # apply rotary embedding
-        x_i = torch.view_as_real(x_i * freqs_i).flatten(2)
-        x_i = torch.cat([x_i, x[i, seq_len:]])
+def dequantize_kv(x, scale, dtype):
+    return (x.float() * scale).to(dtype)
 
-        # append to collection
-        output.append(x_i)
-    return torch.stack(output).type_as(x)
+
+def kv_cache_num_tokens(kv_cache, name="k"):
+    """
+    Number of physical token slots of `kv_cache[name]`.
+    """
+    if "page_tables" in kv_cache:
+        return kv_cache["page_tables"][name].tensor.shape[1] * kv_cache[name].shape[1]
+    return kv_cache[name].shape[1]
+
+
+def kv_cache_get(kv_cache, name, start, end):
+    """
+    Get the physical token range [start, end) of `kv_cache[name]`.
+    Paged buffers have shape [num_pages, page_size, ...] and are mapped to every sample through the page table
+    `kv_cache["page_tables"][name]`. Consecutive pages are read in place as a strided view of the pool, only
+    a fragmented table (a fork after copy-on-write, a pool with interleaved streams) gathers a copy of them.
+    """
+    buffer = kv_cache[name]
+    if "page_tables" not in kv_cache:
+        return buffer[:, start:end]
+    page_size = buffer.shape[1]
+    first_slot, end_slot = start // page_size, (end + page_size - 1) // page_size
+    start, end = start - first_slot * page_size, end - first_slot * page_size
+    page_table = kv_cache["page_tables"][name]
+    strided_pages = page_table.strided_pages(first_slot, end_slot)
+    if strided_pages is None or not buffer.is_contiguous():
+        return buffer[page_table.tensor[:, first_slot:end_slot]].flatten(1, 2)[:, start:end]
+    first_page, sample_stride = strided_pages
+    pages = buffer.as_strided(
+        [len(page_table.pages), (end_slot - first_slot) * page_size, *buffer.shape[2:]],
+        [sample_stride * buffer.stride(0), *buffer.stride()[1:]],
+        buffer.storage_offset() + first_page * buffer.stride(0))
+    return pages[:, start:end]
+
+
+def kv_cache_set(kv_cache, name, start, value):
+    """
+    Set the physical token range starting at `start` of `kv_cache[name]` to `value`.
+    Paged buffers are only written whole pages at a time, pages shared with forked streams are copied first.
+    A value read in place from the pool (Rolling Sink re-inserting original frames) is copied before it is
+    written back to other pages of it.
+    """
+    buffer = kv_cache[name]
+    if "page_tables" not in kv_cache:
+        buffer[:, start:start + value.shape[1]] = value
+        return
+    if value.untyped_storage().data_ptr() == buffer.untyped_storage().data_ptr():
+        value = value.clone()
+    page_size = buffer.shape[1]
+    assert start % page_size == 0 and value.shape[1] % page_size == 0
+    first_page = start // page_size
+    pages = kv_cache["page_tables"][name].writable(first_page, first_page + value.shape[1] // page_size)
+    buffer[pages] = value.unflatten(1, (-1, page_size))
+
+
+def kv_cache_store(kv_cache, name, start, value):
+    """
+    Store `value` at the physical token offset `start` of `kv_cache[name]`.
+    Buffers with a `<name>_scale` entry are quantized on the fly.
+    """
+    if name + "_scale" in kv_cache:
+        value, scale = quantize_kv(value, kv_cache[name].dtype)
+        kv_cache_set(kv_cache, name + "_scale", start, scale)
+    kv_cache_set(kv_cache, name, start, value)
+
+
+def kv_cache_load(kv_cache, name, start, end, dtype):
+    """
+    Load the physical token range [start, end) of `kv_cache[name]`, dequantized to `dtype` if needed.
+    """
+    value = kv_cache_get(kv_cache, name, start, end)
+    if name + "_scale" in kv_cache:
+        value = dequantize_kv(value, kv_cache_get(kv_cache, name + "_scale", start, end), dtype)
+    return value
+
+
+def kv_cache_segments(kv_cache, start, end, sink_tokens):
+    """
+    Map the logical KV cache range [start, end) onto contiguous physical slices.
+    The first `sink_tokens` slots are pinned, the remaining slots form a ring buffer
+    whose logical start is stored at `kv_cache["ring_start_index"]`.
+    Returns a list of (logical_start, physical_start, length) tuples.
+    """
+    ring_size = kv_cache_num_tokens(kv_cache) - sink_tokens
+    ring_start = kv_cache["ring_start_index"]
+    segments = []
+    if start < sink_tokens:
+        length = min(end, sink_tokens) - start
+        segments.append((start, start, length))
+        start += length
+    while start < end:
+        physical_start = sink_tokens + (start - sink_tokens + ring_start) % ring_size
+        length = min(end - start, sink_tokens + ring_size - physical_start)
+        segments.append((start, physical_start, length))
+        start += length
+    return segments
+
+
+def kv_cache_write(kv_cache, name, start, value, sink_tokens):
+    """
+    Write `value` to the logical range starting at `start` of `kv_cache[name]`.
+    """
+    for logical_start, physical_start, length in kv_cache_segments(
+            kv_cache, start, start + value.shape[1], sink_tokens):
+        offset = logical_start - start
+        kv_cache_store(kv_cache, name, physical_start, value[:, offset:offset + length])
+
+
+def kv_cache_read(kv_cache, name, start, end, sink_tokens, dtype):
+    """
+    Read the logical range [start, end) of `kv_cache[name]`.
+    Attention does not depend on the order of the keys (positions are already encoded by RoPE),
+    so a window covering the whole buffer is returned in physical order without any copy
+    (a single gather for paged buffers).
+    """
+    if start == 0 and end == kv_cache_num_tokens(kv_cache, name):
+        return kv_cache_load(kv_cache, name, start, end, dtype)
+    segments = kv_cache_segments(kv_cache, start, end, sink_tokens)
+    if len(segments) == 1:
+        _, physical_start, length = segments[0]
+        return kv_cache_load(kv_cache, name, physical_start, physical_start + length, dtype)
+    return torch.cat([kv_cache_load(kv_cache, name, physical_start, physical_start + length, dtype)
+                      for _, physical_start, length in segments], dim=1)
+
+
+def frame_slot_runs(frame_slots):
+    """
+    Group a list of frame slots into runs of consecutive slots.
+    Returns a list of (offset, first_slot, length) tuples, `offset` being the position in `frame_slots`.
+    """
+    runs = []
+    for offset, slot in enumerate(frame_slots):
+        if runs and runs[-1][1] + runs[-1][2] == slot:
+            runs[-1][2] += 1
+        else:
+            runs.append([offset, slot, 1])
+    return [tuple(run) for run in runs]
 
 
 class CausalWanSelfAttention(nn.Module):
@@ -95,7 +264,9 @@ class CausalWanSelfAttention(nn.Module):
         block_mask,
         kv_cache=None,
         current_start=0,
-        cache_start=None
+        cache_start=None,
+        commit_kv_cache=False,
+        block_sizes=None
     ):
         r"""
         Args:
@@ -104,6 +275,10 @@ class CausalWanSelfAttention(nn.Module):
             grid_sizes(Tensor): Shape [B, 3], the second dimension contains (F, H, W)
             freqs(Tensor): Rope freqs, shape [1024, C / num_heads / 2]
             block_mask (BlockMask)
+            commit_kv_cache (bool): the keys/values written by this call are the final ones of the block,
+                Rolling Sink runs after it as it does after a clean context pass (timestep 0)
+            block_sizes (List[int]): the frames are consecutive blocks, oldest first, with these numbers of
+                frames (diagonal denoising), `timestep` then has one entry per frame
         """
         b, s, n, d = *x.shape[:2], self.num_heads, self.head_dim
         if cache_start is None:
@@ -194,99 +369,276 @@ class CausalWanSelfAttention(nn.Module):
                     block_mask=block_mask
                 )[:, :, :-padded_length].transpose(2, 1)
         else:
-            frame_seqlen = math.prod(grid_sizes[0][1:]).item()
-            current_start_frame = current_start // frame_seqlen
-            roped_query = causal_rope_apply(
-                q, grid_sizes, freqs, start_frame=current_start_frame).type_as(v)
+            x = self._kv_cache_attention(
+                q, k, v, grid_sizes, freqs, timestep, kv_cache, current_start, commit_kv_cache, block_sizes)
+
+        # output
+        x = x.flatten(2)
+        x = self.o(x)
+        return x
+
+    @torch.compiler.disable
+    def _kv_cache_attention(
+            self, q, k, v, grid_sizes, freqs, timestep, kv_cache, current_start, commit_kv_cache, block_sizes=None):
+        r"""
+        Attention of the new tokens over the KV cache, updating the cache in place.
+
+        Everything that depends on the state of the cache (ring buffer indices, eviction, Rolling Sink)
+        happens here, in eager mode, so the rest of the block has fixed shapes and no branching on the
+        cache and is compiled only once by `compile_denoise_step`.
+        """
+        frame_seqlen = math.prod(grid_sizes[0][1:]).item()
+        if block_sizes is not None:
+            # every block updates the cache and attends to it as if it ran alone, oldest first, so a block
+            # never sees the ones after it. Only the projections around the attention are batched
+            outputs = []
+            start_frame = 0
+            for index, num_frames in enumerate(block_sizes):
+                tokens = slice(start_frame * frame_seqlen, (start_frame + num_frames) * frame_seqlen)
+                block_grid_sizes = grid_sizes.clone()
+                block_grid_sizes[:, 0] = num_frames
+                # only the oldest block can be done after this call
+                outputs.append(self._kv_cache_attention(
+                    q[:, tokens], k[:, tokens], v[:, tokens], block_grid_sizes, freqs, timestep[start_frame],
+                    kv_cache, current_start + start_frame * frame_seqlen, commit_kv_cache and index == 0))
+                start_frame += num_frames
+            return torch.cat(outputs, dim=1)
+        current_start_frame = current_start // frame_seqlen
+        rope_offset = self._remap_rope(
+            kv_cache, freqs, current_start_frame + k.shape[1] // frame_seqlen, frame_seqlen, v.dtype)
+        roped_query = causal_rope_apply(
+            q, grid_sizes, freqs, start_frame=current_start_frame - rope_offset).type_as(v)
+        if "frame_slots" in kv_cache:
+            x = self._single_copy_attention(
+                roped_query, k, v, grid_sizes, freqs, timestep, kv_cache, current_start, frame_seqlen,
+                commit_kv_cache)
+        else:
             roped_key = causal_rope_apply(
-                k, grid_sizes, freqs, start_frame=current_start_frame).type_as(v)
+                k, grid_sizes, freqs, start_frame=current_start_frame - rope_offset).type_as(v)
 
             current_end = current_start + roped_query.shape[1]
             sink_tokens = self.sink_size * frame_seqlen
             # If we are using local attention and the current KV cache size is larger than the local attention size, we need to truncate the KV cache
-            kv_cache_size = kv_cache["k"].shape[1]
+            kv_cache_size = kv_cache_num_tokens(kv_cache)
             num_new_tokens = roped_query.shape[1]
-            if (current_end > kv_cache["global_end_index"].item()) and (
-                    num_new_tokens + kv_cache["local_end_index"].item() > kv_cache_size):
+            if (current_end > kv_cache["global_end_index"]) and (
+                    num_new_tokens + kv_cache["local_end_index"] > kv_cache_size):
                 # Calculate the number of new tokens added in this step
-                # Shift existing cache content left to discard oldest tokens
-                # Clone the source slice to avoid overlapping memory error
-                num_evicted_tokens = num_new_tokens + kv_cache["local_end_index"].item() - kv_cache_size
-                num_rolled_tokens = kv_cache["local_end_index"].item() - num_evicted_tokens - sink_tokens
-                kv_cache["k"][:, sink_tokens:sink_tokens + num_rolled_tokens] = \
-                    kv_cache["k"][:, sink_tokens + num_evicted_tokens:sink_tokens + num_evicted_tokens + num_rolled_tokens].clone()
-                kv_cache["v"][:, sink_tokens:sink_tokens + num_rolled_tokens] = \
-                    kv_cache["v"][:, sink_tokens + num_evicted_tokens:sink_tokens + num_evicted_tokens + num_rolled_tokens].clone()
-                # Insert the new keys/values at the end
-                local_end_index = kv_cache["local_end_index"].item() + current_end - \
-                    kv_cache["global_end_index"].item() - num_evicted_tokens
-                local_start_index = local_end_index - num_new_tokens
-                kv_cache["k"][:, local_start_index:local_end_index] = roped_key
-                kv_cache["v"][:, local_start_index:local_end_index] = v
+                # Discard the oldest tokens by advancing the start of the ring buffer,
+                # the sink tokens stay pinned at the front and nothing is copied
+                num_evicted_tokens = num_new_tokens + kv_cache["local_end_index"] - kv_cache_size
+                kv_cache["ring_start_index"] = \
+                    (kv_cache["ring_start_index"] + num_evicted_tokens) % (kv_cache_size - sink_tokens)
+                local_end_index = kv_cache["local_end_index"] + current_end - \
+                    kv_cache["global_end_index"] - num_evicted_tokens
             else:
                 # Assign new keys/values directly up to current_end
-                local_end_index = kv_cache["local_end_index"].item() + current_end - kv_cache["global_end_index"].item()
-                local_start_index = local_end_index - num_new_tokens
-                kv_cache["k"][:, local_start_index:local_end_index] = roped_key
-                kv_cache["v"][:, local_start_index:local_end_index] = v
+                local_end_index = kv_cache["local_end_index"] + current_end - kv_cache["global_end_index"]
+            # Insert the new keys/values at the end
+            local_start_index = local_end_index - num_new_tokens
+            kv_cache_write(kv_cache, "k", local_start_index, roped_key, sink_tokens)
+            kv_cache_write(kv_cache, "v", local_start_index, v, sink_tokens)
 
             """
             Rolling Sink starts.
             """
 
+            # keep the keys of the first window already roped, Rolling Sink only rotates them by a frame offset
             if current_end <= self.max_attention_size:
-                kv_cache["k_original"][:, local_start_index:local_end_index] = k
-                kv_cache["v_original"][:, local_start_index:local_end_index] = v
+                kv_cache_store(kv_cache, "k_original", local_start_index, roped_key)
+                kv_cache_store(kv_cache, "v_original", local_start_index, v)
+
+            window_start_index = max(0, local_end_index - self.max_attention_size)
+            if sink_tokens > 0 and window_start_index > 0:
+                # the cache is larger than the window (diagonal denoising), the sink stays in front of it
+                window_start_index += sink_tokens
+
+                def read(name):
+                    return torch.cat([
+                        kv_cache_read(kv_cache, name, 0, sink_tokens, sink_tokens, v.dtype),
+                        kv_cache_read(kv_cache, name, window_start_index, local_end_index, sink_tokens, v.dtype)
+                    ], dim=1)
+            else:
+                def read(name):
+                    return kv_cache_read(kv_cache, name, window_start_index, local_end_index, sink_tokens, v.dtype)
+            x = attention(roped_query, read("k"), read("v"))
 
-            x = attention(
-                roped_query,
-                kv_cache["k"][:, max(0, local_end_index - self.max_attention_size):local_end_index],
-                kv_cache["v"][:, max(0, local_end_index - self.max_attention_size):local_end_index]
-            )
+            if (timestep == 0 or commit_kv_cache) and current_end - 3 * frame_seqlen >= self.max_attention_size:
+                current_start_frame_RS, left, right, reverse = self._rolling_sink_frames(
+                    current_start_frame, frame_seqlen)
 
-            if timestep == 0 and current_end - 3 * frame_seqlen >= self.max_attention_size:
-                current_start_frame_RS = current_start_frame - 3
-                reverse_window_size = (self.max_attention_size//frame_seqlen) - 3
-                reverse = (current_start_frame_RS // reverse_window_size) % 2 == 1
+                re_k_cache = kv_cache_load(kv_cache, "k_original", left*frame_seqlen, right*frame_seqlen, v.dtype)
+                re_v_cache = kv_cache_load(kv_cache, "v_original", left*frame_seqlen, right*frame_seqlen, v.dtype)
                 if reverse:
-                    right = reverse_window_size - current_start_frame_RS % reverse_window_size 
-                    left = right - 3
+                    # reverse the order of the frames, the tokens inside each frame keep their order
+                    re_k_cache = re_k_cache.unflatten(1, (3, frame_seqlen)).flip(dims=[1]).flatten(1, 2)
+                    re_v_cache = re_v_cache.unflatten(1, (3, frame_seqlen)).flip(dims=[1]).flatten(1, 2)
+                    # source frames right - 1, ..., left move to current_start_frame_RS, ..., + 2
+                    shift, shift_step = current_start_frame_RS - rope_offset - (right - 1), 2
                 else:
-                    left = current_start_frame_RS % reverse_window_size
-                    right = left + 3
-
-                re_k_cache = kv_cache["k_original"][:, left*frame_seqlen:right*frame_seqlen]
-                re_v_cache = kv_cache["v_original"][:, left*frame_seqlen:right*frame_seqlen]
-                if reverse:
-                    re_k_cache = re_k_cache.flip(dims=[1])
-                    re_v_cache = re_v_cache.flip(dims=[1])
-                    for re_block_idx in range(3):
-                        re_k_cache[:, re_block_idx*frame_seqlen:(re_block_idx + 1)*frame_seqlen, :, :] = \
-                            re_k_cache[:, re_block_idx*frame_seqlen:(re_block_idx + 1)*frame_seqlen, :, :].flip(dims=[1])
-                        re_v_cache[:, re_block_idx*frame_seqlen:(re_block_idx + 1)*frame_seqlen, :, :] = \
-                            re_v_cache[:, re_block_idx*frame_seqlen:(re_block_idx + 1)*frame_seqlen, :, :].flip(dims=[1])
+                    shift, shift_step = current_start_frame_RS - rope_offset - left, 0
 
                 insert_left = local_start_index - 3 * frame_seqlen
-                insert_right = local_end_index - 3 * frame_seqlen
-                if self.block_id == 0:
-                    if reverse:
-                        print(f"Reversed sink: {right:2d} --- {left:2d}. \tcurrent idx: {current_start_frame}.")
-                    else:
-                        print(f"Forward  sink: {left:2d} --- {right:2d}. \tcurrent idx: {current_start_frame}.")
-                kv_cache["k"][:, insert_left:insert_right] = causal_rope_apply(
-                    re_k_cache, grid_sizes, freqs, start_frame=current_start_frame_RS).type_as(v)
-                kv_cache["v"][:, insert_left:insert_right] = re_v_cache
+                kv_cache_write(kv_cache, "k", insert_left, causal_rope_shift(
+                    re_k_cache, freqs, frame_seqlen, shift, shift_step), sink_tokens)
+                kv_cache_write(kv_cache, "v", insert_left, re_v_cache, sink_tokens)
 
             """
             Rolling Sink ends.
             """
 
-            kv_cache["global_end_index"].fill_(current_end)
-            kv_cache["local_end_index"].fill_(local_end_index)
+            kv_cache["global_end_index"] = current_end
+            kv_cache["local_end_index"] = local_end_index
+        return x
 
-        # output
-        x = x.flatten(2)
-        x = self.o(x)
+    def _remap_rope(self, kv_cache, freqs, current_end_frame, frame_seqlen, dtype):
+        """
+        The RoPE tables only cover `freqs.size(0)` frames. Frame f is roped at position f - `kv_cache["rope_offset"]`,
+        once the new frames would run past the table the offset grows by half the table. Attention only depends on
+        relative positions, so the roped keys of the cache are rotated back by the same amount and the window is
+        unchanged. The first-window copies keep their positions, Rolling Sink shifts them relative to the offset.
+        Returns the RoPE offset of the new frames.
+        """
+        if current_end_frame - kv_cache["rope_offset"] <= freqs.size(0):
+            return kv_cache["rope_offset"]
+        shift = freqs.size(0) // 2
+        if "frame_slots" not in kv_cache:
+            # single-copy keys are un-roped, only the others are rotated
+            num_tokens = kv_cache_num_tokens(kv_cache)
+            kv_cache_store(kv_cache, "k", 0, causal_rope_shift(
+                kv_cache_load(kv_cache, "k", 0, num_tokens, dtype), freqs, frame_seqlen, -shift))
+        kv_cache["rope_offset"] += shift
+        return kv_cache["rope_offset"]
+
+    def _rolling_sink_frames(self, current_start_frame, frame_seqlen):
+        """
+        Pick the 3 frames of the original window that Rolling Sink re-inserts in place of the previous block.
+        The source frames sweep forward and backward over the first `max_attention_size - 3` frames.
+        Returns the start frame of the previous block, the [left, right) source frames and whether they are reversed.
+        """
+        current_start_frame_RS = current_start_frame - 3
+        reverse_window_size = (self.max_attention_size//frame_seqlen) - 3
+        reverse = (current_start_frame_RS // reverse_window_size) % 2 == 1
+        if reverse:
+            right = reverse_window_size - current_start_frame_RS % reverse_window_size
+            left = right - 3
+        else:
+            left = current_start_frame_RS % reverse_window_size
+            right = left + 3
+
+        if self.block_id == 0:
+            if reverse:
+                print(f"Reversed sink: {right:2d} --- {left:2d}. \tcurrent idx: {current_start_frame}.")
+            else:
+                print(f"Forward  sink: {left:2d} --- {right:2d}. \tcurrent idx: {current_start_frame}.")
+        return current_start_frame_RS, left, right, reverse
+
+    def _single_copy_attention(
+        self,
+        roped_query,
+        k,
+        v,
+        grid_sizes,
+        freqs,
+        timestep,
+        kv_cache,
+        current_start,
+        frame_seqlen,
+        commit_kv_cache=False
+    ):
+        r"""
+        Attention over a single-copy KV cache.
+
+        `kv_cache["k"]` and `kv_cache["v"]` are a pool of frame slots holding un-roped keys and values.
+        The first `kv_cache["num_source_frames"]` slots are pinned to the frames that Rolling Sink replays,
+        `kv_cache["frame_slots"]` maps every frame of the attention window to its slot and
+        `kv_cache["free_slots"]` lists the slots available for new frames. Keys are roped to their
+        window positions right before attention, so re-inserting sink frames only updates the slot map.
+        """
+        frame_slots = kv_cache["frame_slots"]
+        free_slots = kv_cache["free_slots"]
+        num_source_frames = kv_cache["num_source_frames"]
+        max_attention_frames = self.max_attention_size // frame_seqlen
+
+        current_start_frame = current_start // frame_seqlen
+        num_new_frames = k.shape[1] // frame_seqlen
+        current_end_frame = current_start_frame + num_new_frames
+        global_end_frame = kv_cache["global_end_index"] // frame_seqlen
+
+        def release(slots):
+            # the source slots stay pinned, only slots of generated frames are reused
+            free_slots.extend(slot for slot in slots if slot >= num_source_frames)
+
+        if (current_end_frame > global_end_frame) and (num_new_frames + len(frame_slots) > max_attention_frames):
+            # Evict the oldest frames after the sink
+            num_evicted_frames = num_new_frames + len(frame_slots) - max_attention_frames
+            release(frame_slots[self.sink_size:self.sink_size + num_evicted_frames])
+            del frame_slots[self.sink_size:self.sink_size + num_evicted_frames]
+        for frame in range(global_end_frame, current_end_frame):
+            if frame < num_source_frames:
+                frame_slots.append(frame)
+            elif free_slots:
+                frame_slots.append(free_slots.pop(0))
+            else:
+                raise RuntimeError(
+                    "Single-copy KV cache ran out of frame slots, it relies on Rolling Sink "
+                    "re-inserting a block after every clean context pass (context_noise == 0).")
+
+        # Insert the new keys/values
+        local_end_frame = len(frame_slots)
+        local_start_frame = local_end_frame - num_new_frames
+        for offset, slot, length in frame_slot_runs(frame_slots[local_start_frame:local_end_frame]):
+            kv_cache_store(kv_cache, "k", slot * frame_seqlen,
+                           k[:, offset * frame_seqlen:(offset + length) * frame_seqlen])
+            kv_cache_store(kv_cache, "v", slot * frame_seqlen,
+                           v[:, offset * frame_seqlen:(offset + length) * frame_seqlen])
+
+        # Gather the window and rope the keys, the sink frames keep their original positions
+        window_start_frame = max(0, local_end_frame - max_attention_frames)
+
+        def gather(name, start, end):
+            return torch.cat([
+                kv_cache_load(kv_cache, name, slot * frame_seqlen, (slot + length) * frame_seqlen, v.dtype)
+                for _, slot, length in frame_slot_runs(frame_slots[start:end])
+            ], dim=1)
+
+        def rope_frames(x, start_frame):
+            frame_grid_sizes = grid_sizes.clone()
+            frame_grid_sizes[:, 0] = x.shape[1] // frame_seqlen
+            return causal_rope_apply(x, frame_grid_sizes, freqs, start_frame=start_frame).type_as(v)
+
+        sink_end_frame = min(max(window_start_frame, self.sink_size), local_end_frame)
+        window_k, window_v = [], []
+        rope_offset = kv_cache["rope_offset"]
+        if window_start_frame < sink_end_frame:
+            sink_k = rope_frames(gather("k", window_start_frame, sink_end_frame), window_start_frame)
+            if rope_offset > 0:
+                # the sink frames sit before the start of the remapped RoPE table
+                sink_k = causal_rope_shift(sink_k, freqs, frame_seqlen, -rope_offset)
+            window_k.append(sink_k)
+            window_v.append(gather("v", window_start_frame, sink_end_frame))
+        if sink_end_frame < local_end_frame:
+            window_k.append(rope_frames(
+                gather("k", sink_end_frame, local_end_frame),
+                current_end_frame - local_end_frame + sink_end_frame - rope_offset))
+            window_v.append(gather("v", sink_end_frame, local_end_frame))
+        x = attention(
+            roped_query,
+            torch.cat(window_k, dim=1) if len(window_k) > 1 else window_k[0],
+            torch.cat(window_v, dim=1) if len(window_v) > 1 else window_v[0]
+        )
+
+        # Rolling Sink: point the previous block at the source frames instead of copying them
+        if (timestep == 0 or commit_kv_cache) and (current_end_frame - 3) * frame_seqlen >= self.max_attention_size:
+            _, left, right, reverse = self._rolling_sink_frames(current_start_frame, frame_seqlen)
+            source_frames = list(range(left, right))
+            if reverse:
+                source_frames.reverse()
+            release(frame_slots[local_start_frame - 3:local_start_frame])
+            frame_slots[local_start_frame - 3:local_start_frame] = source_frames
+
+        kv_cache["global_end_index"] = current_end_frame * frame_seqlen
+        kv_cache["local_end_index"] = local_end_frame * frame_seqlen
         return x
 
 
@@ -345,7 +697,9 @@ class CausalWanAttentionBlock(nn.Module):
         kv_cache=None,
         crossattn_cache=None,
         current_start=0,
-        cache_start=None
+        cache_start=None,
+        commit_kv_cache=False,
+        block_sizes=None
     ):
         r"""
         Args:
@@ -365,7 +719,7 @@ class CausalWanAttentionBlock(nn.Module):
         y = self.self_attn(
             (self.norm1(x).unflatten(dim=1, sizes=(num_frames, frame_seqlen)) * (1 + e[1]) + e[0]).flatten(1, 2),
             seq_lens, grid_sizes,
-            freqs, timestep, block_mask, kv_cache, current_start, cache_start)
+            freqs, timestep, block_mask, kv_cache, current_start, cache_start, commit_kv_cache, block_sizes)
 
         # with amp.autocast(dtype=torch.float32):
         x = x + (y.unflatten(dim=1, sizes=(num_frames, frame_seqlen)) * e[2]).flatten(1, 2)
@@ -772,7 +1126,9 @@ class CausalWanModel(ModelMixin, ConfigMixin):
         kv_cache: dict = None,
         crossattn_cache: dict = None,
         current_start: int = 0,
-        cache_start: int = 0
+        cache_start: int = 0,
+        commit_kv_cache: bool = False,
+        block_sizes: list = None
     ):
         r"""
         Run the diffusion model with kv caching.
@@ -793,6 +1149,12 @@ class CausalWanModel(ModelMixin, ConfigMixin):
                 CLIP image features for image-to-video mode
             y (List[Tensor], *optional*):
                 Conditional video inputs for image-to-video mode, same shape as x
+            commit_kv_cache (`bool`, *optional*):
+                The keys/values written by this call are the final ones of the block, run Rolling Sink
+                after it instead of after a clean context pass
+            block_sizes (`List[int]`, *optional*):
+                The frames are consecutive blocks with these numbers of frames, oldest first, at their own
+                timesteps (diagonal denoising). Each block attends to the KV cache as if it ran alone
 
         Returns:
             List[Tensor]:
@@ -809,6 +1171,11 @@ class CausalWanModel(ModelMixin, ConfigMixin):
         if y is not None:
             x = [torch.cat([u, v], dim=0) for u, v in zip(x, y)]
 
+        # the inference pipeline keeps t on the host, reading the timestep does not wait for the device.
+        # It stays a tensor so that compiled blocks do not specialize on its value
+        timestep = t[0, 0] if block_sizes is None else t[0]
+        t = t.to(device, non_blocking=True)
+
         # embeddings
         x = [self.patch_embedding(u.unsqueeze(0)) for u in x]
         grid_sizes = torch.stack(
@@ -853,8 +1220,10 @@ class CausalWanModel(ModelMixin, ConfigMixin):
             freqs=self.freqs,
             context=context,
             context_lens=context_lens,
-            timestep=t[0,0].item(),
-            block_mask=self.block_mask
+            timestep=timestep,
+            block_mask=self.block_mask,
+            commit_kv_cache=commit_kv_cache,
+            block_sizes=block_sizes
         )
 
         def create_custom_forward(module):
@@ -1,4 +1,5 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
+import functools
 import math
 
 import torch
@@ -36,35 +37,61 @@ def rope_params(max_seq_len, dim, theta=10000):
     return freqs
 
 
+@functools.lru_cache(maxsize=16)
+def rope_tables(freqs, h=0, w=0):
+    """
+    Float32 cos/sin tables of the complex RoPE frequencies `freqs` from `rope_params`.
+    Returns the temporal tables of shape [max_seq_len, c_t], indexed by frame, and the
+    spatial tables of shape [h * w, c - c_t] of one h x w latent frame.
+    """
+    c = freqs.size(1)
+    freqs_t, freqs_h, freqs_w = freqs.split([c - 2 * (c // 3), c // 3, c // 3], dim=1)
+    freqs_hw = torch.cat([
+        freqs_h[:h].view(h, 1, c // 3).expand(h, w, c // 3),
+        freqs_w[:w].view(1, w, c // 3).expand(h, w, c // 3)
+    ],
+        dim=-1).flatten(0, 1)
+    return (freqs_t.real.float(), freqs_t.imag.float(),
+            freqs_hw.real.float(), freqs_hw.imag.float())
+
+
+def rope_rotate(x, cos, sin):
+    """
+    Rotate the channel pairs x[..., i, :] by the angles of cos[..., i] / sin[..., i] in float32.
+    """
+    x = x.float()
+    x_r, x_i = x[..., 0], x[..., 1]
+    return torch.stack([x_r * cos - x_i * sin, x_r * sin + x_i * cos], dim=-1)
+
+
 # @amp.autocast(enabled=False)
-def rope_apply(x, grid_sizes, freqs):
+def rope_apply(x, grid_sizes, freqs, start_frame=0):
     n, c = x.size(2), x.size(3) // 2
 
-    # split freqs
-    freqs = freqs.split([c - 2 * (c // 3), c // 3, c // 3], dim=1)
-
-    # loop over samples
-    output = []
-    for i, (f, h, w) in enumerate(grid_sizes.tolist()):
-        seq_len = f * h * w
-
-        # precompute multipliers
-        x_i = torch.view_as_complex(x[i, :seq_len].to(torch.float64).reshape(
-            seq_len, n, -1, 2))
-        freqs_i = torch.cat([
-            freqs[0][:f].view(f, 1, 1, -1).expand(f, h, w, -1),
-            freqs[1][:h].view(1, h, 1, -1).expand(f, h, w, -1),
-            freqs[2][:w].view(1, 1, w, -1).expand(f, h, w, -1)
-        ],
-            dim=-1).reshape(seq_len, 1, -1)
-
-        # apply rotary embedding
-        x_i = torch.view_as_real(x_i * freqs_i).flatten(2)
-        x_i = torch.cat([x_i, x[i, seq_len:]])
+    # samples of different sizes are roped one by one
+    if len(grid_sizes) > 1 and not (grid_sizes == grid_sizes[0]).all():
+        return torch.cat([
+            rope_apply(x[i:i + 1], grid_sizes[i:i + 1], freqs, start_frame)
+            for i in range(len(grid_sizes))
+        ])
 
-        # append to collection
-        output.append(x_i)
-    return torch.stack(output).type_as(x)
+    f, h, w = grid_sizes[0].tolist()
+    seq_len = f * h * w
+    cos_t, sin_t, cos_hw, sin_hw = rope_tables(freqs, h, w)
+    c_t = cos_t.size(1)
+
+    # the temporal channels rotate with the frame, the spatial ones with the position inside the frame
+    x_i = x[:, :seq_len].reshape(x.size(0), f, h * w, n, c, 2)
+    x_t = rope_rotate(x_i[..., :c_t, :],
+                      cos_t[start_frame:start_frame + f].view(1, f, 1, 1, c_t),
+                      sin_t[start_frame:start_frame + f].view(1, f, 1, 1, c_t))
+    x_hw = rope_rotate(x_i[..., c_t:, :],
+                       cos_hw.view(1, 1, h * w, 1, c - c_t),
+                       sin_hw.view(1, 1, h * w, 1, c - c_t))
+    output = torch.cat([x_t, x_hw], dim=-2).flatten(1, 2).flatten(3).type_as(x)
+    if seq_len < x.size(1):
+        output = torch.cat([output, x[:, seq_len:]], dim=1)
+    return output
 
 
 class WanRMSNorm(nn.Module):
@@ -1,5 +1,6 @@
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 import logging
+import math
 
 import torch
 import torch.cuda.amp as amp
@@ -35,6 +36,78 @@ class CausalConv3d(nn.Conv3d):
 
         return super().forward(x)
 
+    def forward_padded(self, x):
+        """
+        Convolve frames that already start with their causal context, padding only spatially (inside the
+        convolution, no padded copy of `x` is made).
+        """
+        return F.conv3d(x, self.weight, self.bias, self.stride,
+                        (0, self._padding[2], self._padding[0]), self.dilation,
+                        self.groups)
+
+
+class CausalConvCache:
+    """
+    Feature cache of the causal convolutions of an encoder or decoder, carried from one chunk of frames to the
+    next.
+    Every cached convolution keeps its last input frames in a buffer of fixed shape [b, c, num_frames, h, w],
+    allocated zeroed on first use (zeros are the causal padding of the first chunk) and overwritten in place
+    afterwards. The convolutions read the cached frames followed by the new ones from a scratch buffer shared by
+    all of them, so that once every buffer exists a chunk allocates nothing but the outputs of the layers.
+    A tiled decode keeps one cache per tile, all of them sharing the scratch buffer of the cache of the video.
+    """
+
+    def __init__(self, root=None):
+        self.frames = {}
+        self.tiles = {}
+        self.root = self if root is None else root
+        self.scratch = None
+
+    def __contains__(self, conv):
+        return conv in self.frames
+
+    def tile(self, key):
+        if key not in self.tiles:
+            self.tiles[key] = CausalConvCache(self.root)
+        return self.tiles[key]
+
+    def _frames(self, conv, x, num_frames):
+        frames = self.frames.get(conv)
+        if frames is None:
+            frames = self.frames[conv] = x.new_zeros(
+                [*x.shape[:2], num_frames, *x.shape[3:]])
+        return frames
+
+    def start(self, conv, x, num_frames=CACHE_T, keep_frames=False):
+        """
+        Start the cache of `conv` without applying it: from zeros, or with `keep_frames` from the last frames of
+        `x`.
+        """
+        frames = self._frames(conv, x, num_frames)
+        if keep_frames:
+            t = min(num_frames, x.shape[2])
+            frames[:, :, num_frames - t:].copy_(x[:, :, -t:])
+
+    def __call__(self, conv, x, num_frames=CACHE_T):
+        """
+        `conv` applied to `x` after the cached frames of the previous chunks, caching the last `num_frames`
+        frames for the next chunk.
+        """
+        frames = self._frames(conv, x, num_frames)
+        b, c, t, h, w = x.shape
+        size = b * c * (num_frames + t) * h * w * x.element_size()
+        root = self.root
+        if (root.scratch is None or root.scratch.numel() < size
+                or root.scratch.device != x.device):
+            root.scratch = torch.empty(size, dtype=torch.uint8, device=x.device)
+        window = root.scratch[:size].view(x.dtype).view(
+            b, c, num_frames + t, h, w)
+        window[:, :, :num_frames] = frames
+        window[:, :, num_frames:] = x
+        x = conv.forward_padded(window)
+        frames.copy_(window[:, :, -num_frames:])
+        return x
+
 
 class RMS_norm(nn.Module):
 
@@ -98,38 +171,15 @@ class Resample(nn.Module):
         else:
             self.resample = nn.Identity()
 
-    def forward(self, x, feat_cache=None, feat_idx=[0]):
+    def forward(self, x, feat_cache=None):
         b, c, t, h, w = x.size()
         if self.mode == 'upsample3d':
             if feat_cache is not None:
-                idx = feat_idx[0]
-                if feat_cache[idx] is None:
-                    feat_cache[idx] = 'Rep'
-                    feat_idx[0] += 1
+                if self.time_conv not in feat_cache:
+                    # the first chunk is not upsampled in time, the second one starts from zeros
+                    feat_cache.start(self.time_conv, x)
                 else:
-
-                    cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                    if cache_x.shape[2] < 2 and feat_cache[
-                            idx] is not None and feat_cache[idx] != 'Rep':
-                        # cache last frame of last two chunk
-                        cache_x = torch.cat([
-                            feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                                cache_x.device), cache_x
-                        ],
-                            dim=2)
-                    if cache_x.shape[2] < 2 and feat_cache[
-                            idx] is not None and feat_cache[idx] == 'Rep':
-                        cache_x = torch.cat([
-                            torch.zeros_like(cache_x).to(cache_x.device),
-                            cache_x
-                        ],
-                            dim=2)
-                    if feat_cache[idx] == 'Rep':
-                        x = self.time_conv(x)
-                    else:
-                        x = self.time_conv(x, feat_cache[idx])
-                    feat_cache[idx] = cache_x
-                    feat_idx[0] += 1
+                    x = feat_cache(self.time_conv, x)
 
                     x = x.reshape(b, 2, c, t, h, w)
                     x = torch.stack((x[:, 0, :, :, :, :], x[:, 1, :, :, :, :]),
@@ -142,21 +192,11 @@ class Resample(nn.Module):
 
         if self.mode == 'downsample3d':
             if feat_cache is not None:
-                idx = feat_idx[0]
-                if feat_cache[idx] is None:
-                    feat_cache[idx] = x.clone()
-                    feat_idx[0] += 1
+                if self.time_conv not in feat_cache:
+                    # the first chunk is not downsampled in time, its last frame starts the second one
+                    feat_cache.start(self.time_conv, x, 1, keep_frames=True)
                 else:
-
-                    cache_x = x[:, :, -1:, :, :].clone()
-                    # if cache_x.shape[2] < 2 and feat_cache[idx] is not None and feat_cache[idx]!='Rep':
-                    #     # cache last frame of last two chunk
-                    #     cache_x = torch.cat([feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(cache_x.device), cache_x], dim=2)
-
-                    x = self.time_conv(
-                        torch.cat([feat_cache[idx][:, :, -1:, :, :], x], 2))
-                    feat_cache[idx] = cache_x
-                    feat_idx[0] += 1
+                    x = feat_cache(self.time_conv, x, 1)
         return x
 
     def init_weight(self, conv):
@@ -199,22 +239,11 @@ class ResidualBlock(nn.Module):
         self.shortcut = CausalConv3d(in_dim, out_dim, 1) \
             if in_dim != out_dim else nn.Identity()
 
-    def forward(self, x, feat_cache=None, feat_idx=[0]):
+    def forward(self, x, feat_cache=None):
         h = self.shortcut(x)
         for layer in self.residual:
             if isinstance(layer, CausalConv3d) and feat_cache is not None:
-                idx = feat_idx[0]
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                    # cache last frame of last two chunk
-                    cache_x = torch.cat([
-                        feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                            cache_x.device), cache_x
-                    ],
-                        dim=2)
-                x = layer(x, feat_cache[idx])
-                feat_cache[idx] = cache_x
-                feat_idx[0] += 1
+                x = feat_cache(layer, x)
             else:
                 x = layer(x)
         return x + h
@@ -315,52 +344,30 @@ class Encoder3d(nn.Module):
             RMS_norm(out_dim, images=False), nn.SiLU(),
             CausalConv3d(out_dim, z_dim, 3, padding=1))
 
-    def forward(self, x, feat_cache=None, feat_idx=[0]):
+    def forward(self, x, feat_cache=None):
         if feat_cache is not None:
-            idx = feat_idx[0]
-            cache_x = x[:, :, -CACHE_T:, :, :].clone()
-            if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                # cache last frame of last two chunk
-                cache_x = torch.cat([
-                    feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                        cache_x.device), cache_x
-                ],
-                    dim=2)
-            x = self.conv1(x, feat_cache[idx])
-            feat_cache[idx] = cache_x
-            feat_idx[0] += 1
+            x = feat_cache(self.conv1, x)
         else:
             x = self.conv1(x)
 
         # downsamples
         for layer in self.downsamples:
             if feat_cache is not None:
-                x = layer(x, feat_cache, feat_idx)
+                x = layer(x, feat_cache)
             else:
                 x = layer(x)
 
         # middle
         for layer in self.middle:
             if isinstance(layer, ResidualBlock) and feat_cache is not None:
-                x = layer(x, feat_cache, feat_idx)
+                x = layer(x, feat_cache)
             else:
                 x = layer(x)
 
         # head
         for layer in self.head:
             if isinstance(layer, CausalConv3d) and feat_cache is not None:
-                idx = feat_idx[0]
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                    # cache last frame of last two chunk
-                    cache_x = torch.cat([
-                        feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                            cache_x.device), cache_x
-                    ],
-                        dim=2)
-                x = layer(x, feat_cache[idx])
-                feat_cache[idx] = cache_x
-                feat_idx[0] += 1
+                x = feat_cache(layer, x)
             else:
                 x = layer(x)
         return x
@@ -420,66 +427,36 @@ class Decoder3d(nn.Module):
             RMS_norm(out_dim, images=False), nn.SiLU(),
             CausalConv3d(out_dim, 3, 3, padding=1))
 
-    def forward(self, x, feat_cache=None, feat_idx=[0]):
+    def forward(self, x, feat_cache=None):
         # conv1
         if feat_cache is not None:
-            idx = feat_idx[0]
-            cache_x = x[:, :, -CACHE_T:, :, :].clone()
-            if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                # cache last frame of last two chunk
-                cache_x = torch.cat([
-                    feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                        cache_x.device), cache_x
-                ],
-                    dim=2)
-            x = self.conv1(x, feat_cache[idx])
-            feat_cache[idx] = cache_x
-            feat_idx[0] += 1
+            x = feat_cache(self.conv1, x)
         else:
             x = self.conv1(x)
 
         # middle
         for layer in self.middle:
             if isinstance(layer, ResidualBlock) and feat_cache is not None:
-                x = layer(x, feat_cache, feat_idx)
+                x = layer(x, feat_cache)
             else:
                 x = layer(x)
 
         # upsamples
         for layer in self.upsamples:
             if feat_cache is not None:
-                x = layer(x, feat_cache, feat_idx)
+                x = layer(x, feat_cache)
             else:
                 x = layer(x)
 
         # head
         for layer in self.head:
             if isinstance(layer, CausalConv3d) and feat_cache is not None:
-                idx = feat_idx[0]
-                cache_x = x[:, :, -CACHE_T:, :, :].clone()
-                if cache_x.shape[2] < 2 and feat_cache[idx] is not None:
-                    # cache last frame of last two chunk
-                    cache_x = torch.cat([
-                        feat_cache[idx][:, :, -1, :, :].unsqueeze(2).to(
-                            cache_x.device), cache_x
-                    ],
-                        dim=2)
-                x = layer(x, feat_cache[idx])
-                feat_cache[idx] = cache_x
-                feat_idx[0] += 1
+                x = feat_cache(layer, x)
             else:
                 x = layer(x)
         return x
 
 
-def count_conv3d(model):
-    count = 0
-    for m in model.modules():
-        if isinstance(m, CausalConv3d):
-            count += 1
-    return count
-
-
 class WanVAE_(nn.Module):
 
     def __init__(self,
@@ -514,65 +491,60 @@ class WanVAE_(nn.Module):
         x_recon = self.decode(z)
         return x_recon, mu, log_var
 
-    def encode(self, x, scale):
+    def encode(self, x, scale, sink=None):
         self.clear_cache()
-        # cache
+        out = self.cached_encode(x, scale, sink=sink)
+        self.clear_cache()
+        return out
+
+    def cached_encode(self, x, scale, feat_cache=None, sink=None):
+        # x: [b,c,t,h,w]
+        # feat_cache: a cache from `new_encode_cache` to encode a video of its own chunk by chunk, the module cache
+        # by default. A new cache encodes the first frame on its own, then 4 frames at a time: a long video
+        # streamed in chunks of 1 + 4n frames, then 4n frames, gives the latents of a single encode
+        # (frames after the last 4 are ignored, as with a single encode)
+        # sink: called with the latents [b,c,t,h,w] of every chunk (1 latent frame) instead of returning them
+        if feat_cache is None:
+            feat_cache = self._enc_feat_map
         t = x.shape[2]
-        iter_ = 1 + (t - 1) // 4
         # 对encode输入的x，按时间拆分为1、4、4、4....
-        for i in range(iter_):
-            self._enc_conv_idx = [0]
-            if i == 0:
-                out = self.encoder(
-                    x[:, :, :1, :, :],
-                    feat_cache=self._enc_feat_map,
-                    feat_idx=self._enc_conv_idx)
+        num_first_frames = 0 if self.encoder.conv1 in feat_cache else 1
+        starts = list(range(num_first_frames, t - 3, 4))
+        chunks = [(0, 1)] * num_first_frames + [(start, start + 4) for start in starts]
+        out = None
+        for i, (start, end) in enumerate(chunks):
+            out_ = self.encoder(x[:, :, start:end, :, :], feat_cache=feat_cache)
+            mu, log_var = self.conv1(out_).chunk(2, dim=1)
+            if isinstance(scale[0], torch.Tensor):
+                mu = (mu - scale[0].view(1, self.z_dim, 1, 1, 1)) * scale[1].view(
+                    1, self.z_dim, 1, 1, 1)
             else:
-                out_ = self.encoder(
-                    x[:, :, 1 + 4 * (i - 1):1 + 4 * i, :, :],
-                    feat_cache=self._enc_feat_map,
-                    feat_idx=self._enc_conv_idx)
-                out = torch.cat([out, out_], 2)
-        mu, log_var = self.conv1(out).chunk(2, dim=1)
-        if isinstance(scale[0], torch.Tensor):
-            mu = (mu - scale[0].view(1, self.z_dim, 1, 1, 1)) * scale[1].view(
-                1, self.z_dim, 1, 1, 1)
-        else:
-            mu = (mu - scale[0]) * scale[1]
-        self.clear_cache()
-        return mu
+                mu = (mu - scale[0]) * scale[1]
+            if sink is not None:
+                sink(mu)
+                continue
+            if out is None:
+                out = mu.new_empty([*mu.shape[:2], len(chunks), *mu.shape[3:]])
+            out[:, :, i:i + 1] = mu
+        return out
 
-    def decode(self, z, scale, return_in_cpu=False):
+    def decode(self, z, scale, return_in_cpu=False, sink=None, tile_size=None, tile_overlap=0):
         self.clear_cache()
-        # z: [b,c,t,h,w]
-        if isinstance(scale[0], torch.Tensor):
-            z = z / scale[1].view(1, self.z_dim, 1, 1, 1) + scale[0].view(
-                1, self.z_dim, 1, 1, 1)
-        else:
-            z = z / scale[1] + scale[0]
-        iter_ = z.shape[2]
-        x = self.conv2(z)
-        for i in range(iter_):
-            self._conv_idx = [0]
-            if i == 0:
-                out = self.decoder(
-                    x[:, :, i:i + 1, :, :],
-                    feat_cache=self._feat_map,
-                    feat_idx=self._conv_idx)
-            else:
-                out_ = self.decoder(
-                    x[:, :, i:i + 1, :, :],
-                    feat_cache=self._feat_map,
-                    feat_idx=self._conv_idx)
-                out = torch.cat([out, out_], 2)
+        out = self.cached_decode(z, scale, return_in_cpu=return_in_cpu, sink=sink,
+                                 tile_size=tile_size, tile_overlap=tile_overlap)
         self.clear_cache()
-        if return_in_cpu:
-            out = out.cpu()
         return out
 
-    def cached_decode(self, z, scale, return_in_cpu=False):
-        # TODO: return_in_cpu not implemented
+    def cached_decode(self, z, scale, return_in_cpu=False, feat_cache=None, sink=None, tile_size=None,
+                      tile_overlap=0):
         # z: [b,c,t,h,w]
+        # feat_cache: a cache from `new_decode_cache` to decode a video of its own, the module cache by default
+        # sink: called with every decoded chunk [b,c,t,h,w] (1 frame for the first latent frame of a new cache,
+        # 4 for the others) instead of returning the video
+        # tile_size: decode the frames in tiles of at most tile_size x tile_size latent pixels overlapping by
+        # tile_overlap, so that the activations of the decoder no longer grow with the frame size
+        if feat_cache is None:
+            feat_cache = self._feat_map
         if isinstance(scale[0], torch.Tensor):
             z = z / scale[1].view(1, self.z_dim, 1, 1, 1) + scale[0].view(
                 1, self.z_dim, 1, 1, 1)
@@ -580,21 +552,92 @@ class WanVAE_(nn.Module):
             z = z / scale[1] + scale[0]
         iter_ = z.shape[2]
         x = self.conv2(z)
+        out = None
+        start = 0
         for i in range(iter_):
-            self._conv_idx = [0]
-            if i == 0:
-                out = self.decoder(
-                    x[:, :, i:i + 1, :, :],
-                    feat_cache=self._feat_map,
-                    feat_idx=self._conv_idx)
+            if tile_size is None:
+                out_ = self.decoder(x[:, :, i:i + 1, :, :], feat_cache=feat_cache)
             else:
-                out_ = self.decoder(
-                    x[:, :, i:i + 1, :, :],
-                    feat_cache=self._feat_map,
-                    feat_idx=self._conv_idx)
-                out = torch.cat([out, out_], 2)
+                out_ = self.tiled_decode(x[:, :, i:i + 1, :, :], feat_cache, tile_size, tile_overlap)
+            if sink is not None:
+                sink(out_)
+                continue
+            if out is None:
+                # the output grows linearly with the video, every chunk is written in place instead of
+                # concatenated (a quadratic amount of copies)
+                out = out_.new_empty(
+                    [*out_.shape[:2], self.num_decoded_frames(iter_, out_.shape[2]), *out_.shape[3:]],
+                    device="cpu" if return_in_cpu else None)
+            out[:, :, start:start + out_.shape[2]] = out_
+            start += out_.shape[2]
         return out
 
+    def tiled_decode(self, x, feat_cache, tile_size, tile_overlap):
+        # every tile is decoded with a causal cache of its own, the overlapping borders of the tiles are
+        # blended with linear ramps
+        scale = 2**(len(self.dim_mult) - 1)
+        rows = self._tiles(x.shape[3], tile_size, tile_overlap, scale, x.device)
+        cols = self._tiles(x.shape[4], tile_size, tile_overlap, scale, x.device)
+        out = None
+        for r0, r1, row_weight in rows:
+            for c0, c1, col_weight in cols:
+                tile = self.decoder(
+                    x[:, :, :, r0:r1, c0:c1],
+                    feat_cache=feat_cache.tile((r0, r1, c0, c1)))
+                if out is None:
+                    out = torch.zeros(
+                        [*tile.shape[:3], x.shape[3] * scale, x.shape[4] * scale],
+                        device=tile.device)
+                out[..., r0 * scale:r1 * scale, c0 * scale:c1 * scale].addcmul_(
+                    tile, row_weight[:, None] * col_weight)
+        return out.type_as(tile)
+
+    @staticmethod
+    def _tiles(size, tile_size, tile_overlap, scale, device):
+        # (start, end, weight) of the tiles along an axis of `size` latent pixels, evenly spaced and overlapping by
+        # at least `tile_overlap`. The weights of the `scale` times larger decoded tiles ramp up and down over
+        # `tile_overlap` at the inner borders and sum to 1 over the axis
+        if size <= tile_size:
+            return [(0, size, torch.ones(size * scale, device=device))]
+        assert tile_overlap < tile_size, "the tiles must overlap by less than their size"
+        num_tiles = math.ceil((size - tile_overlap) / (tile_size - tile_overlap))
+        starts = [round(i * (size - tile_size) / (num_tiles - 1)) for i in range(num_tiles)]
+        position = torch.arange(size * scale, device=device) + 0.5
+        ramp = max(tile_overlap * scale, 1)
+        weights = []
+        for start in starts:
+            weight = torch.ones(size * scale, device=device)
+            if start > 0:
+                weight = weight.minimum((position - start * scale) / ramp)
+            if start + tile_size < size:
+                weight = weight.minimum(((start + tile_size) * scale - position) / ramp)
+            weights.append(weight.clamp(min=0))
+        total = torch.stack(weights).sum(0)
+        return [(start, start + tile_size, (weight / total)[start * scale:(start + tile_size) * scale])
+                for start, weight in zip(starts, weights)]
+
+    def num_context_frames(self):
+        # number of previous latent frames the decoded frames of a latent frame depend on through the causal
+        # convolutions of the decoder. Decoding from that many latent frames earlier with a new cache gives the
+        # same frames, so a long video can be decoded in independent segments
+        # (the decoder registers its layers in the order they are applied)
+        upsample_convs = {
+            layer.time_conv
+            for layer in self.decoder.modules()
+            if isinstance(layer, Resample) and layer.mode == 'upsample3d'
+        }
+        num_frames, rate = 0, 1
+        for layer in self.decoder.modules():
+            if isinstance(layer, CausalConv3d):
+                num_frames += layer._padding[4] / rate
+                if layer in upsample_convs:
+                    rate *= 2
+        return math.ceil(num_frames)
+
+    def num_decoded_frames(self, num_latent_frames, num_first_frames):
+        # the first latent frame decodes to `num_first_frames` frames (1 with a new cache), the others to 4
+        return num_first_frames + (num_latent_frames - 1) * 2**sum(self.temperal_upsample)
+
     def sample(self, imgs, deterministic=False):
         mu, log_var = self.encode(imgs)
         if deterministic:
@@ -602,14 +645,16 @@ class WanVAE_(nn.Module):
         std = torch.exp(0.5 * log_var.clamp(-30.0, 20.0))
         return mu + std * torch.randn_like(std)
 
+    def new_decode_cache(self):
+        return CausalConvCache()
+
+    def new_encode_cache(self):
+        return CausalConvCache()
+
     def clear_cache(self):
-        self._conv_num = count_conv3d(self.decoder)
-        self._conv_idx = [0]
-        self._feat_map = [None] * self._conv_num
+        self._feat_map = CausalConvCache()
         # cache encode
-        self._enc_conv_num = count_conv3d(self.encoder)
-        self._enc_conv_idx = [0]
-        self._enc_feat_map = [None] * self._enc_conv_num
+        self._enc_feat_map = CausalConvCache()
 
 
 def _video_vae(pretrained_path=None, z_dim=None, device='cpu', **kwargs):